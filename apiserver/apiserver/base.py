@@ -12,6 +12,7 @@ import zipfile
 from datamart_core.common import log_future
 from datamart_geo import GeoData
 from datamart_materialize import get_writer
+from datamart_profiler import spatial
 
 from .graceful_shutdown import GracefulApplication
 
@@ -161,7 +162,11 @@ class Application(GracefulApplication):
             logger.warning(
                 "$NOMINATIM_URL is not set, not resolving addresses"
             )
-        self.geo_data = GeoData.from_local_cache()
+        if os.environ.get('NOMINATIM_CACHE'):
+            spatial.nominatim_cache = spatial.SqliteNominatimCache(
+                os.environ['NOMINATIM_CACHE'],
+            )
+        self.geo_data = spatial.CachedGeoData(GeoData.from_local_cache())
         self.channel = None
 
         self.custom_fields = {}
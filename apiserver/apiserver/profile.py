@@ -37,12 +37,14 @@ PROM_PROFILE = PromMeasureRequest(
 
 
 class ProfilePostedData(tornado.web.RequestHandler):
-    def handle_data_parameter(self, data, *, fast=False):
+    def handle_data_parameter(self, data, *, fast=False, columns=None):
         """
         Handles the 'data' parameter.
 
         :param data: the input parameter
         :param fast: whether to perform "fast" profiling, unsuitable for search
+        :param columns: indexes of the columns to profile, if not all of them
+            are needed (only used if not `fast`)
         :return: (data, data_profile)
           data: data as bytes (either the input or loaded from the input)
           data_profile: the profiling (metadata) of the data
@@ -63,6 +65,20 @@ class ProfilePostedData(tornado.web.RequestHandler):
         else:
             data_profile = self.application.redis.get('profile:' + data_hash)
 
+        # A profile of some of the columns is stored under its own key, so it
+        # is never mistaken for the full profile
+        profile_key = 'profile:' + data_hash
+        if columns and not fast:
+            columns = sorted(set(columns))
+            profile_key = 'profile-columns:%s:%s' % (
+                data_hash,
+                ','.join(str(idx) for idx in columns),
+            )
+            if data_profile is None:
+                data_profile = self.application.redis.get(profile_key)
+        else:
+            columns = None
+
         # Do format conversion
         materialize = {}
 
@@ -140,6 +156,7 @@ class ProfilePostedData(tornado.web.RequestHandler):
                             search=True,
                             include_sample=True,
                             coverage=True,
+                            columns=columns,
                         )
                     logger.info("Profiled in %.2fs", time.perf_counter() - start)
 
@@ -147,7 +164,7 @@ class ProfilePostedData(tornado.web.RequestHandler):
                 data_profile['version'] = os.environ['DATAMART_VERSION']
 
                 self.application.redis.set(
-                    'profile:' + data_hash,
+                    profile_key,
                     json.dumps(
                         data_profile,
                         # Compact
@@ -506,10 +506,6 @@ class Search(BaseHandler, GracefulHandler, ProfilePostedData):
                 'data_profile': bool(data_profile),
             },
         ):
-            # parameter: data
-            if data is not None:
-                data_profile, _ = self.handle_data_parameter(data)
-
             # parameter: data_id
             if data_id:
                 data_profile = get_data_profile_from_es(
@@ -545,6 +541,17 @@ class Search(BaseHandler, GracefulHandler, ProfilePostedData):
                             "Unknown augmentation_type",
                         )
 
+            # parameter: data
+            # Only the columns the query focuses on need to be profiled
+            if data is not None:
+                try:
+                    data_profile, _ = self.handle_data_parameter(
+                        data,
+                        columns=tabular_variables,
+                    )
+                except ValueError as e:
+                    return self.send_error_json(400, str(e))
+
             # At least one of them must be provided
             if not query_args_main and not data_profile:
                 return self.send_error_json(
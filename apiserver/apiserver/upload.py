@@ -60,6 +60,7 @@ class Upload(BaseHandler):
         if 'file' in self.request.files:
             file = self.request.files['file'][0]
             metadata['filename'] = file.filename
+            metadata['size'] = len(file.body)
             manual_annotations = self.get_body_argument(
                 'manual_annotations',
                 None,
@@ -103,6 +104,9 @@ class Upload(BaseHandler):
                     ),
                 )
 
+            # Size hint, for scheduling by the profiler
+            metadata['size'] = len(response.content)
+
             # Set identifier
             metadata['materialize']['identifier'] = 'datamart.url'
 
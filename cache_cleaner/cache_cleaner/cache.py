@@ -35,13 +35,23 @@ PROM_CACHE_USER_DATASETS_BYTES = prometheus_client.Gauge(
     'cache_user_datasets_bytes',
     "Total size of user datasets in cache",
 )
+PROM_CACHE_PROFILES = prometheus_client.Gauge(
+    'cache_profiles_count',
+    "Number of dataset profiles in cache",
+)
+PROM_CACHE_PROFILES_BYTES = prometheus_client.Gauge(
+    'cache_profiles_bytes',
+    "Total size of dataset profiles in cache",
+)
 
 
 CACHE_HIGH = os.environ.get('MAX_CACHE_BYTES')
 CACHE_HIGH = int(CACHE_HIGH, 10) if CACHE_HIGH else 100000000000  # 100 GB
 CACHE_LOW = CACHE_HIGH * 0.33
 
-CACHES = ('/cache/datasets', '/cache/aug', '/cache/user_data')
+CACHES = (
+    '/cache/datasets', '/cache/aug', '/cache/user_data', '/cache/profiles',
+)
 
 
 def get_tree_size(path):
@@ -126,8 +136,18 @@ def check_cache():
         logger.info("%d user datasets in cache, %d bytes",
                     user_datasets, user_data_bytes)
 
+        # Count profiles in cache
+        profiles, profiles_bytes = measure_cache_dir('/cache/profiles')
+        PROM_CACHE_PROFILES.set(profiles)
+        PROM_CACHE_PROFILES_BYTES.set(profiles_bytes)
+        logger.info("%d profiles in cache, %d bytes",
+                    profiles, profiles_bytes)
+
         # Remove from caches if max is reached
-        if datasets_bytes + augmentations_bytes > CACHE_HIGH:
+        if (
+            datasets_bytes + augmentations_bytes + profiles_bytes
+            > CACHE_HIGH
+        ):
             fut = asyncio.get_event_loop().run_in_executor(
                 None,
                 clear_caches,
@@ -153,6 +173,7 @@ def main():
     os.makedirs('/cache/datasets', exist_ok=True)
     os.makedirs('/cache/aug', exist_ok=True)
     os.makedirs('/cache/user_data', exist_ok=True)
+    os.makedirs('/cache/profiles', exist_ok=True)
 
     check_cache()  # Schedules itself to run periodically
     asyncio.get_event_loop().run_forever()
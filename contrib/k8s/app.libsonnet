@@ -878,11 +878,17 @@ function(config) {
               name: 'profiler',
               image: config.image,
               imagePullPolicy: 'IfNotPresent',
-              args: ['profiler'],
+              // Empty the metrics of the worker processes on restart
+              args: [
+                'bash',
+                '-c',
+                'rm -rf /tmp/prometheus/* && exec profiler',
+              ],
               env: utils.env(
                 {
                   LOG_FORMAT: config.log_format,
                   AUCTUS_OTEL_SERVICE: 'profiler',
+                  PROMETHEUS_MULTIPROC_DIR: '/tmp/prometheus',
                   OTEL_EXPORTER_JAEGER_AGENT_SPLIT_OVERSIZED_BATCHES: '1',
                   ELASTICSEARCH_HOSTS: 'elasticsearch:9200',
                   ELASTICSEARCH_PREFIX: config.elasticsearch.prefix,
@@ -914,6 +920,10 @@ function(config) {
                   mountPath: '/cache',
                   name: 'cache',
                 },
+                {
+                  mountPath: '/tmp/prometheus',
+                  name: 'prometheus',
+                },
               ],
             },
           ],
@@ -924,6 +934,12 @@ function(config) {
                 claimName: 'cache',
               },
             },
+            {
+              name: 'prometheus',
+              emptyDir: {
+                medium: 'Memory',
+              },
+            },
           ],
         },
       },
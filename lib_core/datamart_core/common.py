@@ -244,6 +244,21 @@ class PrefixedElasticsearch(object):
             **kwargs,
         )
 
+    def streaming_bulk(self, actions, **kwargs):
+        """Run actions in bulk, yielding ``(ok, item)`` for each in order.
+
+        Errors are reported rather than raised.
+        """
+        return elasticsearch.helpers.streaming_bulk(
+            self.es,
+            (
+                dict(action, _index=self.add_prefix(action['_index']))
+                for action in actions
+            ),
+            raise_on_error=False,
+            **kwargs,
+        )
+
     def close(self):
         self.es.close()
 
@@ -371,6 +386,14 @@ def add_dataset_to_sup_index(es, dataset_id, metadata):
     Adds dataset to the supplementary Datamart indices: 'columns',
     'spatial_coverage', and 'temporal_coverage'.
     """
+    for index, body in _sup_index_documents(dataset_id, metadata):
+        es.index(index, body)
+
+
+def _sup_index_documents(dataset_id, metadata):
+    """
+    Generates the ``(index, document)`` pairs for the supplementary indices.
+    """
     DISCARD_DATASET_FIELDS = [
         'columns', 'sample', 'materialize',
         'spatial_coverage', 'temporal_coverage',
@@ -399,10 +422,7 @@ def add_dataset_to_sup_index(es, dataset_id, metadata):
                 )
                 for num_range in column_metadata['coverage']
             ]
-        es.index(
-            'columns',
-            column_metadata
-        )
+        yield 'columns', column_metadata
 
     # 'spatial_coverage' index
     if 'spatial_coverage' in metadata:
@@ -423,10 +443,7 @@ def add_dataset_to_sup_index(es, dataset_id, metadata):
                         min_lat=coordinates[1][1],
                     ))
                 spatial_coverage_metadata['ranges'] = ranges
-            es.index(
-                'spatial_coverage',
-                spatial_coverage_metadata,
-            )
+            yield 'spatial_coverage', spatial_coverage_metadata
 
     # 'temporal_coverage' index
     if 'temporal_coverage' in metadata:
@@ -442,10 +459,7 @@ def add_dataset_to_sup_index(es, dataset_id, metadata):
                 )
                 for temporal_range in temporal_coverage_metadata['ranges']
             ]
-            es.index(
-                'temporal_coverage',
-                temporal_coverage_metadata,
-            )
+            yield 'temporal_coverage', temporal_coverage_metadata
 
 
 def add_dataset_to_index(es, dataset_id, metadata):
@@ -467,6 +481,52 @@ def add_dataset_to_index(es, dataset_id, metadata):
     )
 
 
+def add_datasets_to_index(es, datasets):
+    """
+    Adds multiple datasets to all the Datamart indices, in bulk.
+
+    A dataset that fails to be added to the 'datasets' index is not added to
+    the others. A dataset that fails to be added to the other indices is
+    left in 'datasets', so `delete_dataset_from_index()` can clean it up.
+
+    :param datasets: List of ``(dataset_id, metadata)`` pairs
+    :return: Dictionary of the datasets that failed, mapping their ID to the
+        first error
+    """
+    failed = {}
+
+    def record(results, dataset_ids):
+        for (ok, item), dataset_id in zip(results, dataset_ids):
+            if not ok and dataset_id not in failed:
+                failed[dataset_id] = item
+
+    # 'datasets' index
+    record(
+        es.streaming_bulk(
+            {
+                '_index': 'datasets',
+                '_id': dataset_id,
+                '_source': dict(metadata, id=dataset_id),
+            }
+            for dataset_id, metadata in datasets
+        ),
+        [dataset_id for dataset_id, _ in datasets],
+    )
+
+    # Supplementary indices
+    actions = []
+    dataset_ids = []
+    for dataset_id, metadata in datasets:
+        if dataset_id in failed:
+            continue
+        for index, body in _sup_index_documents(dataset_id, metadata):
+            actions.append({'_index': index, '_source': body})
+            dataset_ids.append(dataset_id)
+    record(es.streaming_bulk(actions), dataset_ids)
+
+    return failed
+
+
 def add_dataset_to_lazo_storage(es, id, metadata):
     """Adds a dataset to Lazo.
     """
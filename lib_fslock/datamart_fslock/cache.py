@@ -27,6 +27,8 @@ PROM_CACHE_HITS.labels('/cache/aug').inc(0)
 PROM_CACHE_MISSES.labels('/cache/aug').inc(0)
 PROM_CACHE_HITS.labels('/cache/user_data').inc(0)
 PROM_CACHE_MISSES.labels('/cache/user_data').inc(0)
+PROM_CACHE_HITS.labels('/cache/profiles').inc(0)
+PROM_CACHE_MISSES.labels('/cache/profiles').inc(0)
 
 
 @contextlib.contextmanager
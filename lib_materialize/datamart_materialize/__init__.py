@@ -33,6 +33,14 @@ class DatasetTooBig(Exception):
         self.limit = limit
         self.actual = actual
 
+    def __reduce__(self):
+        # The keyword-only arguments are not in args, pickle them too
+        return _dataset_too_big, (self.args, self.limit, self.actual)
+
+
+def _dataset_too_big(args, limit, actual):
+    return DatasetTooBig(*args, limit=limit, actual=actual)
+
 
 def _write_file(response, writer, size_limit=None):
     """Write download results to disk.
@@ -1,8 +1,12 @@
 from .core import count_rows_to_skip, process_dataset
+from .incremental import get_dataset_state, update_dataset
 from .temporal import parse_date
 
 
 __version__ = '0.11'
 
 
-__all__ = ['count_rows_to_skip', 'process_dataset', 'parse_date']
+__all__ = [
+    'count_rows_to_skip', 'process_dataset', 'get_dataset_state',
+    'update_dataset', 'parse_date',
+]
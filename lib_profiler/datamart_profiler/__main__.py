@@ -74,6 +74,16 @@ def main():
     parser.add_argument('--load-max-size', action='store', nargs=1,
                         help="target size of the data to be analyzed. The "
                              "data will be randomly sampled if it is bigger")
+    parser.add_argument('--workers', action='store', type=int, default=None,
+                        help="number of processes to use to profile columns "
+                             "in parallel")
+    parser.add_argument('--columns', action='store', default=None,
+                        help="comma-separated names of the columns to "
+                             "profile, other columns are not loaded")
+    parser.add_argument('--chunked',
+                        action='store_true', default=False,
+                        help="if the file is sampled, still read all of it "
+                             "to compute numerical and temporal statistics")
     parser.add_argument('file', nargs=1, help="file to profile")
     if detect_format_convert_to_csv is None:
         parser.add_argument(
@@ -131,6 +141,11 @@ def main():
         else:
             load_max_size = parse_size(args.load_max_size[0])
 
+    # Parse column names
+    columns = None
+    if args.columns is not None:
+        columns = args.columns.split(',')
+
     input_file = args.file[0]
     materialize = {}
 
@@ -174,6 +189,9 @@ def main():
                 coverage=args.coverage,
                 plots=args.plots,
                 load_max_size=load_max_size,
+                workers=args.workers,
+                columns=columns,
+                chunked=args.chunked,
             )
         except (pandas.errors.ParserError, UnicodeError):
             if detect_format_convert_to_csv is None:
@@ -1,11 +1,12 @@
 import codecs
 import collections
+import concurrent.futures
 import contextlib
 import csv
-from datetime import datetime
 import itertools
 import logging
 import math
+from multiprocessing.shared_memory import SharedMemory
 import numpy
 import opentelemetry.trace
 import os
@@ -14,15 +15,20 @@ from pandas.errors import EmptyDataError
 import prometheus_client
 import string
 import time
-import random
 import re
 import warnings
 
-from .numerical import mean_stddev, get_numerical_ranges, get_numerical_ranges_new
-from .profile_types import identify_types, determine_dataset_type
-from .spatial import LatLongColumn, Geohasher, nominatim_resolve_all, \
-    pair_latlong_columns, get_spatial_ranges, parse_wkt_column
-from .temporal import get_temporal_resolution, getQuarterData, getWeekData, getTimeOfDayData, checkAndCombineTemporalColumns
+from .encoding import EncodedColumn, TypedColumn
+from .numerical import mean_stddev, get_numerical_ranges, \
+    get_numerical_ranges_new, NumericalSummary
+from .profile_types import identify_types, determine_dataset_type, \
+    is_typed_dtype, parse_dates
+from .sketches import TopK
+from .spatial import CachedGeoData, LatLongColumn, Geohasher, \
+    nominatim_resolve_all, pair_latlong_columns, get_spatial_ranges, \
+    parse_wkt_column
+from .temporal import get_temporal_resolution, getQuarterData, getWeekData, getTimeOfDayData, combine_temporal_columns, \
+    get_temporal_histogram, get_temporal_ranges, to_datetime_index
 from . import types
 
 
@@ -35,6 +41,12 @@ RANDOM_SEED = 89
 MAX_SIZE = 5000000  # 5 MB
 SAMPLE_ROWS = 20
 
+SAMPLE_CHUNK_ROWS = 10000
+"""Number of rows read at a time when sampling a big file"""
+
+SAMPLE_THRESHOLD_MARGIN = 5.0
+"""Margin on the sampling keys to keep, in standard deviations"""
+
 MAX_UNCLEAN_ADDRESSES = 0.20  # 20%
 
 
@@ -47,6 +59,9 @@ HEADER_CONSISTENT_ROWS = 4
 
 MAX_GEOHASHES = 100
 
+LAZO_MAX_IN_FLIGHT = 4
+"""Maximum number of concurrent requests to the Lazo server"""
+
 
 BUCKETS = [
     1.0, 2.0, 4.0, 7.0, 12.0, 20.0, 32.0, 52.0, 80.0, 120.0, 190.0,
@@ -124,14 +139,114 @@ def expand_attribute_name(name):
 
 
 def _lazo_retry(func):
-    from lazo_index_service.errors import LazoError
     try:
         return func()
-    except LazoError:
-        pass
+    except Exception as e:
+        from lazo_index_service.errors import LazoError
+
+        if not isinstance(e, LazoError):
+            raise
     return func()
 
 
+def _is_textual(column_meta):
+    """Whether a column is sent to Lazo, once its types are known.
+    """
+    return (
+        column_meta['structural_type'] == types.TEXT
+        and types.DATE_TIME not in column_meta['semantic_types']
+    )
+
+
+class LazoPipeline(object):
+    """Sends textual columns to Lazo in the background.
+
+    Columns can be submitted as soon as they are profiled, so the requests
+    overlap with profiling the remaining columns. Only the distinct values
+    are sent, which doesn't change the MinHash sketch, with up to
+    `LAZO_MAX_IN_FLIGHT` requests at a time.
+
+    If `search` is False, the columns are indexed under `dataset_id`,
+    otherwise their sketches are computed. Use it as a context manager, so
+    that pending requests are cancelled if profiling fails.
+    """
+    def __init__(self, lazo_client, dataset_id=None, search=False):
+        self.lazo_client = lazo_client
+        self.dataset_id = dataset_id
+        self.search = search
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            LAZO_MAX_IN_FLIGHT,
+        )
+        self._futures = {}
+        self._start = None
+
+    def submit(self, column_idx, name, values):
+        """Send a column, given its distinct values.
+        """
+        if self._start is None:
+            self._start = time.perf_counter()
+        values = list(values)
+        if self.search:
+            def call_lazo():
+                return self.lazo_client.get_lazo_sketch_from_data(
+                    values,
+                    "",
+                    name,
+                )
+        else:
+            def call_lazo():
+                self.lazo_client.index_data(
+                    values,
+                    self.dataset_id,
+                    name,
+                )
+
+        self._futures[column_idx] = self._executor.submit(
+            _lazo_retry, call_lazo,
+        )
+
+    def results(self):
+        """Wait for the requests to complete.
+
+        :return: A dict mapping the index of each submitted column to the
+            result from Lazo (the sketch if `search` is True)
+        """
+        results = {}
+        with PROM_LAZO.time():
+            try:
+                for column_idx, future in self._futures.items():
+                    results[column_idx] = future.result()
+            except Exception:
+                if self.search:
+                    logger.warning("Error getting Lazo sketches")
+                else:
+                    logger.warning(
+                        "Error indexing textual attributes from %s",
+                        self.dataset_id,
+                    )
+                raise
+        if self._start is not None:
+            logger.info(
+                "%s with Lazo took %.2fs seconds",
+                "Sketching" if self.search else "Indexing",
+                time.perf_counter() - self._start,
+            )
+        return results
+
+    def close(self):
+        """Cancel the requests that haven't started, wait for the others.
+        """
+        for future in self._futures.values():
+            future.cancel()
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
 def count_rows_to_skip(file):
     """Count non-data rows at the top, such as titles etc.
     """
@@ -173,7 +288,114 @@ def count_rows_to_skip(file):
         file.seek(0, 0)
 
 
-def load_data(data, load_max_size=None, indexes=True):
+def read_csv_sample(file, ratio, usecols=None):
+    """Read a random sample of the rows of a CSV file, in a single pass.
+
+    The file is read in chunks, and each row is assigned a random key. Only
+    rows whose key might end up among the ``ceil(ratio * nb_rows)`` smallest
+    are kept, the threshold tightening as more rows are seen; the exact sample
+    is selected at the end, once the number of rows is known.
+
+    :param usecols: The indexes of the columns to read, defaults to all
+    :return: A tuple ``(dataframe, nb_rows)`` where `nb_rows` is the total
+        number of rows in the file (not counting the header)
+    """
+    rand = numpy.random.RandomState(RANDOM_SEED)
+    start = file.tell()
+    nb_rows = 0
+    kept = []
+    kept_keys = []
+    for chunk in pandas.read_csv(
+        file,
+        dtype=str, na_filter=False,
+        usecols=usecols,
+        chunksize=SAMPLE_CHUNK_ROWS,
+    ):
+        if not len(chunk):
+            continue
+        nb_rows += len(chunk)
+        keys = rand.random_sample(len(chunk))
+
+        # The final threshold is the ratio-quantile of the keys, which can't
+        # be much above the ratio once enough rows have been seen
+        threshold = ratio + SAMPLE_THRESHOLD_MARGIN * math.sqrt(
+            ratio * (1.0 - ratio) / nb_rows
+        )
+        mask = keys < threshold
+        kept.append(chunk[mask])
+        kept_keys.append(keys[mask])
+
+    if not kept:
+        # No rows, only the header
+        file.seek(start, 0)
+        data = pandas.read_csv(
+            file,
+            dtype=str, na_filter=False,
+            usecols=usecols,
+            nrows=0,
+        )
+        return data, 0
+
+    data = pandas.concat(kept)
+    keys = numpy.concatenate(kept_keys)
+
+    # Select the exact number of rows with the smallest keys
+    nb_selected = math.ceil(ratio * nb_rows)
+    if len(keys) > nb_selected:
+        selected = numpy.argpartition(keys, nb_selected)[:nb_selected]
+        selected.sort()  # Keep them in order
+        data = data.iloc[selected]
+    return data.reset_index(drop=True), nb_rows
+
+
+def _to_str(data):
+    # Change to object dtype first and do fillna() to work around bug
+    # https://github.com/pandas-dev/pandas/issues/25353 (nan as str 'nan')
+    return data.astype(object).fillna('').astype(str)
+
+
+def _encode_column(column):
+    """Encode a column of the data, as a `TypedColumn` if it's not strings.
+    """
+    if is_typed_dtype(column.dtype):
+        return TypedColumn.from_array(column)
+    else:
+        return EncodedColumn.from_array(column)
+
+
+def select_columns(column_names, columns):
+    """Get the indexes of the columns to profile.
+
+    :param column_names: The names of all the columns
+    :param columns: A list of column names or indexes. A name selects all the
+        columns with that name
+    :return: The sorted list of indexes
+    """
+    selected = set()
+    for column in columns:
+        if isinstance(column, (int, numpy.integer)):
+            if not 0 <= column < len(column_names):
+                raise ValueError("Column index out of range: %d" % column)
+            selected.add(int(column))
+        else:
+            matches = [
+                idx for idx, name in enumerate(column_names)
+                if name == column
+            ]
+            if not matches:
+                raise ValueError("No column named %r" % (column,))
+            selected.update(matches)
+    return sorted(selected)
+
+
+def load_data(data, load_max_size=None, indexes=True, typed=False,
+              columns=None):
+    """Load the data to profile, sampling it if it is bigger than needed.
+
+    :param columns: Only load those columns, see :func:`select_columns`.
+        Other columns are still listed in the returned column names
+    :return: A tuple ``(data, metadata, column_names)``
+    """
     metadata = {}
 
     if isinstance(data, pandas.DataFrame):
@@ -194,11 +416,26 @@ def load_data(data, load_max_size=None, indexes=True):
             data = data.reset_index()
 
         metadata['nb_rows'] = len(data)
-        # Change to object dtype first and do fillna() to work around bug
-        # https://github.com/pandas-dev/pandas/issues/25353 (nan as str 'nan')
-        data = data.astype(object).fillna('').astype(str)
-
         column_names = data.columns
+        if columns is not None:
+            data = data.iloc[:, select_columns(column_names, columns)]
+        if typed:
+            # Only convert the columns that can't be profiled from their dtype
+            convert = [
+                not is_typed_dtype(dtype) for dtype in data.dtypes
+            ]
+            if any(convert):
+                data = pandas.concat(
+                    [
+                        _to_str(column) if convert_column else column
+                        for convert_column, (_, column) in zip(
+                            convert, data.items(),
+                        )
+                    ],
+                    axis=1,
+                )
+        else:
+            data = _to_str(data)
     else:
         if not load_max_size:
             load_max_size = MAX_SIZE
@@ -244,34 +481,30 @@ def load_data(data, load_max_size=None, indexes=True):
                 del codec_reader
             data.seek(0, 0)
 
+            # Only read the selected columns, and only count their size
+            usecols = None
+            load_size = metadata['size']
+            if columns is not None and column_names is not None:
+                usecols = select_columns(column_names, columns)
+                load_size *= len(usecols) / len(column_names)
+
             # Load the data
-            if metadata['size'] > load_max_size:
-                logger.info("Counting rows...")
-                metadata['nb_rows'] = sum(1 for _ in data)
+            if load_size > load_max_size:
+                # Sub-sample
+                ratio = load_max_size / load_size
+                logger.info("Loading dataframe, sample ratio=%r...", ratio)
+                data, metadata['nb_rows'] = read_csv_sample(
+                    data, ratio, usecols=usecols,
+                )
                 if metadata['nb_rows'] > 0:
                     metadata['average_row_size'] = (
                         metadata['size'] / metadata['nb_rows']
                     )
-                data.seek(0, 0)
-
-                # Sub-sample
-                ratio = load_max_size / metadata['size']
-                logger.info("Loading dataframe, sample ratio=%r...", ratio)
-                rand = random.Random(RANDOM_SEED)
-                selected_rows = set(rand.sample(
-                    range(1, metadata['nb_rows']),
-                    math.ceil(ratio * (metadata['nb_rows'] - 1)),
-                ))
-                selected_rows.add(0)  # Always get the header
-                data = pandas.read_csv(
-                    data,
-                    dtype=str, na_filter=False,
-                    skiprows=lambda i: i not in selected_rows,
-                )
             else:
                 logger.info("Loading dataframe...")
                 data = pandas.read_csv(data,
-                                       dtype=str, na_filter=False)
+                                       dtype=str, na_filter=False,
+                                       usecols=usecols)
 
                 metadata['nb_rows'] = data.shape[0]
                 if metadata['nb_rows'] > 0:
@@ -285,6 +518,221 @@ def load_data(data, load_max_size=None, indexes=True):
     return data, metadata, column_names
 
 
+def iter_csv_chunks(data, usecols=None):
+    """Read a whole CSV file as strings, one chunk of rows at a time.
+
+    :param data: Path to the file, or file object, which is read from the
+        start
+    :param usecols: The indexes of the columns to read, defaults to all
+    """
+    with contextlib.ExitStack() as stack:
+        if isinstance(data, (str, bytes)):
+            data = stack.enter_context(open(data, 'rb'))
+        else:
+            data.seek(0, 0)
+        yield from pandas.read_csv(
+            data,
+            dtype=str, na_filter=False,
+            usecols=usecols,
+            chunksize=SAMPLE_CHUNK_ROWS,
+        )
+
+
+def get_numerical_values(array):
+    """Get the numbers in a column, for each row that has a valid one.
+
+    :param array: The column, as an `EncodedColumn`
+    :return: An array of float64, without NaNs or values too big to be
+        indexed
+    """
+    if isinstance(array, TypedColumn):
+        values = numpy.asarray(array.native, dtype=numpy.float64)
+    else:
+        values = pandas.to_numeric(
+            array.values,
+            errors='coerce',
+        ).astype(numpy.float64)
+    # Also drops NaN
+    valid = (
+        (-3.4e38 < values)
+        & (values < 3.4e38)  # Overflows in ES
+    )
+    return array.expand_array(values, valid)
+
+
+def get_latlong_points(lat_values, long_values):
+    """Get the valid points from latitude and longitude columns.
+
+    :return: An array of ``(lat, long)`` pairs
+    """
+    lat_values = pandas.to_numeric(lat_values, errors='coerce')
+    long_values = pandas.to_numeric(long_values, errors='coerce')
+    mask = (
+        ~numpy.isnan(lat_values)
+        & ~numpy.isnan(long_values)
+        & (-90.0 < lat_values) & (lat_values < 90.0)
+        & (-180.0 < long_values) & (long_values < 180.0)
+    )
+    return numpy.array([lat_values[mask], long_values[mask]]).T
+
+
+def count_words(counter, array):
+    """Count the words in the values of a column, in a `TopK`.
+    """
+    for value, count in zip(array.values, array.counts.tolist()):
+        counter.update(
+            [
+                word.lower() for word in _re_word_split.split(value)
+                if word
+            ],
+            itertools.repeat(count),
+        )
+
+
+def scan_columns(data, numerical=(), temporal=()):
+    """Read all the rows of a CSV file, summarizing some of its columns.
+
+    This is used to get statistics over the whole file when only a sample of
+    it was profiled. The file is read in chunks that are summarized and
+    dropped in turn, so memory doesn't grow with its size.
+
+    :param data: Path to the file, or file object
+    :param numerical: Indexes of the numerical columns
+    :param temporal: Indexes of the datetime columns
+    :return: A tuple of two dicts ``(numerical, temporal)`` mapping column
+        indexes to `NumericalSummary` objects. Datetimes are summarized as
+        nanoseconds since the epoch
+    """
+    numerical = {idx: NumericalSummary() for idx in numerical}
+    temporal = {idx: NumericalSummary() for idx in temporal}
+    usecols = sorted(set(numerical) | set(temporal))
+    if not usecols:
+        return numerical, temporal
+
+    for chunk in iter_csv_chunks(data, usecols=usecols):
+        for idx, (_, column) in zip(usecols, chunk.items()):
+            array = EncodedColumn.from_array(column)
+            if idx in numerical:
+                numerical[idx].update(get_numerical_values(array))
+            if idx in temporal:
+                temporal[idx].update(parse_dates(array).asi8)
+
+    return numerical, temporal
+
+
+def _numerical_plot(counts, edges):
+    return {
+        "type": "histogram_numerical",
+        "data": [
+            {
+                "count": int(count),
+                "bin_start": float(edges[i]),
+                "bin_end": float(edges[i + 1]),
+            }
+            for i, count in enumerate(counts)
+        ]
+    }
+
+
+def _temporal_plot(counts, edges):
+    return {
+        "type": "histogram_temporal",
+        "data": [
+            {
+                "count": count,
+                "date_start": edges[i].isoformat(),
+                "date_end": edges[i + 1].isoformat(),
+            }
+            for i, count in enumerate(counts)
+        ]
+    }
+
+
+def _categorical_plot(counter):
+    return {
+        "type": "histogram_categorical",
+        "data": [
+            {
+                "bin": value,
+                "count": count,
+            }
+            for value, count in sorted(counter.most_common(5))
+        ]
+    }
+
+
+def _text_plot(counter):
+    return {
+        "type": "histogram_text",
+        "data": [
+            {
+                "bin": value,
+                "count": count,
+            }
+            for value, count in counter.most_common(5)
+        ]
+    }
+
+
+def get_summary_temporal_ranges(summary):
+    """Get the temporal ranges from a `NumericalSummary` of datetimes.
+
+    :return: A tuple ``(ranges_date, ranges_time)``
+    """
+    bounds = numpy.array([summary.min, summary.max], dtype=numpy.int64)
+    return (
+        get_temporal_ranges(to_datetime_index(bounds)),
+        get_numerical_ranges_new(bounds // 1000000000),
+    )
+
+
+def get_temporal_coverage(columns, column_indexes, datetimes, timestamps,
+                          summary=None):
+    """Compute the temporal coverage entry for datetimes read from columns.
+
+    :param summary: A `NumericalSummary` of the datetimes of the whole file,
+        in nanoseconds, that the ranges are computed from instead
+    """
+    # Get temporal ranges
+    if summary is not None and summary.count:
+        ranges_date, ranges_time = get_summary_temporal_ranges(summary)
+    else:
+        ranges_date = get_temporal_ranges(datetimes)
+        ranges_time = get_numerical_ranges_new(timestamps)
+
+    # Get temporal resolution
+    resolution = get_temporal_resolution(datetimes)
+
+    column_types = []
+    for idx in column_indexes:
+        semantic_types = columns[idx]['semantic_types']
+        if types.DATE in semantic_types:
+            column_types.append(types.DATE)
+        elif types.TIME in semantic_types:
+            column_types.append(types.TIME)
+        else:
+            column_types.append(types.DATE_TIME)
+
+    coverage = {
+        'type': 'datetime',
+        'column_names': [columns[idx]['name'] for idx in column_indexes],
+        'column_indexes': list(column_indexes),
+        'column_types': column_types,
+        'ranges_date': ranges_date,
+        'ranges_time': ranges_time,
+        'temporal_resolution': resolution,
+    }
+
+    # get hourly, weekly and quarterly data
+    if resolution in ['hour', 'minute', 'second', 'month', 'day']:
+        coverage['week_percentage_data'] = getWeekData(datetimes)
+        coverage['quarter_percentage_data'] = getQuarterData(datetimes)
+    if resolution in ['hour', 'minute', 'second']:
+        coverage['time_of_day_percentage_data'] = getTimeOfDayData(datetimes)
+
+    return coverage
+
+
 def process_column(
     array, column_meta,
     *,
@@ -294,6 +742,11 @@ def process_column(
     geo_data=None,
     nominatim=None,
 ):
+    """Profile a single column, updating its metadata dict.
+
+    :param array: The values of the column, as an `EncodedColumn`
+    :return: Values resolved while profiling, needed to compute coverage
+    """
     # Identify types
     with tracer.start_as_current_span('profile/identify_types'):
         structural_type, semantic_types_dict, additional_meta = \
@@ -325,15 +778,7 @@ def process_column(
     ):
         # Get numerical values needed for either ranges or plot
         with tracer.start_as_current_span('profile/parse_numerical_values'):
-            numerical_values = []
-            for e in array:
-                try:
-                    e = float(e)
-                except ValueError:
-                    pass
-                else:
-                    if -3.4e38 < e < 3.4e38:  # Overflows in ES
-                        numerical_values.append(e)
+            numerical_values = get_numerical_values(array)
 
         # Compute ranges from numerical values
         if coverage:
@@ -352,64 +797,32 @@ def process_column(
                     numerical_values,
                     bins=10,
                 )
-                counts = [int(i) for i in counts]
-                edges = [float(f) for f in edges]
-                column_meta['plot'] = {
-                    "type": "histogram_numerical",
-                    "data": [
-                        {
-                            "count": count,
-                            "bin_start": edges[i],
-                            "bin_end": edges[i + 1],
-                        }
-                        for i, count in enumerate(counts)
-                    ]
-                }
+                column_meta['plot'] = _numerical_plot(counts, edges)
 
     if types.DATE_TIME in semantic_types_dict:
         datetimes = semantic_types_dict['Data']
         resolved['datetimes'] = datetimes
-        timestamps = numpy.empty(
-            len(datetimes),
-            dtype='float32',
-        )
-        for j, dt in enumerate(datetimes):
-            timestamps[j] = dt.timestamp()
-        resolved['timestamps'] = timestamps
-        
-        
+        resolved['timestamps'] = datetimes.asi8 // 1000000000
 
         # Compute histogram from temporal values
         if plots and 'plot' not in column_meta:
             with tracer.start_as_current_span('profile/temporal_plot'):
-                counts, edges = numpy.histogram(timestamps, bins=10)
-                counts = [int(i) for i in counts]
-                column_meta['plot'] = {
-                    "type": "histogram_temporal",
-                    "data": [
-                        {
-                            "count": count,
-                            "date_start": datetime.utcfromtimestamp(
-                                float(edges[i]),
-                            ).isoformat(),
-                            "date_end": datetime.utcfromtimestamp(
-                                float(edges[i + 1]),
-                            ).isoformat(),
-                        }
-                        for i, count in enumerate(counts)
-                    ]
-                }
+                counts, edges = get_temporal_histogram(datetimes, bins=10)
+                column_meta['plot'] = _temporal_plot(counts, edges)
 
     #For date columns
     if types.DATE in semantic_types_dict:
         dates = semantic_types_dict['Data']
         resolved['datetimes'] = dates
         resolved['timestamps'] = []
+        # Part of a date split over multiple columns, e.g. 'Year'
+        resolved['temporal_part'] = semantic_types_dict[types.DATE]
         
     if types.TIME in semantic_types_dict:
         times = semantic_types_dict['Data']
+        resolved['temporal_part'] = semantic_types_dict[types.TIME]
         timestamps = numpy.empty(
-            len(datetimes),
+            len(times),
             dtype='float32',
         )
         for j, dt in enumerate(times):
@@ -421,23 +834,13 @@ def process_column(
     # Compute histogram from categorical values
     if plots and types.CATEGORICAL in semantic_types_dict:
         with tracer.start_as_current_span('profile/categorical_plot'):
-            counter = collections.Counter()
-            for value in array:
-                if not value:
-                    continue
-                counter[value] += 1
-            counts = counter.most_common(5)
-            counts = sorted(counts)
-            column_meta['plot'] = {
-                "type": "histogram_categorical",
-                "data": [
-                    {
-                        "bin": value,
-                        "count": count,
-                    }
-                    for value, count in counts
-                ]
-            }
+            counter = TopK()
+            non_empty = array.values != ''
+            counter.update(
+                array.values[non_empty],
+                array.counts[non_empty].tolist(),
+            )
+            column_meta['plot'] = _categorical_plot(counter)
 
     # Compute histogram from textual values
     if (
@@ -445,23 +848,10 @@ def process_column(
         'plot' not in column_meta
     ):
         with tracer.start_as_current_span('profile/textual_plot'):
-            counter = collections.Counter()
-            for value in array:
-                for word in _re_word_split.split(value):
-                    word = word.lower()
-                    if word:
-                        counter[word] += 1
-            counts = counter.most_common(5)
-            column_meta['plot'] = {
-                "type": "histogram_text",
-                "data": [
-                    {
-                        "bin": value,
-                        "count": count,
-                    }
-                    for value, count in counts
-                ]
-            }
+            # Only keep track of the most frequent words
+            counter = TopK()
+            count_words(counter, array)
+            column_meta['plot'] = _text_plot(counter)
 
     # Resolve addresses into coordinates
     if (
@@ -473,7 +863,8 @@ def process_column(
         with tracer.start_as_current_span('profile/nominatim'):
             locations, non_empty = nominatim_resolve_all(
                 nominatim,
-                array,
+                array.values,
+                counts=array.counts.tolist(),
             )
         if non_empty > 0:
             unclean_ratio = 1.0 - len(locations) / non_empty
@@ -492,7 +883,141 @@ def process_column(
     return resolved
 
 
-@PROM_LAZO.time()
+_worker_geo_data = None
+
+
+def _init_worker(geo_data_path):
+    global _worker_geo_data
+
+    if geo_data_path is not None:
+        from datamart_geo import GeoData
+
+        _worker_geo_data = CachedGeoData(GeoData(geo_data_path))
+
+
+def _process_column_worker(
+    shm_name, offset, length, cls, values, counts,
+    column_meta, kwargs,
+):
+    # Get the codes from shared memory
+    shm = SharedMemory(name=shm_name)
+    try:
+        codes = numpy.frombuffer(
+            shm.buf,
+            dtype=numpy.intp, count=length, offset=offset,
+        ).copy()
+    finally:
+        shm.close()
+    array = cls(values, counts, codes)
+
+    resolved = process_column(
+        array, column_meta,
+        geo_data=_worker_geo_data,
+        **kwargs
+    )
+
+    # Areas hold a reference to the database, send their fields instead
+    if 'admin_areas' in resolved:
+        resolved['admin_areas'] = [
+            (
+                area.id, area.name, area.type, area.levels,
+                area.latitude, area.longitude, area.bounds,
+            )
+            for area in resolved['admin_areas']
+        ]
+
+    return column_meta, resolved
+
+
+def process_columns_parallel(
+    data, columns, manual_columns, workers,
+    *,
+    plots, coverage, geo_data, nominatim, column_done=None,
+):
+    """Profile the columns in a pool of processes.
+
+    The columns are encoded here, and the codes for each row are sent to the
+    workers through shared memory, so only the distinct values get pickled.
+
+    :param column_done: Function called with the index and `EncodedColumn` of
+        each column once it has been profiled, in order
+    :return: The values resolved for each column, like `process_column()`
+    """
+    encoded = []
+    with tracer.start_as_current_span('profile/encode_columns'):
+        for column_idx in range(len(columns)):
+            encoded.append(_encode_column(data.iloc[:, column_idx]))
+
+    itemsize = numpy.dtype(numpy.intp).itemsize
+    shm = SharedMemory(
+        create=True,
+        size=max(1, sum(len(array) for array in encoded) * itemsize),
+    )
+    try:
+        offsets = []
+        offset = 0
+        for array in encoded:
+            view = numpy.ndarray(
+                len(array),
+                dtype=numpy.intp, buffer=shm.buf, offset=offset,
+            )
+            view[:] = array.codes
+            del view  # Buffer can't be closed while it is exported
+            offsets.append(offset)
+            offset += len(array) * itemsize
+
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(geo_data._data_path if geo_data is not None else None,),
+        ) as executor:
+            futures = []
+            for column_idx, (column_meta, array) in enumerate(
+                zip(columns, encoded),
+            ):
+                logger.info(
+                    "Submitting column %d %r...",
+                    column_idx, column_meta['name'],
+                )
+                futures.append(executor.submit(
+                    _process_column_worker,
+                    shm.name, offsets[column_idx], len(array),
+                    type(array),
+                    (
+                        array.native if isinstance(array, TypedColumn)
+                        else array.values
+                    ),
+                    array.counts,
+                    column_meta,
+                    dict(
+                        manual=manual_columns.get(column_meta['name']),
+                        plots=plots,
+                        coverage=coverage,
+                        nominatim=nominatim,
+                    ),
+                ))
+
+            resolved_columns = {}
+            for column_idx, future in enumerate(futures):
+                column_meta, resolved = future.result()
+                columns[column_idx].update(column_meta)
+                if 'admin_areas' in resolved:
+                    from datamart_geo import Area
+
+                    resolved['admin_areas'] = [
+                        Area(geo_data, *fields)
+                        for fields in resolved['admin_areas']
+                    ]
+                resolved_columns[column_idx] = resolved
+                if column_done is not None:
+                    column_done(column_idx, encoded[column_idx])
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return resolved_columns
+
+
 def lazo_index_data(
     data,
     dataset_id,
@@ -500,45 +1025,95 @@ def lazo_index_data(
     lazo_client,
 ):
     logger.info("Indexing textual data with Lazo...")
-    start = time.perf_counter()
-    for idx, name in zip(columns_textual, column_textual_names):
-        def call_lazo():
-            lazo_client.index_data(
-                data.iloc[:, idx].values.tolist(),
-                dataset_id,
-                name,
-            )
+    with LazoPipeline(lazo_client, dataset_id) as lazo:
+        for idx, name in zip(columns_textual, column_textual_names):
+            lazo.submit(idx, name, pandas.unique(data.iloc[:, idx].values))
+        lazo.results()
 
-        _lazo_retry(call_lazo)
-    logger.info(
-        "Indexing with Lazo took %.2fs seconds",
-        time.perf_counter() - start,
-    )
 
-
-@PROM_LAZO.time()
 def get_lazo_data_sketch(
     data,
     columns_textual, column_textual_names,
     lazo_client,
 ):
     logger.info("Sketching textual data with Lazo...")
-    start = time.perf_counter()
-    lazo_sketches = []
-    for idx, name in zip(columns_textual, column_textual_names):
-        def call_lazo():
-            return lazo_client.get_lazo_sketch_from_data(
-                data.iloc[:, idx].values.tolist(),
-                "",
-                name,
-            )
+    with LazoPipeline(lazo_client, search=True) as lazo:
+        for idx, name in zip(columns_textual, column_textual_names):
+            lazo.submit(idx, name, pandas.unique(data.iloc[:, idx].values))
+        results = lazo.results()
+    return [results[idx] for idx in columns_textual]
+
+
+def summarize_file(data, columns, selected=None, *,
+                   coverage=True, plots=True):
+    """Update the metadata of profiled columns from the whole file.
+
+    The mean, standard deviation, ranges, and plots of numerical columns,
+    and the plots of datetime columns, are replaced by those computed over
+    all the rows by :func:`scan_columns`.
+
+    :param columns: The metadata of the profiled columns
+    :param selected: The index of each profiled column in the file, if not
+        all the columns were profiled
+    :return: A tuple of two dicts ``(numerical, temporal)``, mapping indexes
+        in `columns` to `NumericalSummary` objects
+    """
+    if selected is None:
+        selected = range(len(columns))
+    numerical = [
+        idx for idx, col in enumerate(columns)
+        if col['structural_type'] in (types.INTEGER, types.FLOAT)
+    ]
+    temporal = [
+        idx for idx, col in enumerate(columns)
+        if types.DATE_TIME in col['semantic_types']
+    ]
+    if not numerical and not temporal:
+        return {}, {}
 
-        lazo_sketches.append(_lazo_retry(call_lazo))
     logger.info(
-        "Sketching with Lazo took %.2fs seconds",
-        time.perf_counter() - start,
+        "Reading the whole file, %d numerical and %d datetime columns...",
+        len(numerical), len(temporal),
     )
-    return lazo_sketches
+    with tracer.start_as_current_span('profile/scan_file'):
+        numerical_summaries, temporal_summaries = scan_columns(
+            data,
+            numerical=[selected[idx] for idx in numerical],
+            temporal=[selected[idx] for idx in temporal],
+        )
+    numerical = {
+        idx: numerical_summaries[selected[idx]] for idx in numerical
+    }
+    temporal = {
+        idx: temporal_summaries[selected[idx]] for idx in temporal
+    }
+
+    for idx, summary in numerical.items():
+        if not summary.count:
+            continue
+        column_meta = columns[idx]
+        if coverage:
+            column_meta['mean'], column_meta['stddev'] = \
+                summary.mean_stddev()
+            ranges = summary.ranges()
+            if ranges:
+                column_meta['coverage'] = ranges
+        if plots:
+            counts, edges = summary.histogram(bins=10)
+            column_meta['plot'] = _numerical_plot(counts, edges)
+    for idx, summary in temporal.items():
+        if not summary.count:
+            continue
+        column_meta = columns[idx]
+        plot = column_meta.get('plot')
+        if plots and plot and plot['type'] == 'histogram_temporal':
+            items, weights = summary.weighted_items()
+            counts, edges = get_temporal_histogram(
+                items, bins=10, weights=weights,
+            )
+            column_meta['plot'] = _temporal_plot(counts, edges)
+
+    return numerical, temporal
 
 
 @PROM_PROFILE.time()
@@ -546,8 +1121,8 @@ def process_dataset(data, dataset_id=None, metadata=None,
                     lazo_client=None, nominatim=None, geo_data=None,
                     search=False, include_sample=False,
                     coverage=True, plots=False, indexes=True,
-                    load_max_size=None,
-                    **kwargs):
+                    load_max_size=None, workers=None, typed=False,
+                    columns=None, chunked=False, **kwargs):
     """Compute all metafeatures from a dataset.
 
     :param data: path to dataset, or file object, or DataFrame
@@ -557,7 +1132,8 @@ def process_dataset(data, dataset_id=None, metadata=None,
     :param lazo_client: client for the Lazo Index Server
     :param nominatim: URL of the Nominatim server
     :param geo_data: ``True`` or a datamart_geo.GeoData instance to use to
-        resolve named administrative territorial entities
+        resolve named administrative territorial entities. Pass the same
+        ``spatial.CachedGeoData`` to multiple calls to reuse its lookups
     :param search: True if this method is being called during the search
         operation (and not for indexing).
     :param include_sample: Set to True to include a few random rows to the
@@ -570,6 +1146,21 @@ def process_dataset(data, dataset_id=None, metadata=None,
     :param load_max_size: Target size of the data to be analyzed. The data will
         be randomly sampled if it is bigger. Defaults to `MAX_SIZE`, currently
         5 MB. This is different from the sample data included in the result.
+    :param workers: Number of processes to use to profile the columns in
+        parallel. Defaults to profiling them one at a time in this process.
+    :param typed: If the input is a DataFrame, profile the columns that have
+        a numerical, boolean, or datetime dtype directly from their values,
+        instead of converting everything to strings first. This is faster and
+        uses less memory, and gives the same types, except that floats are
+        not checked for dates.
+    :param columns: Only load and profile those columns, given as a list of
+        names or indexes. The other columns are listed in the result, but
+        only with their name and ``'unprofiled': True``.
+    :param chunked: If the input is a file that is bigger than
+        `load_max_size`, types are still identified from a sample, but the
+        whole file is then read in chunks to compute the statistics, ranges,
+        and plots of numerical and datetime columns. Memory use stays
+        bounded, the distributions are approximated with sketches.
     :return: JSON structure (dict)
     """
     if 'sample_size' in kwargs:
@@ -588,16 +1179,29 @@ def process_dataset(data, dataset_id=None, metadata=None,
         from datamart_geo import GeoData
 
         geo_data = GeoData.from_local_cache()
+    if geo_data is not None and not isinstance(geo_data, CachedGeoData):
+        geo_data = CachedGeoData(geo_data)
 
     if metadata is None:
         metadata = {}
 
+    if chunked and isinstance(data, pandas.DataFrame):
+        warnings.warn(
+            "chunked is set but ignored since the data was already loaded "
+            + "and provided as a DataFrame",
+            UserWarning,
+        )
+        chunked = False
+    source = data
+
     # Load or prepare data for processing
     try:
         data, file_metadata, column_names = load_data(
             data,
             load_max_size=load_max_size,
             indexes=indexes,
+            typed=typed,
+            columns=columns,
         )
     except EmptyDataError:
         logger.warning("Dataframe is empty!")
@@ -608,21 +1212,35 @@ def process_dataset(data, dataset_id=None, metadata=None,
         return metadata
     metadata.update(file_metadata)
     metadata['nb_profiled_rows'] = data.shape[0]
-    metadata['nb_columns'] = data.shape[1]
+    metadata['nb_columns'] = len(column_names)
 
     if 'columns' in metadata:
-        columns = metadata['columns']
+        all_columns = metadata['columns']
         logger.info("Using provided columns info")
-        if len(columns) != len(data.columns):
+        if len(all_columns) != len(column_names):
             raise ValueError("Column metadata doesn't match number of columns")
-        for column_meta, name in zip(columns, column_names):
+        for column_meta, name in zip(all_columns, column_names):
             if 'name' in column_meta and column_meta['name'] != name:
                 raise ValueError("Column names don't match")
             column_meta['name'] = name
     else:
         logger.info("Setting column names from header")
-        columns = [{'name': name} for name in column_names]
-        metadata['columns'] = columns
+        all_columns = [{'name': name} for name in column_names]
+        metadata['columns'] = all_columns
+
+    # Only the selected columns were loaded, the others are left out from now
+    # on, and indexes are mapped back to all the columns at the end
+    if columns is not None:
+        selected = select_columns(column_names, columns)
+        logger.info(
+            "Profiling %d/%d columns", len(selected), len(column_names),
+        )
+        for idx in set(range(len(all_columns))) - set(selected):
+            all_columns[idx]['unprofiled'] = True
+        columns = [all_columns[idx] for idx in selected]
+    else:
+        selected = None
+        columns = all_columns
 
     if data.shape[0] == 0:
         logger.info("0 rows, returning early")
@@ -644,72 +1262,83 @@ def process_dataset(data, dataset_id=None, metadata=None,
     # build coverage information would be too slow
     resolved_columns = {}
 
-    # Identify types
-    logger.info("Identifying types, %d columns...", len(columns))
-    with PROM_TYPES.time():
-        with tracer.start_as_current_span('profile/columns'):
-            for column_idx, column_meta in enumerate(columns):
-                name = column_meta['name']
-                with tracer.start_as_current_span('profile/column', attributes={'idx': column_idx, 'name': name}):
-                    logger.info("Processing column %d %r...", column_idx, name)
-                    array = data.iloc[:, column_idx]
-                    if name in manual_columns:
-                        manual = manual_columns[name]
-                    else:
-                        manual = None
-                    # Process the column, updating the column_meta dict
-                    resolved_columns[column_idx] = process_column(
-                        array, column_meta,
-                        manual=manual,
+    # Textual columns are sent to Lazo as soon as they are profiled, while the
+    # other columns are being profiled
+    lazo = None
+    if lazo_client:
+        lazo = LazoPipeline(lazo_client, dataset_id, search=search)
+
+    def column_done(column_idx, array):
+        if lazo is not None and _is_textual(columns[column_idx]):
+            lazo.submit(
+                column_idx,
+                columns[column_idx]['name'],
+                array.values,
+            )
+
+    with lazo if lazo is not None else contextlib.nullcontext():
+        # Identify types
+        logger.info("Identifying types, %d columns...", len(columns))
+        with PROM_TYPES.time():
+            with tracer.start_as_current_span('profile/columns'):
+                if workers is not None and workers > 1 and len(columns) > 1:
+                    logger.info("Using %d processes", workers)
+                    resolved_columns = process_columns_parallel(
+                        data, columns, manual_columns, workers,
                         plots=plots,
                         coverage=coverage,
                         geo_data=geo_data,
                         nominatim=nominatim,
+                        column_done=column_done,
+                    )
+                else:
+                    for column_idx, column_meta in enumerate(columns):
+                        name = column_meta['name']
+                        with tracer.start_as_current_span('profile/column', attributes={'idx': column_idx, 'name': name}):
+                            logger.info("Processing column %d %r...", column_idx, name)
+                            with tracer.start_as_current_span('profile/encode_column'):
+                                array = _encode_column(
+                                    data.iloc[:, column_idx],
+                                )
+                            if name in manual_columns:
+                                manual = manual_columns[name]
+                            else:
+                                manual = None
+                            # Process the column, updating the column_meta dict
+                            resolved_columns[column_idx] = process_column(
+                                array, column_meta,
+                                manual=manual,
+                                plots=plots,
+                                coverage=coverage,
+                                geo_data=geo_data,
+                                nominatim=nominatim,
+                            )
+                            column_done(column_idx, array)
+
+        # Textual columns
+        if lazo is not None:
+            with tracer.start_as_current_span('profile/categorical'):
+                lazo_results = lazo.results()
+            if search:
+                # saving sketches into metadata
+                for idx, sketch in sorted(lazo_results.items()):
+                    n_permutations, hash_values, cardinality = sketch
+                    columns[idx]['lazo'] = dict(
+                        n_permutations=n_permutations,
+                        hash_values=list(hash_values),
+                        cardinality=cardinality,
                     )
 
-    # Textual columns
-    columns_textual = [
-        col_idx
-        for col_idx, col in enumerate(columns)
-        if (
-            col['structural_type'] == types.TEXT
-            and types.DATE_TIME not in col['semantic_types']
+    # Go over the whole file if only a sample was profiled
+    numerical_summaries = temporal_summaries = {}
+    if (
+        chunked
+        and (coverage or plots)
+        and metadata['nb_rows'] > metadata['nb_profiled_rows']
+    ):
+        numerical_summaries, temporal_summaries = summarize_file(
+            source, columns, selected, coverage=coverage, plots=plots,
         )
-    ]
-    if lazo_client and columns_textual:
-        with tracer.start_as_current_span('profile/categorical'):
-            # Indexing with lazo
-            column_textual_names = [columns[idx]['name'] for idx in columns_textual]
-            if not search:
-                try:
-                    lazo_index_data(
-                        data,
-                        dataset_id,
-                        columns_textual, column_textual_names,
-                        lazo_client,
-                    )
-                except Exception:
-                    logger.warning("Error indexing textual attributes from %s", dataset_id)
-                    raise
-            else:
-                try:
-                    lazo_sketches = get_lazo_data_sketch(
-                        data,
-                        columns_textual, column_textual_names,
-                        lazo_client,
-                    )
-                except Exception:
-                    logger.warning("Error getting Lazo sketches")
-                    raise
-                else:
-                    # saving sketches into metadata
-                    for sketch, idx in zip(lazo_sketches, columns_textual):
-                        n_permutations, hash_values, cardinality = sketch
-                        columns[idx]['lazo'] = dict(
-                            n_permutations=n_permutations,
-                            hash_values=list(hash_values),
-                            cardinality=cardinality,
-                        )
 
     # Pair lat & long columns
     columns_lat = [
@@ -772,21 +1401,12 @@ def process_dataset(data, dataset_id=None, metadata=None,
             with tracer.start_as_current_span('profile/spatial_coverage'):
                 # Compute sketches from lat/long pairs
                 for col_lat, col_long in latlong_pairs:
-                    lat_values = data.iloc[:, col_lat.index]
-                    lat_values = pandas.to_numeric(lat_values, errors='coerce')
-                    long_values = data.iloc[:, col_long.index]
-                    long_values = pandas.to_numeric(long_values, errors='coerce')
-                    mask = (
-                        ~numpy.isnan(lat_values)
-                        & ~numpy.isnan(long_values)
-                        & (-90.0 < lat_values) & (lat_values < 90.0)
-                        & (-180.0 < long_values) & (long_values < 180.0)
+                    values = get_latlong_points(
+                        data.iloc[:, col_lat.index],
+                        data.iloc[:, col_long.index],
                     )
 
-                    if mask.any():
-                        lat_values = lat_values[mask]
-                        long_values = long_values[mask]
-                        values = numpy.array([lat_values, long_values]).T
+                    if len(values):
                         logger.info(
                             "Computing spatial sketch lat=%r long=%r (%d rows)",
                             col_lat.name, col_long.name, len(values),
@@ -928,10 +1548,11 @@ def process_dataset(data, dataset_id=None, metadata=None,
 
                         # Compute geohashes
                         builder = Geohasher(number=MAX_GEOHASHES)
-                        for area in areas:
-                            if area is None or not area.bounds:
-                                continue
-                            builder.add_aab(area.bounds)
+                        builder.add_aabs(
+                            area.bounds
+                            for area in areas
+                            if area is not None and area.bounds
+                        )
                         hashes = builder.get_hashes_json()
                         if hashes:
                             cov['geohashes4'] = hashes
@@ -959,65 +1580,62 @@ def process_dataset(data, dataset_id=None, metadata=None,
                     "Computing temporal ranges datetime=%r (%d rows)",
                     col['name'], len(datetimes),
                 )
+                temporal_coverage.append(get_temporal_coverage(
+                    columns, [idx], datetimes, timestamps,
+                    summary=temporal_summaries.get(idx),
+                ))
 
-                # Get temporal ranges
-                ranges_date = get_numerical_ranges_new(datetimes)
-                ranges_time = get_numerical_ranges_new(timestamps)
-
-                # Get temporal resolution
-                resolution = get_temporal_resolution(datetimes)
-
-                # get hourly, weekly and quarterly data
-                if resolution in ['hour','minute','second']:
-                    weekPercentageData = getWeekData(datetimes)
-                    quarterPercentageData = getQuarterData(datetimes)
-                    timeOfDayPercentageData = getTimeOfDayData(datetimes)
-                    temporal_coverage.append({
-                        'type': 'datetime',
-                        'column_names': [col['name']],
-                        'column_indexes': [idx],
-                        'column_types': [types.DATE if types.DATE in col['semantic_types'] else types.TIME if types.TIME in col['semantic_types'] else types.DATE_TIME],
-                        'ranges_date': ranges_date,
-                        'ranges_time': ranges_time,
-                        'temporal_resolution': resolution,
-                        'week_percentage_data':weekPercentageData,
-                        'quarter_percentage_data': quarterPercentageData,
-                        'time_of_day_percentage_data':timeOfDayPercentageData
-                    })
-                elif resolution in ['month','day']:
-                    weekPercentageData = getWeekData(datetimes)
-                    quarterPercentageData = getQuarterData(datetimes)
-                    temporal_coverage.append({
-                        'type': 'datetime',
-                        'column_names': [col['name']],
-                        'column_indexes': [idx],
-                        'column_types': [types.DATE if types.DATE in col['semantic_types'] else types.TIME if types.TIME in col['semantic_types'] else types.DATE_TIME],
-                        'ranges_date': ranges_date,
-                        'ranges_time': ranges_time,
-                        'temporal_resolution': resolution,
-                        'week_percentage_data':weekPercentageData,
-                        'quarter_percentage_data': quarterPercentageData,
-                    })
-                else:
-                    temporal_coverage.append({
-                        'type': 'datetime',
-                        'column_names': [col['name']],
-                        'column_indexes': [idx],
-                        'column_types': [types.DATE if types.DATE in col['semantic_types'] else types.TIME if types.TIME in col['semantic_types'] else types.DATE_TIME],
-                        'ranges_date': ranges_date,
-                        'ranges_time': ranges_time,
-                        'temporal_resolution': resolution,
-                    })
-
-            # TODO: Times split over multiple columns
-            data,metadata = checkAndCombineTemporalColumns(data,metadata)
+            # Dates split over multiple columns
+            date_parts = {}
+            for idx, col in enumerate(columns):
+                if (
+                    types.DATE_TIME not in col['semantic_types']
+                    and 'temporal_part' in resolved_columns[idx]
+                ):
+                    date_parts[idx] = resolved_columns[idx]['temporal_part']
+            combined = None
+            if len(date_parts) >= 2:
+                combined = combine_temporal_columns(data, date_parts)
+            elif list(date_parts.values()) == ['Year']:
+                # A lone year column, its dates are the first of January.
+                # Years pandas can't represent are dropped, like when
+                # combining columns
+                idx, = date_parts
+                datetimes = pandas.DatetimeIndex(pandas.to_datetime(
+                    resolved_columns[idx]['datetimes'],
+                    errors='coerce',
+                    utc=True,
+                ))
+                datetimes = datetimes[~datetimes.isna()]
+                if len(datetimes):
+                    combined = [idx], datetimes
+            if combined is not None:
+                indexes, datetimes = combined
+                logger.info(
+                    "Computing temporal ranges for combined columns %r "
+                    + "(%d rows)",
+                    [columns[idx]['name'] for idx in indexes], len(datetimes),
+                )
+                temporal_coverage.append(get_temporal_coverage(
+                    columns, indexes, datetimes,
+                    datetimes.asi8 // 1000000000,
+                ))
 
         if temporal_coverage:
             metadata['temporal_coverage'] = temporal_coverage
 
+        if selected is not None:
+            for coverage_entry in itertools.chain(
+                metadata.get('spatial_coverage', ()),
+                metadata.get('temporal_coverage', ()),
+            ):
+                coverage_entry['column_indexes'] = [
+                    selected[idx] for idx in coverage_entry['column_indexes']
+                ]
+
     # Attribute names
     attribute_keywords = []
-    for col in columns:
+    for col in all_columns:
         attribute_keywords.append(col['name'])
         kw = list(expand_attribute_name(col['name']))
         if kw != [col['name']]:
@@ -1034,7 +1652,7 @@ def process_dataset(data, dataset_id=None, metadata=None,
                 replace=False,
             )
             choose_rows.sort()  # Keep it in order
-            sample = data.iloc[choose_rows]
+            sample = _to_str(data.iloc[choose_rows])
             sample = sample.applymap(truncate_string)  # Truncate long values
             metadata['sample'] = sample.to_csv(index=False, line_terminator='\r\n')
 
@@ -0,0 +1,98 @@
+import numpy
+import pandas
+
+
+class EncodedColumn(object):
+    """A column of strings, dictionary-encoded.
+
+    The distinct values are stored once, along with the number of rows in
+    which they appear, and the index of the value for each row. This allows
+    inspecting each value only once, no matter how many times it is repeated.
+    """
+    def __init__(self, values, counts, codes):
+        self.values = values
+        self.counts = counts
+        self.codes = codes
+
+    @classmethod
+    def from_array(cls, array):
+        """Encode a list, series, or array of strings.
+
+        Distinct values are kept in order of first appearance.
+        """
+        codes, values = pandas.factorize(numpy.asarray(array, dtype=object))
+        counts = numpy.bincount(codes, minlength=len(values))
+        return cls(values, counts, codes)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def rows(self):
+        """Get the value for each row, e.g. decode the column.
+        """
+        return self.values[self.codes]
+
+    def map(self, func):
+        """Apply a function to each distinct value, get the result for each row.
+
+        Rows for which the function returned None are omitted.
+        """
+        return self.expand([func(value) for value in self.values])
+
+    def expand(self, results):
+        """Get the result for each row, from results for each distinct value.
+
+        Rows for which the result is None are omitted.
+        """
+        array = numpy.empty(len(self.values), dtype=object)
+        valid = numpy.zeros(len(self.values), dtype=bool)
+        for i, result in enumerate(results):
+            array[i] = result
+            valid[i] = result is not None
+        codes = self.codes[valid[self.codes]]
+        return array[codes].tolist()
+
+    def expand_array(self, results, valid):
+        """Get the result for each row, from an array of results for each value.
+
+        :param results: Array with a result for each distinct value
+        :param valid: Boolean array, rows whose value is not valid are omitted
+        """
+        return results[self.codes[valid[self.codes]]]
+
+
+class TypedColumn(EncodedColumn):
+    """A column of numbers, booleans, or datetimes, dictionary-encoded.
+
+    The distinct values are kept in their original dtype in `native`, which
+    is what types and statistics are computed from. `values` has them as
+    strings, the way they would have been loaded from a CSV file; those are
+    only built if needed.
+    """
+    def __init__(self, native, counts, codes):
+        self.native = native
+        self.counts = counts
+        self.codes = codes
+        self._values = None
+
+    @classmethod
+    def from_array(cls, array):
+        """Encode a series with a numerical, boolean, or datetime dtype.
+
+        Missing values are encoded as a distinct value, NaN or NaT.
+        """
+        codes, native = pandas.factorize(array)
+        missing = codes < 0
+        if missing.any():
+            codes[missing] = len(native)
+            native = native.insert(len(native), None)
+        counts = numpy.bincount(codes, minlength=len(native))
+        return cls(native, counts, codes)
+
+    @property
+    def values(self):
+        if self._values is None:
+            self._values = pandas.Series(
+                self.native, dtype=object,
+            ).fillna('').astype(str).values
+        return self._values
@@ -0,0 +1,363 @@
+import copy
+import logging
+import numpy
+import os
+import pandas
+
+from .core import MAX_GEOHASHES, iter_csv_chunks, get_numerical_values, \
+    get_latlong_points, count_words, get_summary_temporal_ranges, \
+    _to_str, _numerical_plot, _temporal_plot, _categorical_plot, _text_plot
+from .encoding import EncodedColumn
+from .numerical import NumericalSummary
+from .profile_types import parse_dates
+from .sketches import HyperLogLog, TopK
+from .spatial import Geohasher
+from .temporal import get_temporal_histogram
+from . import types
+
+
+logger = logging.getLogger(__name__)
+
+
+class ColumnState(object):
+    """Mergeable summary of the values of a profiled column.
+
+    The number of rows, of empty values, and of distinct values are always
+    tracked. Depending on the types the column was profiled as, numbers and
+    datetimes are summarized in `NumericalSummary` objects, and the most
+    frequent values or words are counted for the plot.
+    """
+    def __init__(self, *, numerical=None, temporal=None, top=None,
+                 words=None):
+        self.nb_rows = 0
+        self.nb_empty = 0
+        self.distinct = HyperLogLog()
+        self.numerical = numerical
+        self.temporal = temporal
+        self.top = top
+        self.words = words
+
+    @classmethod
+    def for_column(cls, column_meta):
+        """Create an empty state for a column, from its profile.
+        """
+        plot_type = column_meta.get('plot', {}).get('type')
+        return cls(
+            numerical=(
+                NumericalSummary()
+                if column_meta['structural_type'] in (
+                    types.INTEGER, types.FLOAT,
+                )
+                else None
+            ),
+            temporal=(
+                NumericalSummary()
+                if types.DATE_TIME in column_meta['semantic_types']
+                else None
+            ),
+            top=TopK() if plot_type == 'histogram_categorical' else None,
+            words=TopK() if plot_type == 'histogram_text' else None,
+        )
+
+    def update(self, array):
+        """Add the values of a column, as an `EncodedColumn`.
+        """
+        non_empty = array.values != ''
+        self.nb_rows += len(array)
+        self.nb_empty += int(array.counts[~non_empty].sum())
+        self.distinct.update(array.values[non_empty])
+        if self.numerical is not None:
+            self.numerical.update(get_numerical_values(array))
+        if self.temporal is not None:
+            self.temporal.update(parse_dates(array).asi8)
+        if self.top is not None:
+            self.top.update(
+                array.values[non_empty],
+                array.counts[non_empty].tolist(),
+            )
+        if self.words is not None:
+            count_words(self.words, array)
+
+    def merge(self, other):
+        """Add the values summarized by another state to this one.
+        """
+        self.nb_rows += other.nb_rows
+        self.nb_empty += other.nb_empty
+        self.distinct.merge(other.distinct)
+        for name in ('numerical', 'temporal', 'top', 'words'):
+            summary = getattr(self, name)
+            if summary is not None:
+                summary.merge(getattr(other, name))
+
+    def update_metadata(self, column_meta):
+        """Update the profile of the column from this state.
+        """
+        if self.nb_empty:
+            column_meta['missing_values_ratio'] = self.nb_empty / self.nb_rows
+        else:
+            column_meta.pop('missing_values_ratio', None)
+        if 'num_distinct_values' in column_meta:
+            column_meta['num_distinct_values'] = self.distinct.count()
+
+        plot_type = column_meta.get('plot', {}).get('type')
+        if self.numerical is not None and self.numerical.count:
+            if 'mean' in column_meta:
+                column_meta['mean'], column_meta['stddev'] = \
+                    self.numerical.mean_stddev()
+                ranges = self.numerical.ranges()
+                if ranges:
+                    column_meta['coverage'] = ranges
+            if plot_type == 'histogram_numerical':
+                counts, edges = self.numerical.histogram(bins=10)
+                column_meta['plot'] = _numerical_plot(counts, edges)
+        if (
+            self.temporal is not None and self.temporal.count
+            and plot_type == 'histogram_temporal'
+        ):
+            items, weights = self.temporal.weighted_items()
+            counts, edges = get_temporal_histogram(
+                items, bins=10, weights=weights,
+            )
+            column_meta['plot'] = _temporal_plot(counts, edges)
+        if self.top is not None:
+            column_meta['plot'] = _categorical_plot(self.top)
+        if self.words is not None:
+            column_meta['plot'] = _text_plot(self.words)
+
+    def to_dict(self):
+        """Get the state as a JSON-serializable dict.
+        """
+        obj = {
+            'nb_rows': self.nb_rows,
+            'nb_empty': self.nb_empty,
+            'distinct': self.distinct.to_dict(),
+        }
+        for name in ('numerical', 'temporal', 'top', 'words'):
+            summary = getattr(self, name)
+            if summary is not None:
+                obj[name] = summary.to_dict()
+        return obj
+
+    @classmethod
+    def from_dict(cls, obj):
+        state = cls(
+            numerical=(
+                NumericalSummary.from_dict(obj['numerical'])
+                if 'numerical' in obj else None
+            ),
+            temporal=(
+                NumericalSummary.from_dict(obj['temporal'])
+                if 'temporal' in obj else None
+            ),
+            top=TopK.from_dict(obj['top']) if 'top' in obj else None,
+            words=TopK.from_dict(obj['words']) if 'words' in obj else None,
+        )
+        state.nb_rows = obj['nb_rows']
+        state.nb_empty = obj['nb_empty']
+        state.distinct = HyperLogLog.from_dict(obj['distinct'])
+        return state
+
+
+class DatasetState(object):
+    """Mergeable summary of a profiled dataset.
+
+    This has a `ColumnState` for each profiled column (None for the others),
+    and counts of points in a `Geohasher` for each pair of latitude and
+    longitude columns. States of consecutive parts of a dataset can be merged
+    to get the state of the whole, without reading it again.
+    """
+    def __init__(self, columns, latlong, *, nb_rows=0, size=None):
+        self.nb_rows = nb_rows
+        self.size = size
+        self.columns = columns
+        self.latlong = latlong
+
+    @classmethod
+    def for_dataset(cls, metadata):
+        """Create an empty state for a dataset, from its profile.
+        """
+        columns = [
+            None if column_meta.get('unprofiled')
+            else ColumnState.for_column(column_meta)
+            for column_meta in metadata['columns']
+        ]
+        latlong = {
+            tuple(coverage['column_indexes']): Geohasher(number=MAX_GEOHASHES)
+            for coverage in metadata.get('spatial_coverage', ())
+            if coverage['type'] == 'latlong'
+        }
+        return cls(columns, latlong)
+
+    def update(self, data):
+        """Add rows, as a DataFrame of strings with all the columns.
+        """
+        self.nb_rows += len(data)
+        for idx, column_state in enumerate(self.columns):
+            if column_state is not None:
+                column_state.update(
+                    EncodedColumn.from_array(data.iloc[:, idx]),
+                )
+        for (lat_idx, long_idx), builder in self.latlong.items():
+            points = get_latlong_points(
+                data.iloc[:, lat_idx],
+                data.iloc[:, long_idx],
+            )
+            if len(points):
+                builder.add_points(points)
+
+    def merge(self, other):
+        """Add the rows summarized by another state to this one.
+        """
+        if len(other.columns) != len(self.columns):
+            raise ValueError("States have different numbers of columns")
+        self.nb_rows += other.nb_rows
+        if self.size is not None and other.size is not None:
+            self.size += other.size
+        else:
+            self.size = None
+        for column_state, other_column in zip(self.columns, other.columns):
+            if column_state is not None:
+                column_state.merge(other_column)
+        for key, builder in self.latlong.items():
+            builder.merge(other.latlong[key])
+
+    def update_metadata(self, metadata):
+        """Update a profile from this state, in place.
+
+        The number of rows, the statistics and plots of columns, and the
+        temporal ranges and geohashes are updated. Types, the sample, spatial
+        ranges, and temporal resolution and distributions are kept from the
+        initial profile.
+        """
+        metadata['nb_rows'] = self.nb_rows
+        if self.size is not None and 'size' in metadata:
+            metadata['size'] = self.size
+            if self.nb_rows > 0:
+                metadata['average_row_size'] = self.size / self.nb_rows
+
+        for column_meta, column_state in zip(
+            metadata['columns'], self.columns,
+        ):
+            if column_state is not None:
+                column_state.update_metadata(column_meta)
+
+        for coverage in metadata.get('temporal_coverage', ()):
+            if len(coverage['column_indexes']) != 1:
+                continue  # Combined from multiple columns
+            column_state = self.columns[coverage['column_indexes'][0]]
+            if (
+                column_state is not None
+                and column_state.temporal is not None
+                and column_state.temporal.count
+            ):
+                coverage['ranges_date'], coverage['ranges_time'] = \
+                    get_summary_temporal_ranges(column_state.temporal)
+
+        for coverage in metadata.get('spatial_coverage', ()):
+            if coverage['type'] != 'latlong':
+                continue
+            builder = self.latlong[tuple(coverage['column_indexes'])]
+            coverage['geohashes4'] = builder.get_hashes_json()
+            coverage['number'] = builder.total
+
+    def to_dict(self):
+        """Get the state as a JSON-serializable dict.
+        """
+        return {
+            'nb_rows': self.nb_rows,
+            'size': self.size,
+            'columns': [
+                None if column_state is None else column_state.to_dict()
+                for column_state in self.columns
+            ],
+            'latlong': [
+                [list(key), builder.to_dict()]
+                for key, builder in self.latlong.items()
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, obj):
+        return cls(
+            [
+                None if column is None else ColumnState.from_dict(column)
+                for column in obj['columns']
+            ],
+            {
+                tuple(key): Geohasher.from_dict(builder)
+                for key, builder in obj['latlong']
+            },
+            nb_rows=obj['nb_rows'],
+            size=obj['size'],
+        )
+
+
+def get_dataset_state(data, metadata, indexes=True):
+    """Summarize the rows of a dataset, for the columns of a profile.
+
+    All the rows are read, in chunks, so memory use stays bounded.
+
+    :param data: path to dataset, or file object, or DataFrame. It should
+        have the same columns as when profiled
+    :param metadata: The profile of the dataset, from
+        :func:`~datamart_profiler.process_dataset`
+    :param indexes: Whether to include indexes, like
+        :func:`~datamart_profiler.process_dataset`
+    :return: A `DatasetState`
+    """
+    state = DatasetState.for_dataset(metadata)
+    nb_columns = len(metadata['columns'])
+
+    if isinstance(data, pandas.DataFrame):
+        # Turn indexes into regular columns
+        if (
+            indexes and (
+                data.index.dtype != numpy.int64
+                or not pandas.Index(numpy.arange(len(data))).equals(data.index)
+            )
+        ):
+            data = data.reset_index()
+        chunks = [_to_str(data)]
+    else:
+        if isinstance(data, (str, bytes)):
+            if not os.path.exists(data):
+                raise ValueError("data file does not exist")
+            state.size = os.path.getsize(data)
+        elif hasattr(data, 'read'):
+            data.seek(0, 2)
+            state.size = data.tell()
+        else:
+            raise TypeError("data should be a filename, a file object, or "
+                            "a pandas.DataFrame")
+        chunks = iter_csv_chunks(data)
+
+    for chunk in chunks:
+        if chunk.shape[1] != nb_columns:
+            raise ValueError("Column metadata doesn't match number of columns")
+        state.update(chunk)
+    logger.info("Summarized %d rows", state.nb_rows)
+    return state
+
+
+def update_dataset(data, metadata, state, indexes=True):
+    """Profile rows appended to a dataset, from the state of the previous rows.
+
+    Only the new rows are read. Their state is merged into `state`, which is
+    modified in place, and the metadata is updated from it. The types of the
+    columns are not identified again.
+
+    :param data: The new rows, as a path, file object, or DataFrame, with
+        the same columns
+    :param metadata: The profile of the previous rows, from
+        :func:`~datamart_profiler.process_dataset` or a previous call to this
+        function. It is not modified
+    :param state: The `DatasetState` of the previous rows, from
+        :func:`get_dataset_state` or a previous call to this function
+    :param indexes: Whether to include indexes, like
+        :func:`~datamart_profiler.process_dataset`
+    :return: The updated profile
+    """
+    state.merge(get_dataset_state(data, metadata, indexes=indexes))
+    metadata = copy.deepcopy(metadata)
+    state.update_metadata(metadata)
+    return metadata
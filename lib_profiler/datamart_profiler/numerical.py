@@ -1,10 +1,8 @@
 import logging
 import math
 import numpy
-from sklearn.cluster import KMeans
-from sklearn.exceptions import ConvergenceWarning
 
-from .warning_tools import ignore_warnings
+from .sketches import KLLSketch
 
 
 logger = logging.getLogger(__name__)
@@ -17,22 +15,19 @@ MIN_RANGE_SIZE = 0.1  # 10%
 def mean_stddev(array):
     """Compute the mean (average) and standard deviation of a numerical array.
     """
-    total = 0
-    count = 0
-    for elem in array:
-        if elem is not None:
-            total += elem
-            count += 1
-    mean = total / count if count > 0 else 0
-
-    total = 0
-    for elem in array:
-        if elem is not None:
-            elem = elem - mean
-            total += elem * elem
-    stddev = math.sqrt(total / count) if count > 0 else 0
-
-    return mean, stddev
+    array = numpy.asarray(array, dtype=numpy.float64)
+    array = array[~numpy.isnan(array)]
+    count = len(array)
+    if not count:
+        return 0, 0
+
+    # cumsum() adds in order, unlike sum() which does pairwise summation, so
+    # the results don't change with the implementation
+    mean = numpy.cumsum(array)[-1] / count
+    deviations = array - mean
+    stddev = math.sqrt(numpy.cumsum(deviations * deviations)[-1] / count)
+
+    return float(mean), stddev
 
 def get_numerical_ranges_new(values):
     """
@@ -47,47 +42,156 @@ def get_numerical_ranges_new(values):
 
     return ranges
 
-def get_numerical_ranges(values):
+
+def _segment_costs(prefix_w, prefix_x, prefix_x2, starts, ends):
+    """Sum of squared distances to the mean, for segments of the sorted values.
+    """
+    w = prefix_w[ends] - prefix_w[starts]
+    x = prefix_x[ends] - prefix_x[starts]
+    x2 = prefix_x2[ends] - prefix_x2[starts]
+    return numpy.maximum(x2 - x * x / w, 0.0)
+
+
+def optimal_clusters_1d(values, weights, k):
+    """Optimal k-means clustering of sorted distinct values, with weights.
+
+    This uses the dynamic programming approach of Ckmeans.1d.dp: the best
+    clustering of the first `j` values in `m` clusters is computed from the
+    best clusterings in `m - 1` clusters. Because the start of the last
+    cluster never decreases when `j` increases, each step is solved by divide
+    and conquer; each level of the recursion is computed at once with numpy.
+
+    :param values: Sorted array of distinct values
+    :param weights: Number of times each value appears
+    :param k: Number of clusters, at most the number of values
+    :returns: The index of the first value of each cluster, in order
+    """
+    n = len(values)
+    values = values - numpy.median(values)  # Improves numerical stability
+    prefix_w = numpy.concatenate([[0.0], numpy.cumsum(weights)])
+    prefix_x = numpy.concatenate([[0.0], numpy.cumsum(weights * values)])
+    prefix_x2 = numpy.concatenate(
+        [[0.0], numpy.cumsum(weights * values * values)],
+    )
+
+    # cost[j]: cost of the best clustering of the first j values
+    cost = numpy.full(n + 1, numpy.inf)
+    cost[1:] = _segment_costs(
+        prefix_w, prefix_x, prefix_x2,
+        numpy.zeros(n, dtype=numpy.intp), numpy.arange(1, n + 1),
+    )
+    # starts[m][j]: start of the last cluster, for j values in m + 1 clusters
+    starts = []
+    for m in range(1, k):
+        new_cost = numpy.full(n + 1, numpy.inf)
+        best_start = numpy.zeros(n + 1, dtype=numpy.intp)
+        # Ranges of j to compute, and ranges of possible starts for them
+        j_lo = numpy.array([m + 1], dtype=numpy.intp)
+        j_hi = numpy.array([n], dtype=numpy.intp)
+        opt_lo = numpy.array([m], dtype=numpy.intp)
+        opt_hi = numpy.array([n - 1], dtype=numpy.intp)
+        while len(j_lo):
+            mid = (j_lo + j_hi) // 2
+            cand_hi = numpy.minimum(mid - 1, opt_hi)
+            lengths = cand_hi - opt_lo + 1
+            offsets = numpy.concatenate([[0], numpy.cumsum(lengths)[:-1]])
+            task = numpy.repeat(numpy.arange(len(mid)), lengths)
+            candidates = (
+                opt_lo[task]
+                + numpy.arange(len(task)) - offsets[task]
+            )
+            costs = cost[candidates] + _segment_costs(
+                prefix_w, prefix_x, prefix_x2,
+                candidates, mid[task],
+            )
+
+            # Find the first best candidate for each task
+            task_min = numpy.minimum.reduceat(costs, offsets)
+            best = numpy.minimum.reduceat(
+                numpy.where(costs == task_min[task], candidates, n),
+                offsets,
+            )
+            new_cost[mid] = task_min
+            best_start[mid] = best
+
+            # Recurse on both halves
+            left = j_lo <= mid - 1
+            right = mid + 1 <= j_hi
+            j_lo, j_hi, opt_lo, opt_hi = (
+                numpy.concatenate([j_lo[left], mid[right] + 1]),
+                numpy.concatenate([mid[left] - 1, j_hi[right]]),
+                numpy.concatenate([opt_lo[left], best[right]]),
+                numpy.concatenate([best[left], opt_hi[right]]),
+            )
+        cost = new_cost
+        starts.append(best_start)
+
+    # Backtrack
+    clusters = []
+    end = n
+    for best_start in reversed(starts):
+        end = best_start[end]
+        clusters.append(int(end))
+    clusters.append(0)
+    clusters.reverse()
+    return clusters
+
+
+def get_numerical_ranges(values, weights=None):
     """
     Retrieve the numeral ranges given the input (timestamp, integer, or float).
 
-    This performs K-Means clustering, returning a maximum of 3 ranges.
+    This performs an optimal 1-dimensional K-Means clustering, returning a
+    maximum of 3 ranges.
+
+    :param weights: The number of values each element of `values` stands
+        for, e.g. from a sketch
     """
 
+    if weights is not None:
+        values = numpy.asarray(values)[weights > 0]
+        weights = weights[weights > 0]
+
     if not len(values):
         return []
 
     logger.info("Computing numerical ranges, %d values", len(values))
 
-    clustering = KMeans(n_clusters=min(N_RANGES, len(values)),
-                        random_state=0)
-    values_array = numpy.array(values).reshape(-1, 1)
-    with ignore_warnings(ConvergenceWarning):
-        clustering.fit(values_array)
-    logger.info("K-Means clusters: %r", list(clustering.cluster_centers_))
+    if weights is None:
+        values, counts = numpy.unique(
+            numpy.asarray(values, dtype=numpy.float64),
+            return_counts=True,
+        )
+    else:
+        values, inverse = numpy.unique(
+            numpy.asarray(values, dtype=numpy.float64),
+            return_inverse=True,
+        )
+        counts = numpy.bincount(inverse, weights=weights).astype(numpy.int64)
+    total = counts.sum()
+    starts = optimal_clusters_1d(values, counts, min(N_RANGES, len(values)))
+    ends = starts[1:] + [len(values)]
+    logger.info("Clusters: %r", [values[i] for i in starts])
 
     # Compute confidence intervals for each range
     ranges = []
     sizes = []
-    for rg in range(N_RANGES):
-        cluster = [values[i]
-                   for i in range(len(values))
-                   if clustering.labels_[i] == rg]
-        if not cluster:
-            continue
+    for start, end in zip(starts, ends):
+        cumulative = numpy.cumsum(counts[start:end])
+        size = cumulative[-1]
 
         # Eliminate clusters of outliers
-        if len(cluster) < MIN_RANGE_SIZE * len(values):
+        if size < MIN_RANGE_SIZE * total:
             continue
 
-        cluster.sort()
-        min_idx = int(0.05 * len(cluster))
-        max_idx = int(0.95 * len(cluster))
+        # Index into the sorted cluster, as if each value was repeated
+        min_idx = int(0.05 * size)
+        max_idx = int(0.95 * size)
         ranges.append([
-            cluster[min_idx],
-            cluster[max_idx],
+            values[start + numpy.searchsorted(cumulative, min_idx, 'right')],
+            values[start + numpy.searchsorted(cumulative, max_idx, 'right')],
         ])
-        sizes.append(len(cluster))
+        sizes.append(int(size))
     ranges.sort()
     logger.info("Ranges: %r", ranges)
     logger.info("Sizes: %r", sizes)
@@ -96,3 +200,122 @@ def get_numerical_ranges(values):
     ranges = [{'range': {'gte': float(rg[0]), 'lte': float(rg[1])}}
               for rg in ranges]
     return ranges
+
+
+class NumericalSummary(object):
+    """Summary of a numerical column, built chunk by chunk.
+
+    The count, minimum, maximum, mean and standard deviation are exact (the
+    moments of each chunk are merged with Chan's formulas), and the
+    distribution is kept in a `KLLSketch`, so memory stays constant.
+    """
+    def __init__(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.sketch = KLLSketch()
+
+    def update(self, values):
+        """Add a chunk of values, without NaNs.
+
+        The minimum and maximum are kept in the dtype of `values`, e.g. exact
+        int64 for timestamps.
+        """
+        if not len(values):
+            return
+        low, high = values.min(), values.max()
+        if self.min is None:
+            self.min, self.max = low, high
+        else:
+            self.min, self.max = min(self.min, low), max(self.max, high)
+
+        floats = numpy.asarray(values, dtype=numpy.float64)
+        self._merge_moments(
+            len(floats),
+            float(floats.mean()),
+            float(numpy.sum((floats - floats.mean()) ** 2)),
+        )
+        self.sketch.update(floats)
+
+    def merge(self, other):
+        """Add all the values of another summary to this one.
+        """
+        if not other.count:
+            return
+        if self.min is None:
+            self.min, self.max = other.min, other.max
+        else:
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        self._merge_moments(other.count, other.mean, other.m2)
+        self.sketch.merge(other.sketch)
+
+    def _merge_moments(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+
+    def mean_stddev(self):
+        """Get the mean and standard deviation, like `mean_stddev()`.
+        """
+        if not self.count:
+            return 0, 0
+        return self.mean, math.sqrt(self.m2 / self.count)
+
+    def weighted_items(self):
+        """Get sorted items and their weights, from the sketch.
+
+        The exact minimum and maximum are included, with a weight of 0. Items
+        have the dtype of the values that were added.
+        """
+        items, weights = self.sketch.weighted_items()
+        if not self.count:
+            return items, weights
+        dtype = numpy.asarray(self.min).dtype
+        return (
+            numpy.concatenate(
+                [[self.min], items.astype(dtype), [self.max]],
+            ).astype(dtype),
+            numpy.concatenate([[0], weights, [0]]),
+        )
+
+    def ranges(self):
+        """Get the numerical ranges, like `get_numerical_ranges()`.
+        """
+        items, weights = self.sketch.weighted_items()
+        return get_numerical_ranges(items, weights)
+
+    def histogram(self, bins=10):
+        """Get an histogram, like ``numpy.histogram()``.
+        """
+        items, weights = self.weighted_items()
+        counts, edges = numpy.histogram(items, bins=bins, weights=weights)
+        return counts.astype(numpy.int64), edges
+
+    def to_dict(self):
+        """Get the summary as a JSON-serializable dict.
+        """
+        return {
+            'count': self.count,
+            'min': None if self.min is None else self.min.item(),
+            'max': None if self.max is None else self.max.item(),
+            'mean': self.mean,
+            'm2': self.m2,
+            'sketch': self.sketch.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, obj):
+        summary = cls()
+        summary.count = obj['count']
+        if obj['min'] is not None:
+            summary.min = numpy.asarray(obj['min'])[()]
+            summary.max = numpy.asarray(obj['max'])[()]
+        summary.mean = obj['mean']
+        summary.m2 = obj['m2']
+        summary.sketch = KLLSketch.from_dict(obj['sketch'])
+        return summary
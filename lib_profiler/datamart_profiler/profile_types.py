@@ -1,13 +1,17 @@
 import collections
 from datetime import datetime
 import dateutil.tz
+import itertools
+import numpy
 import opentelemetry.trace
+import pandas
 import re
 import regex
 
 from . import types
+from .encoding import EncodedColumn, TypedColumn
 from .spatial import LATITUDE, LONGITUDE, disambiguate_admin_areas
-from .temporal import parse_date
+from .temporal import parse_date_array
 
 
 tracer = opentelemetry.trace.get_tracer(__name__)
@@ -92,36 +96,46 @@ TEXT_WORDS_THRESHOLD = 0.5  # 50%
 MAX_CATEGORICAL_RATIO = 0.10  # 10%
 
 
-def regular_exp_count(array):
+# Names that trigger the heuristics for dates split over multiple columns
+_date_part_names = ('year', 'month', 'day', 'hour', 'minute', 'second')
+
+
+def regular_exp_count(array, counts=None):
     """Count instances matching the structure of each data type, using regexes.
+
+    :param counts: The number of times each element of `array` appears, if it
+        only has distinct values
     """
     re_count = collections.Counter()
 
-    for elem in array:
+    if counts is None:
+        counts = itertools.repeat(1)
+
+    for elem, count in zip(array, counts):
         if not elem:
-            re_count['empty'] += 1
+            re_count['empty'] += count
         elif _re_int.match(elem):
-            re_count['int'] += 1
+            re_count['int'] += count
         elif _re_float.match(elem):
-            re_count['float'] += 1
+            re_count['float'] += count
         elif _re_url.match(elem):
-            re_count['url'] += 1
+            re_count['url'] += count
         elif _re_file.match(elem):
-            re_count['file'] += 1
+            re_count['file'] += count
         elif _re_wkt_point.match(elem):
-            re_count['point'] += 1
+            re_count['point'] += count
         elif _re_geo_combined.match(elem):
-            re_count['geo_combined'] += 1
+            re_count['geo_combined'] += count
         elif _re_other_point.match(elem):
-            re_count['other_point'] += 1
+            re_count['other_point'] += count
         elif _re_latlong_point.match(elem):
-            re_count['latlong_point'] += 1
+            re_count['latlong_point'] += count
         elif _re_wkt_polygon.match(elem):
-            re_count['polygon'] += 1
+            re_count['polygon'] += count
         elif len(_re_whitespace.findall(elem)) >= TEXT_WORDS - 1:
-            re_count['text'] += 1
+            re_count['text'] += count
         if elem.lower() in ('0', '1', 'true', 'false', 'y', 'n', 'yes', 'no'):
-            re_count['bool'] += 1
+            re_count['bool'] += count
 
     return re_count
 
@@ -205,19 +219,155 @@ def unclean_values_ratio(c_type, re_count, num_total):
 
 def parse_dates(array):
     """Parse the valid dates in an array of strings.
+
+    Each distinct value is only parsed once.
+
+    :return: A ``DatetimeIndex`` in UTC, with an element for each row that
+        contains a valid date
     """
-    parsed_dates = []
-    for elem in array:
-        elem = parse_date(elem)
-        if elem is not None:
-            parsed_dates.append(elem)
-    return parsed_dates
+    if not isinstance(array, EncodedColumn):
+        array = EncodedColumn.from_array(array)
+    dates = parse_date_array(array.values)
+    return array.expand_array(dates, ~dates.isna())
+
+
+def is_typed_dtype(dtype):
+    """Whether columns with that dtype can be profiled without strings.
+
+    This is the case for numbers, booleans, and datetimes.
+    """
+    if isinstance(dtype, pandas.DatetimeTZDtype):
+        return True
+    return isinstance(dtype, numpy.dtype) and dtype.kind in 'biufM'
+
+
+def _count_where(counts, mask):
+    return int(counts[mask].sum())
+
+
+def identify_types_typed(array, name):
+    """Identify the types of a `TypedColumn` from its dtype.
+
+    This gives the same types as :func:`identify_types` would on the column
+    formatted as strings, without inspecting them. Float columns that only
+    hold whole numbers (e.g. integers with missing values) are integers.
+
+    :return: Like :func:`identify_types`, or None if the column needs to be
+        inspected as strings, for example if it might contain dates
+    """
+    native = array.native
+    counts = array.counts
+    num_total = len(array)
+    column_meta = {}
+    semantic_types_dict = {}
+
+    if any(part in name.strip().lower() for part in _date_part_names):
+        return None
+
+    missing = numpy.asarray(pandas.isna(native))
+    num_empty = _count_where(counts, missing)
+    if num_empty == num_total:
+        return types.MISSING_DATA, semantic_types_dict, column_meta
+    num_distinct = len(native) - int(missing.sum())
+    threshold = max(1, (1.0 - MAX_UNCLEAN) * (num_total - num_empty))
+
+    kind = native.dtype.kind
+    if kind in 'bM':
+        structural_type = types.TEXT
+        if num_empty > 0:
+            column_meta['missing_values_ratio'] = num_empty / num_total
+        if kind == 'b':
+            semantic_types_dict[types.BOOLEAN] = None
+            column_meta['unclean_values_ratio'] = 0.0
+        column_meta['num_distinct_values'] = num_distinct
+        max_categorical = MAX_CATEGORICAL_RATIO * (num_total - num_empty)
+        if kind == 'b' or num_distinct <= max_categorical:
+            semantic_types_dict[types.CATEGORICAL] = set(
+                e for e in array.values if e
+            )
+        if kind == 'M':
+            dates = pandas.DatetimeIndex(native)
+            if dates.tz is None:
+                dates = dates.tz_localize('UTC')
+            else:
+                dates = dates.tz_convert('UTC')
+            semantic_types_dict[types.DATE_TIME] = 'DateTime'
+            semantic_types_dict['Data'] = array.expand_array(dates, ~missing)
+        return structural_type, semantic_types_dict, column_meta
+
+    numbers = numpy.asarray(native, dtype=numpy.float64)
+    with numpy.errstate(invalid='ignore'):
+        finite = numpy.isfinite(numbers)
+        whole = finite & (numbers == numpy.floor(numbers))
+    num_int = _count_where(counts, whole)
+    num_float = _count_where(counts, finite)
+    if num_int >= threshold:
+        structural_type = types.INTEGER
+        num_valid = num_int
+    elif num_float >= threshold:
+        structural_type = types.FLOAT
+        num_valid = num_float
+    else:
+        return None
+    column_meta['unclean_values_ratio'] = \
+        (num_total - num_empty - num_valid) / num_total
+    if num_empty > 0:
+        column_meta['missing_values_ratio'] = num_empty / num_total
+
+    if kind in 'iu':
+        # Integers that read like 'YYYYMMDD' or 'YYYYMM' might be dates
+        num_date_like = _count_where(
+            counts,
+            ((100000 <= numbers) & (numbers < 1000000))
+            | ((10000000 <= numbers) & (numbers < 100000000)),
+        )
+        if num_date_like >= threshold:
+            return None
+
+        # Identify booleans
+        num_bool = _count_where(counts, (numbers == 0) | (numbers == 1))
+        if num_bool >= threshold:
+            semantic_types_dict[types.BOOLEAN] = None
+            column_meta['unclean_values_ratio'] = \
+                (num_total - num_empty - num_bool) / num_total
+
+    if structural_type == types.INTEGER:
+        # Identify ids
+        if (name.lower().startswith('id') or
+                name.lower().endswith('id') or
+                name.lower().startswith('identifier') or
+                name.lower().endswith('identifier') or
+                name.lower().startswith('index') or
+                name.lower().endswith('index')):
+            semantic_types_dict[types.ID] = None
+
+        # Count distinct values
+        column_meta['num_distinct_values'] = num_distinct
+    else:
+        # Identify lat/long
+        with numpy.errstate(invalid='ignore'):
+            num_long = _count_where(
+                counts,
+                (-180.0 <= numbers) & (numbers <= 180.0),
+            )
+            num_lat = _count_where(
+                counts,
+                (-90.0 <= numbers) & (numbers <= 90.0),
+            )
+        if num_lat >= threshold and any(n in name.lower() for n in LATITUDE):
+            semantic_types_dict[types.LATITUDE] = None
+        if num_long >= threshold and any(n in name.lower() for n in LONGITUDE):
+            semantic_types_dict[types.LONGITUDE] = None
+
+    return structural_type, semantic_types_dict, column_meta
 
 
 def identify_types(array, name, geo_data, manual=None):
     """Identify the structural type and semantic types of an array.
 
-    :param array: The list, series, or array to inspect
+    :param array: The list, series, or array to inspect, or an
+        `EncodedColumn`. A `TypedColumn` is identified from its dtype if
+        possible, see :func:`identify_types_typed`
     :param name: The name of this column. This is taken into account for some
         heuristics like latitude, longitude, year number.
     :param manual: Manual information provided by the user that will be
@@ -228,12 +378,22 @@ def identify_types(array, name, geo_data, manual=None):
         meaning) to parsed values for further processing, and `column_meta`
         contains additional information about the column (not related to type).
     """
+    if isinstance(array, TypedColumn) and not manual:
+        result = identify_types_typed(array, name)
+        if result is not None:
+            return result
+    if not isinstance(array, EncodedColumn):
+        array = EncodedColumn.from_array(array)
+    # Work on distinct values, weighting the results by their count
+    values = array.values
+    counts = array.counts.tolist()
+
     num_total = len(array)
     column_meta = {}
 
     # This function let you check/count how many instances match a structure of particular data type
     with tracer.start_as_current_span('profile/regular_exp_count'):
-        re_count = regular_exp_count(array)
+        re_count = regular_exp_count(values, counts)
 
     # Identify structural type and compute unclean values ratio
     threshold = max(1, (1.0 - MAX_UNCLEAN) * (num_total - re_count['empty']))
@@ -264,7 +424,11 @@ def identify_types(array, name, geo_data, manual=None):
     if structural_type != types.MISSING_DATA and re_count['empty'] > 0:
         column_meta['missing_values_ratio'] = re_count['empty'] / num_total
 
-    distinct_values = set(e for e in array if e)
+    # Values are already distinct, only build a set of them if it's needed
+    num_distinct = sum(1 for e in values if e)
+
+    def distinct_values():
+        return set(e for e in values if e)
 
     semantic_types_dict = {}
     if manual:
@@ -279,18 +443,23 @@ def identify_types(array, name, geo_data, manual=None):
                 dates = parse_dates(array)
                 semantic_types_dict[types.DATE_TIME] = dates
             if el == types.ADMIN:
-                if geo_data is not None and len(distinct_values) >= 3:
-                    admin_areas = geo_data.resolve_names_all(array)
+                if geo_data is not None and num_distinct >= 3:
+                    admin_areas = geo_data.resolve_names_all(
+                        distinct_values(),
+                    )
                     admin_areas = [r for r in admin_areas if r]
                     if admin_areas:
-                        admin_areas = disambiguate_admin_areas(admin_areas)
+                        admin_areas = disambiguate_admin_areas(
+                            admin_areas, geo_data,
+                        )
                         if admin_areas is not None:
                             semantic_types_dict[types.ADMIN] = admin_areas
             if el == types.CATEGORICAL or el == types.INTEGER:
                 # Count distinct values
-                column_meta['num_distinct_values'] = len(distinct_values)
+                column_meta['num_distinct_values'] = num_distinct
                 if el == types.CATEGORICAL:
-                    semantic_types_dict[types.CATEGORICAL] = distinct_values
+                    semantic_types_dict[types.CATEGORICAL] = \
+                        distinct_values()
     else:
         num_bool = re_count['bool']
         num_text = re_count['text']
@@ -316,13 +485,17 @@ def identify_types(array, name, geo_data, manual=None):
                 semantic_types_dict[types.FILE_PATH] = None
 
             # Administrative areas
-            if geo_data is not None and len(distinct_values) >= 3:
+            if geo_data is not None and num_distinct >= 3:
                 with tracer.start_as_current_span('profile/admin_areas'):
-                    admin_areas = geo_data.resolve_names_all(distinct_values)
+                    admin_areas = geo_data.resolve_names_all(
+                        distinct_values(),
+                    )
                     admin_areas = [r for r in admin_areas if r]
-                    if len(admin_areas) > 0.7 * len(distinct_values):
+                    if len(admin_areas) > 0.7 * num_distinct:
 
-                        admin_areas = disambiguate_admin_areas(admin_areas)
+                        admin_areas = disambiguate_admin_areas(
+                            admin_areas, geo_data,
+                        )
                         if admin_areas is not None:
                             semantic_types_dict[types.ADMIN] = admin_areas
                             categorical = True
@@ -337,14 +510,15 @@ def identify_types(array, name, geo_data, manual=None):
                 semantic_types_dict[types.TEXT] = None
             else:
                 # Count distinct values
-                column_meta['num_distinct_values'] = len(distinct_values)
-                max_categorical = MAX_CATEGORICAL_RATIO * (len(array) - num_empty)
+                column_meta['num_distinct_values'] = num_distinct
+                max_categorical = MAX_CATEGORICAL_RATIO * (num_total - num_empty)
                 if (
                     categorical or
-                    len(distinct_values) <= max_categorical or
+                    num_distinct <= max_categorical or
                     types.BOOLEAN in semantic_types_dict
                 ):
-                    semantic_types_dict[types.CATEGORICAL] = distinct_values
+                    semantic_types_dict[types.CATEGORICAL] = \
+                        distinct_values()
         elif structural_type == types.INTEGER:
             # Identify ids
             # TODO: is this enough?
@@ -358,14 +532,14 @@ def identify_types(array, name, geo_data, manual=None):
                 semantic_types_dict[types.ID] = None
 
             # Count distinct values
-            column_meta['num_distinct_values'] = len(distinct_values)
+            column_meta['num_distinct_values'] = num_distinct
 
         #identify dates/ time
         dates = []
         if structural_type == types.INTEGER or structural_type == types.TEXT:
             # Identify years
             if 'year' in name.strip().lower():
-                for year in array:
+                for year in array.rows():
                     try:
                         # Handle a column that contains both year and month in the form -  "YYYY-MM" or "YYYYMM"
                         if (structural_type == types.INTEGER):
@@ -391,9 +565,10 @@ def identify_types(array, name, geo_data, manual=None):
             if 'month' in name.strip().lower():
                 #If the column has both year and month, dates must have been already declared
                 if len(dates) != 0:
+                    rows = array.rows()
                     for index, date in enumerate(dates):
                         try:
-                            dates[index] = replace_month(extract_month(date), array[index])
+                            dates[index] = replace_month(extract_month(date), rows[index])
                         except ValueError:
                             print("Error parsing dates for column ", name, " due to value error in month parsing" )
                             pass
@@ -402,7 +577,7 @@ def identify_types(array, name, geo_data, manual=None):
                             semantic_types_dict[types.DATE] = 'Year_Month'
                             semantic_types_dict['Data'] = dates
                 else:
-                    for month in array:
+                    for month in array.rows():
                         try:
                             dates.append(replace_month(None, month))
                         except ValueError:
@@ -415,7 +590,7 @@ def identify_types(array, name, geo_data, manual=None):
 
             #Identify day
             if 'day' in name.strip().lower():
-                for day in array:
+                for day in array.rows():
                     try:
                         dates.append(datetime(
                                 1, 1, int(day),
@@ -431,7 +606,7 @@ def identify_types(array, name, geo_data, manual=None):
             times = []
             #Identify hour
             if 'hour' in name.strip().lower():
-                for hour in array:
+                for hour in array.rows():
                     try:
                         times.append(datetime(
                                 1, 1, 1, int(hour), 0, 0,
@@ -446,7 +621,7 @@ def identify_types(array, name, geo_data, manual=None):
 
             #Identify minutes
             if 'minute' in name.strip().lower():
-                for minute in array:
+                for minute in array.rows():
                     try:
                         times.append(datetime(
                                 1, 1, 1, 0, int(minute), 0,
@@ -461,7 +636,7 @@ def identify_types(array, name, geo_data, manual=None):
 
             #Identify seconds
             if 'second' in name.strip().lower():
-                for second in array:
+                for second in array.rows():
                     try:
                         times.append(datetime(
                                 1, 1, 1, 0, 0, int(second),
@@ -479,16 +654,16 @@ def identify_types(array, name, geo_data, manual=None):
         if structural_type == types.FLOAT:
             with tracer.start_as_current_span('profile/parse_latlong'):
                 num_lat = num_long = 0
-                for elem in array:
+                for elem, count in zip(values, counts):
                     try:
                         elem = float(elem)
                     except ValueError:
                         pass
                     else:
-                        if -180.0 <= float(elem) <= 180.0:
-                            num_long += 1
-                            if -90.0 <= float(elem) <= 90.0:
-                                num_lat += 1
+                        if -180.0 <= elem <= 180.0:
+                            num_long += count
+                            if -90.0 <= elem <= 90.0:
+                                num_lat += count
 
                 if num_lat >= threshold and any(n in name.lower() for n in LATITUDE):
                     semantic_types_dict[types.LATITUDE] = None
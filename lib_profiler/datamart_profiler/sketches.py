@@ -0,0 +1,272 @@
+import base64
+import itertools
+import math
+import numpy
+import pandas
+
+
+HLL_PRECISION = 14
+"""Number of bits of the hash that select a HyperLogLog register
+
+The sketch uses ``2 ** HLL_PRECISION`` bytes, and its standard error is about
+``1.04 / sqrt(2 ** HLL_PRECISION)``, 0.8%.
+"""
+
+TOPK_CAPACITY = 1000
+"""Number of items tracked by a `TopK` summary"""
+
+KLL_K = 200
+"""Size of the top level of a `KLLSketch`, the rank error is about 1.7%"""
+
+
+def hash_values_64(values):
+    """Hash values to 64-bit integers, using pandas' vectorized hashing.
+
+    The hashes are the same across processes, so sketches can be merged.
+    """
+    return pandas.util.hash_array(
+        numpy.asarray(values, dtype=object),
+        categorize=False,
+    )
+
+
+class HyperLogLog(object):
+    """Estimate the number of distinct values, with bounded memory.
+
+    Sketches built from different parts of the data can be merged, giving the
+    sketch of the whole.
+    """
+    def __init__(self, precision=HLL_PRECISION, registers=None):
+        self.precision = precision
+        if registers is None:
+            registers = numpy.zeros(1 << precision, dtype=numpy.uint8)
+        self.registers = registers
+
+    def update(self, values):
+        """Add values, which need not be distinct.
+        """
+        self.update_hashes(hash_values_64(values))
+
+    def update_hashes(self, hashes):
+        """Add values from their 64-bit hashes.
+        """
+        hashes = numpy.asarray(hashes, dtype=numpy.uint64)
+        index = (hashes >> numpy.uint64(64 - self.precision)).astype(
+            numpy.intp,
+        )
+        # The rank is the position of the first 1 bit in the rest of the
+        # hash. Only its top 53 bits are used, which are exact in a float
+        rest = (hashes << numpy.uint64(self.precision)) >> numpy.uint64(11)
+        _, exponent = numpy.frexp(rest.astype(numpy.float64))
+        rank = pandas.Series((54 - exponent).astype(numpy.uint8))
+        rank = rank.groupby(index).max()
+        self.registers[rank.index] = numpy.maximum(
+            self.registers[rank.index],
+            rank.values,
+        )
+
+    def merge(self, other):
+        """Add all the values of another sketch to this one.
+        """
+        if other.precision != self.precision:
+            raise ValueError("Can't merge sketches with different precision")
+        numpy.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self):
+        """Estimate the number of distinct values.
+        """
+        m = len(self.registers)
+        alpha = 0.7213 / (1.0 + 1.079 / m)
+        estimate = alpha * m * m / numpy.sum(
+            numpy.ldexp(1.0, -self.registers.astype(numpy.int64)),
+        )
+        zeros = int(numpy.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros > 0:
+            # Small range correction, use linear counting
+            estimate = m * numpy.log(m / zeros)
+        return int(round(estimate))
+
+    def to_dict(self):
+        """Get the sketch as a JSON-serializable dict.
+        """
+        return {
+            'precision': self.precision,
+            'registers': base64.b64encode(
+                self.registers.tobytes(),
+            ).decode('ascii'),
+        }
+
+    @classmethod
+    def from_dict(cls, obj):
+        registers = numpy.frombuffer(
+            base64.b64decode(obj['registers']),
+            dtype=numpy.uint8,
+        ).copy()
+        return cls(obj['precision'], registers)
+
+
+class TopK(object):
+    """Count the most frequent items, with bounded memory.
+
+    At most `capacity` items are tracked. When there are twice as many, the
+    least frequent are dropped, and `error` is increased by the highest
+    count dropped. The counts are underestimates, the true count of an item
+    is at most its count plus `error`. Summaries can be merged.
+    """
+    def __init__(self, capacity=TOPK_CAPACITY):
+        self.capacity = capacity
+        self.counts = {}
+        self.error = 0
+
+    def update(self, items, counts=None):
+        """Count items, optionally with the number of times each appears.
+        """
+        if counts is None:
+            counts = itertools.repeat(1)
+        item_counts = self.counts
+        for item, count in zip(items, counts):
+            item_counts[item] = item_counts.get(item, 0) + count
+            if len(item_counts) >= 2 * self.capacity:
+                self._prune()
+                item_counts = self.counts
+
+    def merge(self, other):
+        """Add the counts from another summary to this one.
+        """
+        self.update(other.counts.keys(), other.counts.values())
+        self.error += other.error
+
+    def _prune(self):
+        items = sorted(
+            self.counts.items(),
+            key=lambda e: e[1],
+            reverse=True,
+        )
+        if len(items) > self.capacity:
+            self.error += items[self.capacity][1]
+            self.counts = dict(items[:self.capacity])
+
+    def most_common(self, n):
+        """Get the `n` most frequent items, as ``(item, count)`` pairs.
+
+        Items with the same count are in the order they were first seen.
+        """
+        return sorted(
+            self.counts.items(),
+            key=lambda e: e[1],
+            reverse=True,
+        )[:n]
+
+    def to_dict(self):
+        """Get the summary as a JSON-serializable dict.
+        """
+        return {
+            'capacity': self.capacity,
+            'counts': [list(e) for e in self.counts.items()],
+            'error': self.error,
+        }
+
+    @classmethod
+    def from_dict(cls, obj):
+        top = cls(obj['capacity'])
+        top.counts = {item: count for item, count in obj['counts']}
+        top.error = obj['error']
+        return top
+
+
+class KLLSketch(object):
+    """Approximate distribution of a stream of numbers (KLL sketch).
+
+    Items are kept in levels, where an item at level ``i`` stands for
+    ``2 ** i`` values. When a level is full, it is sorted and every other
+    item is promoted to the next level. Lower levels get smaller, so the
+    total size stays around ``3 * k``. Sketches can be merged.
+    """
+    def __init__(self, k=KLL_K, seed=0):
+        self.k = k
+        self.count = 0
+        self.levels = [numpy.empty(0, dtype=numpy.float64)]
+        self._rand = numpy.random.RandomState(seed)
+
+    def _capacity(self, level):
+        depth = len(self.levels) - 1 - level
+        return max(2, int(math.ceil(self.k * (2.0 / 3.0) ** depth)))
+
+    def update(self, values):
+        """Add values, NaNs are ignored.
+        """
+        values = numpy.asarray(values, dtype=numpy.float64)
+        values = values[~numpy.isnan(values)]
+        self.count += len(values)
+        self.levels[0] = numpy.concatenate([self.levels[0], values])
+        self._compress()
+
+    def merge(self, other):
+        """Add all the values of another sketch to this one.
+        """
+        while len(self.levels) < len(other.levels):
+            self.levels.append(numpy.empty(0, dtype=numpy.float64))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = numpy.concatenate([self.levels[level], items])
+        self.count += other.count
+        self._compress()
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) <= self._capacity(level):
+                level += 1
+                continue
+            if level + 1 == len(self.levels):
+                self.levels.append(numpy.empty(0, dtype=numpy.float64))
+            items = numpy.sort(items)
+            # With an odd number of items, the largest stays at this level
+            even = len(items) - len(items) % 2
+            offset = self._rand.randint(2)
+            self.levels[level] = items[even:]
+            self.levels[level + 1] = numpy.concatenate(
+                [self.levels[level + 1], items[offset:even:2]],
+            )
+            # Capacities depend on the number of levels, start over
+            level = 0
+
+    def weighted_items(self):
+        """Get the items, sorted, and the number of values each stands for.
+        """
+        items = numpy.concatenate(self.levels)
+        weights = numpy.concatenate([
+            numpy.full(len(level_items), 1 << level, dtype=numpy.int64)
+            for level, level_items in enumerate(self.levels)
+        ])
+        order = numpy.argsort(items, kind='stable')
+        return items[order], weights[order]
+
+    def quantile(self, q):
+        """Estimate the value at quantile `q` (between 0 and 1).
+        """
+        items, weights = self.weighted_items()
+        if not len(items):
+            raise ValueError("Empty sketch")
+        cumulative = numpy.cumsum(weights)
+        idx = numpy.searchsorted(cumulative, q * cumulative[-1], 'left')
+        return float(items[min(idx, len(items) - 1)])
+
+    def to_dict(self):
+        """Get the sketch as a JSON-serializable dict.
+        """
+        return {
+            'k': self.k,
+            'count': self.count,
+            'levels': [items.tolist() for items in self.levels],
+        }
+
+    @classmethod
+    def from_dict(cls, obj):
+        sketch = cls(obj['k'])
+        sketch.count = obj['count']
+        sketch.levels = [
+            numpy.array(items, dtype=numpy.float64)
+            for items in obj['levels']
+        ]
+        return sketch
@@ -1,8 +1,10 @@
 import collections
+import concurrent.futures
 from dataclasses import dataclass
+import functools
+import itertools
 import json
 import logging
-import math
 import numpy
 import numpy.random
 import prometheus_client
@@ -11,6 +13,8 @@ import requests
 from sklearn.cluster import KMeans
 from sklearn.exceptions import ConvergenceWarning
 from sklearn.neighbors._kd_tree import KDTree
+import sqlite3
+import threading
 import time
 import typing
 from urllib.parse import urlencode
@@ -27,16 +31,27 @@ MIN_RANGE_SIZE = 0.10  # 10%
 SPATIAL_RANGE_DELTA_LONG = 0.0001
 SPATIAL_RANGE_DELTA_LAT = 0.0001
 
+SPATIAL_RANGES_FIT_SIZE = 20000
+"""Above this number of points, spatial ranges are fitted on a sample"""
+
 MAX_ADDRESS_LENGTH = 90  # 90 characters
 MAX_NOMINATIM_REQUESTS = 200
 NOMINATIM_BATCH_SIZE = 20
 NOMINATIM_MIN_SPLIT_BATCH_SIZE = 2  # Batches >=this are divided on failure
+NOMINATIM_MAX_IN_FLIGHT = 4
+"""Maximum number of batches sent to Nominatim at the same time"""
+NOMINATIM_CACHE_SIZE = 100000
+"""Maximum number of addresses kept in the Nominatim cache"""
+NOMINATIM_CACHE_TTL = 30 * 24 * 3600  # 30 days
 
 LATITUDE = ('latitude', 'lat', 'ycoord', 'y_coord')
 LONGITUDE = ('longitude', 'long', 'lon', 'lng', 'xcoord', 'x_coord')
 
 MAX_WRONG_LEVEL_ADMIN = 0.10  # 10%
 
+GEO_CACHE_SIZE = 100000
+"""Maximum number of names and of areas kept by CachedGeoData"""
+
 
 PROM_NOMINATIM_REQS = prometheus_client.Counter(
     'profile_nominatim_reqs', "Queries to Nominatim",
@@ -44,43 +59,72 @@ PROM_NOMINATIM_REQS = prometheus_client.Counter(
 PROM_NOMINATIM_REQ_TIME = prometheus_client.Histogram(
     'profile_nominatim_req_seconds', "Time for Nominatim to answer a query",
 )
+PROM_NOMINATIM_CACHE_HITS = prometheus_client.Counter(
+    'profile_nominatim_cache_hits', "Addresses found in the Nominatim cache",
+)
+PROM_NOMINATIM_CACHE_MISSES = prometheus_client.Counter(
+    'profile_nominatim_cache_misses',
+    "Addresses not found in the Nominatim cache",
+)
+PROM_GEO_CACHE_HITS = prometheus_client.Counter(
+    'profile_geo_cache_hits',
+    "Admin area lookups found in the cache, per type of lookup",
+    ['lookup'],
+)
+PROM_GEO_CACHE_MISSES = prometheus_client.Counter(
+    'profile_geo_cache_misses',
+    "Admin area lookups not found in the cache, per type of lookup",
+    ['lookup'],
+)
+PROM_GEO_CACHE_HITS.labels('names').inc(0)
+PROM_GEO_CACHE_MISSES.labels('names').inc(0)
+PROM_GEO_CACHE_HITS.labels('parents').inc(0)
+PROM_GEO_CACHE_MISSES.labels('parents').inc(0)
 
 
 def get_spatial_ranges(values):
     """Build a small number (3) of bounding boxes from lat/long points.
 
     This performs K-Means clustering, returning a maximum of 3 clusters as
-    bounding boxes.
+    bounding boxes. For large sets of points, the clusters are computed from a
+    random sample of `SPATIAL_RANGES_FIT_SIZE` points, then every point is
+    assigned to the closest one.
     """
 
+    values = numpy.asarray(values, dtype=numpy.float64).reshape(-1, 2)
     clustering = KMeans(n_clusters=min(N_RANGES, len(values)),
                         random_state=0)
     with ignore_warnings(ConvergenceWarning):
-        clustering.fit(values)
+        if len(values) > SPATIAL_RANGES_FIT_SIZE:
+            rand = numpy.random.RandomState(0)
+            sample = rand.choice(
+                len(values), SPATIAL_RANGES_FIT_SIZE, replace=False,
+            )
+            clustering.fit(values[sample])
+            labels = clustering.predict(values)
+        else:
+            clustering.fit(values)
+            labels = clustering.labels_
     logger.info("K-Means clusters: %r", list(clustering.cluster_centers_))
 
     # Compute confidence intervals for each range
     ranges = []
     sizes = []
     for rg in range(N_RANGES):
-        cluster = [values[i]
-                   for i in range(len(values))
-                   if clustering.labels_[i] == rg]
-        if not cluster:
+        cluster = values[labels == rg]
+        if not len(cluster):
             continue
 
         # Eliminate clusters of outliers
         if len(cluster) < MIN_RANGE_SIZE * len(values):
             continue
 
-        cluster.sort(key=lambda p: p[0])
+        # Select the 5% and 95% points on each axis
         min_idx = int(0.05 * len(cluster))
         max_idx = int(0.95 * len(cluster))
-        min_lat = cluster[min_idx][0]
-        max_lat = cluster[max_idx][0]
-        cluster.sort(key=lambda p: p[1])
-        min_long = cluster[min_idx][1]
-        max_long = cluster[max_idx][1]
+        cluster = numpy.partition(cluster, [min_idx, max_idx], axis=0)
+        min_lat, min_long = cluster[min_idx].tolist()
+        max_lat, max_long = cluster[max_idx].tolist()
         ranges.append([
             [min_long, max_lat],
             [max_long, min_lat],
@@ -253,84 +297,355 @@ def nominatim_query(url, *, q):
         return res.json()
 
 
-def _nominatim_batch(url, batch, locations, cache):
+class NominatimCache(object):
+    """In-memory cache of Nominatim results.
+
+    Entries expire after `ttl` seconds, and the least recently used are
+    evicted when there are more than `max_size`. Addresses that Nominatim
+    couldn't find are cached as None.
+    """
+    def __init__(self, *, max_size=NOMINATIM_CACHE_SIZE,
+                 ttl=NOMINATIM_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get_many(self, url, addresses):
+        """Look up addresses.
+
+        :returns: A dict with the addresses that are in the cache, mapped to
+            a ``(lat, long)`` pair or None
+        """
+        now = time.time()
+        results = {}
+        with self._lock:
+            for address in addresses:
+                key = url, address
+                try:
+                    expires, location = self._entries[key]
+                except KeyError:
+                    continue
+                if expires < now:
+                    del self._entries[key]
+                    continue
+                self._entries.move_to_end(key)
+                results[address] = location
+        return results
+
+    def set_many(self, url, results):
+        """Store results, a dict mapping addresses to locations or None.
+        """
+        expires = time.time() + self.ttl
+        with self._lock:
+            for address, location in results.items():
+                key = url, address
+                self._entries[key] = expires, location
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class SqliteNominatimCache(NominatimCache):
+    """Cache of Nominatim results in a SQLite database.
+
+    The database persists across runs and can be shared by multiple
+    processes. When there are more than `max_size` entries, the oldest are
+    evicted.
+    """
+    def __init__(self, path, *, max_size=NOMINATIM_CACHE_SIZE,
+                 ttl=NOMINATIM_CACHE_TTL):
+        super(SqliteNominatimCache, self).__init__(
+            max_size=max_size, ttl=ttl,
+        )
+        self._conn = sqlite3.connect(
+            path,
+            timeout=30.0,
+            check_same_thread=False,
+        )
+        with self._lock, self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS nominatim('
+                + 'url TEXT NOT NULL, '
+                + 'address TEXT NOT NULL, '
+                + 'latitude REAL NULL, '
+                + 'longitude REAL NULL, '
+                + 'expires REAL NOT NULL, '
+                + 'PRIMARY KEY(url, address)'
+                + ');'
+            )
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS nominatim_expires '
+                + 'ON nominatim(expires);'
+            )
+
+    def get_many(self, url, addresses):
+        addresses = list(addresses)
+        now = time.time()
+        results = {}
+        with self._lock:
+            # Limit the number of parameters in each query
+            for i in range(0, len(addresses), 500):
+                chunk = addresses[i:i + 500]
+                rows = self._conn.execute(
+                    'SELECT address, latitude, longitude FROM nominatim '
+                    + 'WHERE url = ? AND expires >= ? '
+                    + 'AND address IN (%s);' % ', '.join('?' * len(chunk)),
+                    [url, now] + chunk,
+                )
+                for address, latitude, longitude in rows:
+                    if latitude is None:
+                        results[address] = None
+                    else:
+                        results[address] = latitude, longitude
+        return results
+
+    def set_many(self, url, results):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO nominatim('
+                + 'url, address, latitude, longitude, expires'
+                + ') VALUES(?, ?, ?, ?, ?);',
+                [
+                    (
+                        url, address,
+                        location[0] if location else None,
+                        location[1] if location else None,
+                        now + self.ttl,
+                    )
+                    for address, location in results.items()
+                ],
+            )
+            # Evict expired entries, then the oldest ones over max_size
+            self._conn.execute(
+                'DELETE FROM nominatim WHERE expires < ?;',
+                [now],
+            )
+            self._conn.execute(
+                'DELETE FROM nominatim WHERE rowid IN ('
+                + 'SELECT rowid FROM nominatim '
+                + 'ORDER BY expires DESC '
+                + 'LIMIT -1 OFFSET ?'
+                + ');',
+                [self.max_size],
+            )
+
+
+nominatim_cache = NominatimCache()
+"""Cache used by :func:`nominatim_resolve_all`, shared by the whole process"""
+
+
+def _nominatim_batch(url, batch):
+    """Resolve a list of addresses, splitting it if Nominatim fails.
+
+    :returns: A dict mapping each address to a ``(lat, long)`` pair or None
+    """
     try:
-        locs = nominatim_query(url, q=list(batch.keys()))
+        locs = nominatim_query(url, q=batch)
     except requests.HTTPError as e:
         if (
             e.response.status_code in (500, 414)
             and len(batch) >= max(2, NOMINATIM_MIN_SPLIT_BATCH_SIZE)
         ):
             # Try smaller batch size
-            batch_list = list(batch.items())
             mid = len(batch) // 2
-            return (
-                _nominatim_batch(url, dict(batch_list[:mid]), locations, cache)
-                +
-                _nominatim_batch(url, dict(batch_list[mid:]), locations, cache)
-            )
+            results = _nominatim_batch(url, batch[:mid])
+            results.update(_nominatim_batch(url, batch[mid:]))
+            return results
         raise e from None
 
-    not_found = 0
-    for location, (value, count) in zip(locs, batch.items()):
+    results = {}
+    for location, value in zip(locs, batch):
         if location:
-            loc = (
+            results[value] = (
                 float(location[0]['lat']),
                 float(location[0]['lon']),
             )
-            cache[value] = loc
-            locations.extend([loc] * count)
         else:
-            cache[value] = None
-            not_found += count
-    batch.clear()
-    return not_found
+            results[value] = None
+    return results
 
 
-def nominatim_resolve_all(url, array, max_requests=MAX_NOMINATIM_REQUESTS):
-    cache = {}
-    locations = []
-    not_found = 0  # Unique locations not found
-    non_empty = 0
+def nominatim_resolve_all(url, array, max_requests=MAX_NOMINATIM_REQUESTS,
+                          counts=None, cache=None):
+    """Resolve addresses into coordinates using Nominatim.
+
+    Addresses are looked up in the cache first. The others are sent to
+    Nominatim in batches, with up to `NOMINATIM_MAX_IN_FLIGHT` batches at a
+    time. Once `max_requests` addresses need to be sent, the remaining values
+    are ignored.
+
+    :param counts: The number of times each element of `array` appears, if it
+        only has distinct values
+    :param cache: The :class:`NominatimCache` to use, defaults to
+        `nominatim_cache`
+    :returns: A tuple ``(locations, non_empty)`` where `locations` is a list
+        of ``(lat, long)`` pairs and `non_empty` the number of non-empty values
+    """
+    if cache is None:
+        cache = nominatim_cache
     start = time.perf_counter()
-    processed = 0
-    batch = {}
 
-    for processed, value in enumerate(array):
+    if counts is None:
+        counts = itertools.repeat(1)
+
+    values = []
+    for value, count in zip(array, counts):
         value = value.strip()
-        if not value:
-            continue
-        non_empty += 1
+        if value:
+            values.append((value, count))
+
+    # Look up the cache
+    resolved = cache.get_many(
+        url,
+        dict.fromkeys(
+            value for value, _ in values
+            if len(value) <= MAX_ADDRESS_LENGTH
+        ),
+    )
+
+    # Count the addresses, until we have enough to send to Nominatim
+    addresses = {}
+    missing = []
+    non_empty = 0
+    for value, count in values:
+        non_empty += count
 
         if len(value) > MAX_ADDRESS_LENGTH:
             continue
-        elif value in cache:
-            if cache[value] is not None:
-                locations.append(cache[value])
-        elif value in batch:
-            batch[value] += 1
+        elif value in addresses:
+            addresses[value] += count
         else:
-            batch[value] = 1
-            if len(batch) == NOMINATIM_BATCH_SIZE:
-                not_found += _nominatim_batch(url, batch, locations, cache)
-                if len(cache) >= max_requests:
+            addresses[value] = count
+            if value not in resolved:
+                missing.append(value)
+                if (
+                    len(missing) % NOMINATIM_BATCH_SIZE == 0
+                    and len(missing) >= max_requests
+                ):
                     break
+    PROM_NOMINATIM_CACHE_HITS.inc(len(addresses) - len(missing))
+    PROM_NOMINATIM_CACHE_MISSES.inc(len(missing))
 
-    if batch and len(cache) < max_requests:
-        not_found += _nominatim_batch(url, batch, locations, cache)
+    # Query the rest, multiple batches at a time
+    batches = [
+        missing[i:i + NOMINATIM_BATCH_SIZE]
+        for i in range(0, len(missing), NOMINATIM_BATCH_SIZE)
+    ]
+    if batches:
+        with concurrent.futures.ThreadPoolExecutor(
+            min(NOMINATIM_MAX_IN_FLIGHT, len(batches)),
+        ) as executor:
+            for results in executor.map(
+                functools.partial(_nominatim_batch, url),
+                batches,
+            ):
+                cache.set_many(url, results)
+                resolved.update(results)
+
+    locations = []
+    not_found = 0  # Unique locations not found
+    for value, count in addresses.items():
+        location = resolved[value]
+        if location is not None:
+            locations.extend([location] * count)
+        else:
+            not_found += 1
 
     logger.info(
-        "Performed %d Nominatim queries in %fs (%d hits). Found %d/%d",
-        len(cache),
+        "Performed %d Nominatim queries in %fs (%d cached, %d not found). "
+        + "Found %d/%d",
+        len(missing),
         time.perf_counter() - start,
-        len(cache) - not_found,
+        len(addresses) - len(missing),
+        not_found,
         len(locations),
-        processed,
+        non_empty,
     )
     return locations, non_empty
 
 
-def disambiguate_admin_areas(admin_areas):
+class CachedGeoData(object):
+    """Wrapper for a ``datamart_geo.GeoData`` that memoizes lookups.
+
+    The admin areas that names resolve to, and the chain of parents of each
+    area, are kept in LRU caches of up to `max_size` entries. Keep a single
+    instance around to reuse them across datasets. Other attributes are
+    forwarded to the wrapped object.
+    """
+    def __init__(self, geo_data, max_size=GEO_CACHE_SIZE):
+        self.geo_data = geo_data
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._names = collections.OrderedDict()
+        self._parents = collections.OrderedDict()
+
+    def __getattr__(self, name):
+        if name == 'geo_data':
+            raise AttributeError(name)
+        return getattr(self.geo_data, name)
+
+    def _lookup(self, cache, label, key, compute):
+        with self._lock:
+            try:
+                value = cache[key]
+            except KeyError:
+                pass
+            else:
+                cache.move_to_end(key)
+                PROM_GEO_CACHE_HITS.labels(label).inc()
+                return value
+        PROM_GEO_CACHE_MISSES.labels(label).inc()
+
+        value = compute()
+        with self._lock:
+            cache[key] = value
+            while len(cache) > self.max_size:
+                cache.popitem(last=False)
+        return value
+
+    def resolve_name_all(self, name):
+        return list(self._lookup(
+            self._names, 'names', name,
+            lambda: tuple(self.geo_data.resolve_name_all(name)),
+        ))
+
+    def resolve_name(self, name):
+        for area in self.resolve_name_all(name):
+            return area
+        return None
+
+    def resolve_names_all(self, names):
+        return [self.resolve_name_all(name) for name in names]
+
+    def resolve_names(self, names):
+        return [self.resolve_name(name) for name in names]
+
+    def get_parent_areas(self, area):
+        """Get the parents of an area, from the closest to the country.
+        """
+        def compute():
+            parent = area.get_parent_area()
+            if parent is None:
+                return ()
+            return (parent,) + self.get_parent_areas(parent)
+
+        return self._lookup(self._parents, 'parents', area.id, compute)
+
+
+def get_parent_areas(area):
+    """Get the parents of an area, from the closest to the country.
+    """
+    parents = []
+    area = area.get_parent_area()
+    while area:
+        parents.append(area)
+        area = area.get_parent_area()
+    return tuple(parents)
+
+
+def disambiguate_admin_areas(admin_areas, geo_data=None):
     """This takes admin areas resolved from names and tries to disambiguate.
 
     Each name in the input will have been resolved to multiple possible areas,
@@ -341,7 +656,15 @@ def disambiguate_admin_areas(admin_areas):
     or all states, but not a mix of counties and states), and if possible all
     in the same parent area (for example, states of the same country, or
     counties in states of the same country).
+
+    :param geo_data: If this is a :class:`CachedGeoData`, parent areas are
+        looked up from its cache
     """
+    if isinstance(geo_data, CachedGeoData):
+        parent_areas = geo_data.get_parent_areas
+    else:
+        parent_areas = get_parent_areas
+
     # Count possible options
     options = collections.Counter()
     for candidates in admin_areas:
@@ -349,10 +672,8 @@ def disambiguate_admin_areas(admin_areas):
         options_for_entry = set()
         for area in candidates:
             level = area.type.value
-            area = area.get_parent_area()
-            while area:
-                options_for_entry.add((level, area))
-                area = area.get_parent_area()
+            for parent in parent_areas(area):
+                options_for_entry.add((level, parent))
             options_for_entry.add((level, None))
         options.update(options_for_entry)
 
@@ -475,6 +796,97 @@ def hash_location(point, base=32, precision=16):
     return bits_to_chars(bits, base_bits)
 
 
+def _cell_index(values, low, high, n_bits):
+    """Find which cell each value falls in, splitting [low, high] in 2**n_bits.
+
+    Values on the boundary between two cells go in the lower one, as with the
+    bisection in :func:`location_to_bits`.
+    """
+    n_cells = 2 ** n_bits
+    step = (high - low) / n_cells
+    index = numpy.ceil((values - low) / step) - 1
+    index[numpy.isnan(index)] = 0
+    index = numpy.clip(index, 0, n_cells - 1)
+
+    # Correct rounding errors by comparing with the boundaries, which are exact
+    index -= (index > 0) & (values <= low + index * step)
+    index += (index < n_cells - 1) & (values > low + (index + 1) * step)
+    return index.astype(numpy.int64)
+
+
+def _spread_bits(array):
+    """Insert a 0 bit before each bit of 32-bit integers.
+    """
+    array = array.astype(numpy.uint64)
+    for shift, mask in [
+        (16, 0x0000FFFF0000FFFF),
+        (8, 0x00FF00FF00FF00FF),
+        (4, 0x0F0F0F0F0F0F0F0F),
+        (2, 0x3333333333333333),
+        (1, 0x5555555555555555),
+    ]:
+        array = (array | (array << numpy.uint64(shift))) & numpy.uint64(mask)
+    return array
+
+
+def _interleave(long_index, lat_index, n_bits):
+    """Build codes from cell indexes, alternating bits starting with longitude.
+    """
+    if n_bits % 2:
+        return (
+            _spread_bits(long_index)
+            | (_spread_bits(lat_index) << numpy.uint64(1))
+        )
+    else:
+        return (
+            (_spread_bits(long_index) << numpy.uint64(1))
+            | _spread_bits(lat_index)
+        )
+
+
+def hash_locations(points, base=32, precision=16):
+    """Hash an array of coordinates into integer codes.
+
+    This is the vectorized version of :func:`hash_location`: the code for
+    each point is the integer made of the bits of its hash, which need to fit
+    in 64 bits.
+
+    :param points: Array of ``(latitude, longitude)`` points, shape (N, 2)
+    :returns: Array of N codes, of type uint64
+    """
+    base_bits = base.bit_length() - 1
+    if 2 ** base_bits != base:
+        raise ValueError("Base is not a power of 2")
+    precision_bits = base_bits * precision
+    if precision_bits > 64:
+        raise ValueError("Hashes are too long to be encoded in 64 bits")
+
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    n_long_bits = (precision_bits + 1) // 2
+    n_lat_bits = precision_bits // 2
+    long_index = _cell_index(points[:, 1], -180.0, 180.0, n_long_bits)
+    lat_index = _cell_index(points[:, 0], -90.0, 90.0, n_lat_bits)
+    return _interleave(long_index, lat_index, precision_bits)
+
+
+def codes_to_hashes(codes, base, precision):
+    """Turn integer codes from :func:`hash_locations` back into strings.
+    """
+    base_bits = base.bit_length() - 1
+    mask = numpy.uint64(base - 1)
+    digits = numpy.stack(
+        [
+            (codes >> numpy.uint64(base_bits * (precision - 1 - i))) & mask
+            for i in range(precision)
+        ],
+        axis=-1,
+    ).reshape(len(codes), precision)
+    return [
+        ''.join(GEOHASH_CHARS[d] for d in row)
+        for row in digits.tolist()
+    ]
+
+
 def decode_hash(hash, base=32):
     """Turn a hash back into a rectangle.
 
@@ -521,100 +933,255 @@ def bitrange(from_bits, to_bits):
     yield bits
 
 
+def _group_starts(sorted_array):
+    """Get the index where each run of equal values starts.
+    """
+    if not len(sorted_array):
+        return numpy.zeros(0, dtype=numpy.intp)
+    return numpy.flatnonzero(numpy.concatenate([
+        [True],
+        sorted_array[1:] != sorted_array[:-1],
+    ]))
+
+
 class Geohasher(object):
+    """Count points and boxes in the cells of a hierarchical grid.
+
+    For each level of the grid, the cells are kept as a sorted array of codes
+    (the hash as an integer, see :func:`hash_locations`), with the number of
+    points or boxes in each cell and the order in which the cells were first
+    seen. If a level has more than `number` cells, the precision is lowered.
+    """
     def __init__(self, *, number, base=4, precision=16):
         self.number = number
         self.base = base
         self.precision = precision
 
-        self.tree_root = [0, {}]
-        self.number_at_level = [0] * (precision)
+        self.base_bits = base.bit_length() - 1
+        if 2 ** self.base_bits != base:
+            raise ValueError("Base is not a power of 2")
+        if self.base_bits * precision > 64:
+            raise ValueError("Hashes are too long to be encoded in 64 bits")
+
+        self._total = 0
+        self._seen = 0  # Number of cells seen, to order new cells
+        # For each level: codes, counts, and order of first appearance
+        self._levels = [
+            (
+                numpy.zeros(0, dtype=numpy.uint64),
+                numpy.zeros(0, dtype=numpy.int64),
+                numpy.zeros(0, dtype=numpy.int64),
+            )
+            for _ in range(precision)
+        ]
+
+    def _add_cells(self, level, codes, counts, orders):
+        """Add counts to cells at a level.
+
+        If this makes the level have too many cells, the precision is lowered.
+
+        :returns: False if the level was dropped
+        """
+        old_codes, old_counts, old_orders = self._levels[level - 1]
+        codes = numpy.concatenate([old_codes, codes])
+        counts = numpy.concatenate([old_counts, counts])
+        orders = numpy.concatenate([old_orders, orders])
+
+        # Sort by code then order, to merge the counts of identical codes
+        sort = numpy.lexsort((orders, codes))
+        codes = codes[sort]
+        starts = _group_starts(codes)
+        if len(starts) > self.number:
+            # This level has too many cells, stop building it
+            self.precision = level - 1
+            del self._levels[level - 1:]
+            return False
+        if len(starts):
+            counts = numpy.add.reduceat(counts[sort], starts)
+        self._levels[level - 1] = (codes[starts], counts, orders[sort][starts])
+        return True
 
     def add_points(self, points):
-        for point in points:
-            geohash = hash_location(point, self.base, self.precision)
-            # Add this hash to the tree
-            node = self.tree_root
-            for level, key in enumerate(geohash):
-                node[0] += 1
-                try:
-                    node = node[1][key]
-                except KeyError:
-                    new_node = [0, {}]
-                    node[1][key] = new_node
-                    node = new_node
-                    self.number_at_level[level] += 1
+        codes = hash_locations(points, self.base, self.precision)
+        orders = self._seen + numpy.arange(len(codes))
+        self._total += len(codes)
+        self._seen += len(codes)
+
+        # Count each distinct hash, then add them up at each level
+        codes, first, counts = numpy.unique(
+            codes,
+            return_index=True, return_counts=True,
+        )
+        orders = orders[first]
+        precision = self.precision
+        for level in range(1, precision + 1):
+            shift = numpy.uint64(self.base_bits * (precision - level))
+            cells = codes >> shift
+            starts = _group_starts(cells)
+            if len(starts) and not self._add_cells(
+                level,
+                cells[starts],
+                numpy.add.reduceat(counts, starts),
+                numpy.minimum.reduceat(orders, starts),
+            ):
+                break
 
-                    # If this level has too many nodes, stop building it
-                    if self.number_at_level[level] > self.number:
-                        self.precision = level
-                        break
-            node[0] += 1
+    def merge(self, other):
+        """Add the points and boxes counted by another builder to this one.
+
+        Cells are only kept down to the precision of the coarsest of the two.
+        """
+        if (other.number, other.base) != (self.number, self.base):
+            raise ValueError("Can't merge builders with different parameters")
+        self._total += other._total
+        if other.precision < self.precision:
+            self.precision = other.precision
+            del self._levels[self.precision:]
+        for level in range(1, self.precision + 1):
+            codes, counts, orders = other._levels[level - 1]
+            if len(codes) and not self._add_cells(
+                level, codes, counts, orders + self._seen,
+            ):
+                break
+        self._seen += other._seen
+
+    def to_dict(self):
+        """Get the counts as a JSON-serializable dict.
+        """
+        return {
+            'number': self.number,
+            'base': self.base,
+            'precision': self.precision,
+            'total': self._total,
+            'seen': self._seen,
+            'levels': [
+                [codes.tolist(), counts.tolist(), orders.tolist()]
+                for codes, counts, orders in self._levels
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, obj):
+        builder = cls(number=obj['number'], base=obj['base'])
+        builder.precision = obj['precision']
+        builder._total = obj['total']
+        builder._seen = obj['seen']
+        builder._levels = [
+            (
+                numpy.array(codes, dtype=numpy.uint64),
+                numpy.array(counts, dtype=numpy.int64),
+                numpy.array(orders, dtype=numpy.int64),
+            )
+            for codes, counts, orders in obj['levels']
+        ]
+        return builder
 
     def add_aab(self, box):
-        base_bits = self.base.bit_length() - 1
+        self.add_aabs([box])
+
+    def add_aabs(self, boxes):
+        """Add axis-aligned boxes, counting them in every cell they overlap.
+
+        Boxes are ``(min_long, max_long, min_lat, max_lat)``. If the minimum
+        is greater than the maximum, the box wraps around (e.g. crosses the
+        antimeridian). Identical boxes are only covered once.
+        """
+        # Deduplicate the boxes, keeping the order they first appear in
+        unique_boxes = {}
+        for box in boxes:
+            box = tuple(box)
+            unique_boxes[box] = unique_boxes.get(box, 0) + 1
+            self._total += 1
+        if not unique_boxes or self.precision == 0:
+            return
+        weights = numpy.array(list(unique_boxes.values()), dtype=numpy.int64)
+        min_long, max_long, min_lat, max_lat = numpy.array(
+            list(unique_boxes), dtype=numpy.float64,
+        ).T
+
+        # Find the cells of the corners at full precision
+        precision_bits = self.base_bits * self.precision
+        axes = []
+        for n_bits, low, high, min_coord, max_coord in [
+            ((precision_bits + 1) // 2, -180.0, 180.0, min_long, max_long),
+            (precision_bits // 2, -90.0, 90.0, min_lat, max_lat),
+        ]:
+            axes.append((
+                n_bits,
+                _cell_index(min_coord, low, high, n_bits),
+                _cell_index(max_coord, low, high, n_bits),
+                min_coord > max_coord,
+            ))
 
-        min_long, max_long, min_lat, max_lat = box
-        min_bits = location_to_bits(
-            (min_lat, min_long), self.base, self.precision,
-        )
-        min_long_bits = min_bits[0::2]
-        min_lat_bits = min_bits[1::2]
-        max_bits = location_to_bits(
-            (max_lat, max_long), self.base, self.precision,
-        )
-        max_long_bits = max_bits[0::2]
-        max_lat_bits = max_bits[1::2]
-
-        self.tree_root[0] += 1
-        level = 1
-        while level <= self.precision:
-            n_long_bits = math.ceil(level * base_bits / 2)
-            n_lat_bits = math.floor(level * base_bits / 2)
-            for long_bits in bitrange(
-                    min_long_bits[:n_long_bits],
-                    max_long_bits[:n_long_bits],
+        for level in range(1, self.precision + 1):
+            level_bits = self.base_bits * level
+
+            # Compute the range of cells covered on each axis
+            ranges = []
+            for (n_bits, from_idx, to_idx, wraps), level_axis_bits in zip(
+                axes,
+                [(level_bits + 1) // 2, level_bits // 2],
             ):
-                for lat_bits in bitrange(
-                        min_lat_bits[:n_lat_bits],
-                        max_lat_bits[:n_lat_bits],
-                ):
-                    bits = [0] * (n_long_bits + n_lat_bits)
-                    bits[0::2] = long_bits
-                    bits[1::2] = lat_bits
-                    geohash = bits_to_chars(bits, base_bits)
-
-                    # Add this hash to the tree
-                    node = self.tree_root
-                    for lvl, key in enumerate(geohash):
-                        try:
-                            node = node[1][key]
-                        except KeyError:
-                            new_node = [0, {}]
-                            node[1][key] = new_node
-                            node = new_node
-                            self.number_at_level[lvl] += 1
-                    node[0] += 1
-
-                    if self.number_at_level[level - 1] > self.number:
-                        self.precision = level - 1
-                        break
-
-            level += 1
+                shift = n_bits - level_axis_bits
+                n_cells = 2 ** level_axis_bits
+                from_idx = from_idx >> shift
+                count = ((to_idx >> shift) - from_idx) % n_cells + 1
+                count[wraps & (count == 1)] = n_cells
+                ranges.append((from_idx, count, n_cells))
+            (long_from, long_count, n_long), (lat_from, lat_count, n_lat) = \
+                ranges
+
+            # If a single box overlaps too many cells, stop here
+            if (
+                (long_count > self.number).any()
+                or (lat_count > self.number).any()
+                or (long_count * lat_count > self.number).any()
+            ):
+                self.precision = level - 1
+                del self._levels[level - 1:]
+                break
 
-    def get_hashes(self):
-        # Reconstruct the hashes at this level
-        hashes = []
+            # List the cells of all boxes, in the order of the boxes
+            sizes = long_count * lat_count
+            box_idx = numpy.repeat(numpy.arange(len(sizes)), sizes)
+            position = (
+                numpy.arange(len(box_idx))
+                - (numpy.cumsum(sizes) - sizes)[box_idx]
+            )
+            long_idx = (
+                long_from[box_idx] + position // lat_count[box_idx]
+            ) % n_long
+            lat_idx = (
+                lat_from[box_idx] + position % lat_count[box_idx]
+            ) % n_lat
+
+            orders = self._seen + numpy.arange(len(box_idx))
+            self._seen += len(box_idx)
+            if not self._add_cells(
+                level,
+                _interleave(long_idx, lat_idx, level_bits),
+                weights[box_idx],
+                orders,
+            ):
+                break
 
-        def add_node(prefix, node, level):
-            if level == self.precision:
-                hashes.append((prefix, node[0]))
-                return
-            for k, n in node[1].items():
-                add_node(prefix + k, n, level + 1)
+    def get_hashes(self):
+        if self.precision == 0:
+            return [('', self._total)]
+        codes, counts, orders = self._levels[self.precision - 1]
+
+        # Order depth-first, by when each ancestor of the cell was first seen
+        keys = [orders]
+        for level in range(self.precision - 1, 0, -1):
+            level_codes, _, level_orders = self._levels[level - 1]
+            shift = numpy.uint64(self.base_bits * (self.precision - level))
+            keys.append(
+                level_orders[numpy.searchsorted(level_codes, codes >> shift)]
+            )
+        sort = numpy.lexsort(keys)
 
-        add_node('', self.tree_root, 0)
-        return hashes
+        hashes = codes_to_hashes(codes[sort], self.base, self.precision)
+        return list(zip(hashes, counts[sort].tolist()))
 
     def get_hashes_json(self):
         hashes = self.get_hashes()
@@ -628,7 +1195,7 @@ class Geohasher(object):
 
     @property
     def total(self):
-        return self.tree_root[0]
+        return self._total
 
 
 def median_smallest_distance(points, tree=None):
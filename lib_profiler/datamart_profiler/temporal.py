@@ -1,10 +1,11 @@
-import collections
-from collections import Counter
-from datetime import datetime
+import calendar
+from datetime import datetime, timedelta
 import dateutil.parser
 import dateutil.tz
 import logging
+import numpy
 import pandas
+import re
 
 from .warning_tools import raise_warnings
 
@@ -33,38 +34,112 @@ temporal_aggregation_keys = {
     'second': '%Y-%m-%d %H:%M:%S',
 }
 
+_NS_PER_SECOND = 10 ** 9
+_NS_PER_DAY = 86400 * _NS_PER_SECOND
 
-def get_temporal_resolution(values):
-    """Returns the resolution of the temporal attribute.
+_EPOCH = datetime(1970, 1, 1, tzinfo=dateutil.tz.UTC)
+
+
+def to_datetime_index(values):
+    """Convert datetimes to a ``DatetimeIndex`` in UTC.
+
+    This accepts lists of datetime objects as well as pandas and numpy arrays.
+    Values without a timezone are assumed to be UTC.
     """
+    if isinstance(values, pandas.DatetimeIndex) and str(values.tz) == 'UTC':
+        return values
+    if isinstance(values, (set, frozenset)):
+        values = list(values)
+    return pandas.DatetimeIndex(pandas.to_datetime(values, utc=True))
+
+
+_resolution_units = {
+    'week': 7 * _NS_PER_DAY,
+    'day': _NS_PER_DAY,
+    'hour': 3600 * _NS_PER_SECOND,
+    'minute': 60 * _NS_PER_SECOND,
+    'second': _NS_PER_SECOND,
+}
+"""Length of the bins of resolutions that don't depend on the calendar"""
+
+_resolution_lengths = dict(
+    {k: (v, v) for k, v in _resolution_units.items()},
+    year=(365 * _NS_PER_DAY, 366 * _NS_PER_DAY),
+    quarter=(90 * _NS_PER_DAY, 92 * _NS_PER_DAY),
+    month=(28 * _NS_PER_DAY, 31 * _NS_PER_DAY),
+)
+"""Minimum and maximum length of the bins of each resolution"""
+
 
-    if not isinstance(values, set):
-        values = set(values)
+def _resolution_bins(epochs, resolution):
+    """Get the bin of each epoch (in nanoseconds) at the given resolution.
+
+    The bins are numbered in chronological order.
+    """
+    if resolution in ('year', 'quarter', 'month'):
+        unit = 'Y' if resolution == 'year' else 'M'
+        bins = epochs.astype('M8[ns]').astype('M8[%s]' % unit)
+        bins = bins.astype(numpy.int64)
+        if resolution == 'quarter':
+            bins //= 3
+        return bins
+    elif resolution == 'week':
+        # 1970-01-01 was a Thursday, shift so weeks start on Mondays
+        return (epochs // _NS_PER_DAY + 3) // 7
+    else:
+        return epochs // _resolution_units[resolution]
+
+
+def get_temporal_resolution(values):
+    """Returns the resolution of the temporal attribute.
 
-    if len(values) == 1:
-        value, = values
-        if value.second:
+    This is the coarsest resolution at which aggregating the distinct values
+    doesn't merge more than a few of them. It is computed from the sorted
+    distinct values: gaps between consecutive values that are longer than a
+    bin can't fall in the same bin, and if all the gaps are multiples of the
+    bin length, all values are in distinct bins.
+    """
+    epochs = to_datetime_index(values).asi8
+    epochs = numpy.unique(epochs)
+    if len(epochs) and epochs[0] == numpy.iinfo(numpy.int64).min:
+        epochs = epochs[1:]  # NaT
+    if not len(epochs):
+        raise ValueError("No values")
+
+    if len(epochs) == 1:
+        seconds = int(epochs[0]) // _NS_PER_SECOND
+        if seconds % 60:
             return 'second'
-        elif value.minute:
+        elif seconds // 60 % 60:
             return 'minute'
-        elif value.hour:
+        elif seconds // 3600 % 24:
             return 'hour'
         else:
             return 'day'
 
+    deltas = numpy.diff(epochs)
+    step = int(numpy.gcd.reduce(deltas))
+    span = int(epochs[-1]) - int(epochs[0])
+
     # Python 3.7+ iterates on dict in insertion order
-    for resolution, key in temporal_aggregation_keys.items():
-        counts = collections.defaultdict(collections.Counter)
-        if isinstance(key, str):
-            for value in values:
-                bin = value.strftime(key)
-                counts[bin][value] += 1
-        else:
-            for value in values:
-                bin = key(value)
-                counts[bin][value] += 1
+    for resolution in temporal_aggregation_keys:
+        unit = _resolution_units.get(resolution)
+        if unit is not None and step % unit == 0:
+            return resolution
+        min_length, max_length = _resolution_lengths[resolution]
 
-        avg_per_bin = sum(len(v) for v in counts.values()) / len(counts)
+        # The values can't spread over more bins than fit in their span
+        if len(epochs) / (span // min_length + 2) >= 1.05:
+            continue
+
+        # Only consecutive values closer than a bin can share it, use that
+        # bound before looking at the calendar
+        merged = int(numpy.count_nonzero(deltas < max_length))
+        if len(epochs) / (len(epochs) - merged) >= 1.05:
+            bins = _resolution_bins(epochs, resolution)
+            merged = len(deltas) - int(numpy.count_nonzero(numpy.diff(bins)))
+
+        avg_per_bin = len(epochs) / (len(epochs) - merged)
         if avg_per_bin < 1.05:
             # 5 % error tolerated
             return resolution
@@ -72,68 +147,93 @@ def get_temporal_resolution(values):
     return 'second'
 
 
-def detect_quarter(timestamp):
-    # Convert timestamp string to datetime object
-    #timestamp = datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S")
+def get_temporal_ranges(values):
+    """Get the range of datetimes, in the same format as numerical ranges.
+    """
+    values = to_datetime_index(values)
+    if not len(values):
+        return []
+    ns = values.asi8
+    return [{'range': {
+        'gte': _EPOCH + timedelta(microseconds=int(ns.max()) // 1000),
+        'lte': _EPOCH + timedelta(microseconds=int(ns.min()) // 1000),
+    }}]
 
-    # Extract the month from the timestamp
-    month = timestamp.month
 
-    # Determine the quarter based on the month
-    if 1 <= month <= 3:
-        return 1
-    elif 4 <= month <= 6:
-        return 2
-    elif 7 <= month <= 9:
-        return 3
-    else:
-        return 4
+def get_temporal_histogram(values, bins=10, weights=None):
+    """Compute a histogram of datetimes, with bins of equal duration.
 
-def getQuarterData(values):
-    quarter_counts = Counter(map(detect_quarter, values))
+    Like ``numpy.histogram()``, the last bin includes its upper edge, and if
+    all the values are the same the bins span one second around them.
+    Computations are done exactly on the int64 values.
 
-    # Calculate percentages
-    total_timestamps = len(values)
-    quarter_percentages = {quarter: count / total_timestamps * 100 for quarter, count in quarter_counts.items()}
+    :param weights: The number of values each element of `values` stands
+        for, e.g. from a sketch
 
-    return quarter_percentages
+    :return: A tuple ``(counts, edges)`` where `edges` are naive datetimes in
+        UTC, one more than there are `counts`
+    """
+    ns = to_datetime_index(values).asi8
+    low, high = int(ns.min()), int(ns.max())
+    if low == high:
+        low -= _NS_PER_SECOND // 2
+        high += _NS_PER_SECOND // 2
+    edges = [low + (high - low) * i // bins for i in range(bins + 1)]
+    indexes = numpy.searchsorted(
+        numpy.array(edges[1:-1], dtype=numpy.int64),
+        ns,
+        side='right',
+    )
+    counts = numpy.bincount(indexes, weights=weights, minlength=bins)
+    epoch = _EPOCH.replace(tzinfo=None)
+    return (
+        [int(round(c)) for c in counts],
+        [epoch + timedelta(microseconds=edge // 1000) for edge in edges],
+    )
+
+
+def _percentages(keys):
+    """Get the percentage of the values that have each key (small integers).
+    """
+    counts = numpy.bincount(keys)
+    total = len(keys)
+    return {
+        int(key): int(counts[key]) / total * 100
+        for key in numpy.flatnonzero(counts)
+    }
+
+
+def _iso_weeks(values):
+    """Get the ISO week number of each datetime.
+    """
+    days = values.asi8 // _NS_PER_DAY
+    # The week belongs to the year its Thursday is in (1970-01-01 was one)
+    thursdays = days - (days + 3) % 7 + 3
+    years = thursdays.astype('M8[D]').astype('M8[Y]').astype('M8[D]')
+    return (thursdays - years.astype(numpy.int64)) // 7 + 1
+
+
+def getQuarterData(values):
+    values = to_datetime_index(values)
+    return _percentages(values.quarter.to_numpy())
 
-def detect_week(timestamp):
-    #timestamp = datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S")
-    week_number = timestamp.isocalendar()[1]
-    return week_number
 
 def getWeekData(timestamps):
-    # Count occurrences of each week
-    week_counts = Counter(map(detect_week, timestamps))
-
-    # Calculate percentages
-    total_timestamps = len(timestamps)
-    week_percentages = {week: count / total_timestamps * 100 for week, count in week_counts.items()}
-
-    return week_percentages
-def detect_time_of_day(timestamp):
-    #timestamp = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
-    hour = timestamp.hour
-
-    if 6 <= hour < 12:
-        return "morning"
-    elif 12 <= hour < 18:
-        return "afternoon"
-    elif 18 <= hour < 24:
-        return "evening"
-    else:
-        return "night"
+    timestamps = to_datetime_index(timestamps)
+    return _percentages(_iso_weeks(timestamps))
 
-def getTimeOfDayData(timestamps):
-    # Count occurrences of each time of day
-    time_of_day_counts = Counter(map(detect_time_of_day, timestamps))
 
-    # Calculate percentages
-    total_timestamps = len(timestamps)
-    time_of_day_percentages = {time_of_day: count / total_timestamps * 100 for time_of_day, count in time_of_day_counts.items()}
+_times_of_day = ['night', 'morning', 'afternoon', 'evening']
+
+
+def getTimeOfDayData(timestamps):
+    timestamps = to_datetime_index(timestamps)
+    percentages = _percentages(timestamps.hour.to_numpy() // 6)
+    return {
+        _times_of_day[key]: percentage
+        for key, percentage in percentages.items()
+    }
 
-    return time_of_day_percentages
 
 _defaults = datetime(1985, 1, 1), datetime(2005, 6, 1)
 
@@ -165,39 +265,206 @@ def parse_date(string):
         dt1 = dt1.replace(tzinfo=dateutil.tz.UTC)
     return dt1
 
-def checkAndCombineTemporalColumns(data, column_meta):
-    # col_names = data.columns
-    # #print(col_names)
-    # if 'year' in col_names and 'month' in col_names and 'day' in col_names:
-    #   hours = df['hours'] if 'hours' in columns else '0'
-    #   minutes = df['minutes'] if 'minutes' in columns else '0'
-    #   seconds = df['seconds'] if 'seconds' in columns else '0'
-    #   data['gen_timestamp'] = pd.to_datetime(data[['year', 'month', 'day', 'hours', 'minutes', 'seconds']]).astype('str')
-    #   columns.append({'name':'gen_timestamp'})
-
-    # #print(columns)
-    # return data,columns
-
-    # Extract column names and their resolutions from column_meta
-    resolutions = {}
-    for col in column_meta['temporal_coverage']:
-        if col['temporal_resolution']:
-          if 'day' in col['temporal_resolution'] or 'month' in col['temporal_resolution'] or 'year' in col['temporal_resolution']:
-            resolutions[col['temporal_resolution']] = col['column_names'][0]
-
-    if(len(resolutions) > 0):
-      data['Concatenated Date'] = 'DD-MM-YYYY'
-      for col_type, col in resolutions.items():
-        if col_type == 'day':
-          data['Concatenated Date'] = data.apply(lambda row: row['Concatenated Date'].replace('DD', row[col]), axis=1)
-          continue
-        if col_type == 'month':
-          data['Concatenated Date'] = data.apply(lambda row: row['Concatenated Date'].replace('MM', row[col]), axis=1)
-          continue
-        if col_type == 'year':
-          data['Concatenated Date'] = data.apply(lambda row: row['Concatenated Date'].replace('YYYY', row[col]), axis=1)
-          continue
-
-      data['Concatenated Date'] = pandas.to_datetime(data['Concatenated Date'])
-
-    return data, column_meta
\ No newline at end of file
+DATE_FORMATS = [
+    '%Y-%m-%d',
+    '%Y-%m-%d %H:%M',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y/%m/%d',
+    '%Y/%m/%d %H:%M:%S',
+    '%m/%d/%Y',
+    '%m/%d/%Y %H:%M',
+    '%m/%d/%Y %H:%M:%S',
+    '%Y-%m',
+]
+"""Formats tried before falling back on dateutil
+
+Those should only contain formats that dateutil would parse the same way, e.g.
+month before day, and a full year.
+"""
+
+DATE_FORMATS_SAMPLE = 100
+"""Number of values looked at to pick the formats to try"""
+
+MAX_DATE_FORMATS = 3
+
+_format_directives = {
+    '%Y': '[0-9]{4}',
+    '%m': '[0-9]{1,2}',
+    '%d': '[0-9]{1,2}',
+    '%H': '[0-9]{1,2}',
+    '%M': '[0-9]{2}',
+    '%S': '[0-9]{2}',
+    '%f': '[0-9]{1,6}',
+}
+
+
+def _format_regex(fmt):
+    """Build a regular expression matching strings with the exact format.
+
+    This is used to check the values before handing them to pandas, which can
+    be more lenient than ``strptime()`` about the format.
+    """
+    return re.compile(
+        '^'
+        + re.sub(
+            '%[a-zA-Z]|[^%]+',
+            lambda m: _format_directives.get(m.group(0)) or re.escape(m.group(0)),
+            fmt,
+        )
+        # 'Z' means UTC, which is what we assume anyway
+        + 'Z?$'
+    )
+
+
+_date_formats = [(fmt, _format_regex(fmt)) for fmt in DATE_FORMATS]
+
+
+def parse_date_array(values):
+    """Parse an array of strings into dates, in bulk.
+
+    The formats in `DATE_FORMATS` that match a sample of the values are tried
+    first, converting the whole array with ``pandas.to_datetime()``. Values
+    that don't match any of them go through `parse_date()`.
+
+    :return: A ``DatetimeIndex`` of type ``datetime64[ns, UTC]``, with NaT
+        for values that are not dates (or fall outside of its range)
+    """
+    values = pandas.Series(values, dtype=object)
+    results = numpy.full(len(values), numpy.datetime64('NaT', 'ns'))
+
+    # Pick formats from a sample
+    sample = values.iloc[:DATE_FORMATS_SAMPLE]
+    format_counts = []
+    for fmt, regex in _date_formats:
+        count = sum(1 for value in sample if regex.match(value))
+        if count:
+            format_counts.append((count, fmt, regex))
+    format_counts.sort(key=lambda e: -e[0])
+
+    # Parse with those formats
+    remaining = values
+    for _, fmt, regex in format_counts[:MAX_DATE_FORMATS]:
+        matches = remaining.str.match(regex.pattern)
+        if not matches.any():
+            continue
+        matched = remaining[matches].str.rstrip('Z')
+        parsed = pandas.to_datetime(matched, format=fmt, errors='coerce')
+        valid = ~parsed.isna()
+        results[parsed.index[valid]] = parsed[valid].to_numpy()
+        remaining = remaining[~remaining.index.isin(parsed.index[valid])]
+
+    # Fall back on dateutil for the rest
+    fallback = [
+        (idx, parse_date(value))
+        for idx, value in remaining.items()
+        if value
+    ]
+    fallback = [(idx, dt) for idx, dt in fallback if dt is not None]
+    if fallback:
+        indexes, datetimes = zip(*fallback)
+        results[list(indexes)] = pandas.to_datetime(
+            list(datetimes), utc=True, errors='coerce',
+        ).tz_localize(None).to_numpy()
+
+    return pandas.DatetimeIndex(results).tz_localize('UTC')
+
+
+_date_components = ['year', 'month', 'day', 'hour', 'minute', 'second']
+
+_month_numbers = {
+    name[:3].lower(): number
+    for number, name in enumerate(calendar.month_name)
+    if name
+}
+
+
+def _parse_date_part(values, part):
+    """Parse the numbers in a column that holds part of a date.
+
+    :return: A DataFrame with a column for each date component found (e.g.
+        ``year`` and ``month`` for `part` ``'Year_Month'``), with NaN for
+        invalid values
+    """
+    values = pandas.Series(values, dtype=object).astype(str).str.strip()
+    if part == 'Year_Month':
+        # "YYYY-MM" or "YYYYMM"
+        components = values.str.extract(
+            r'^(?P<year>[0-9]{4})-?(?P<month>[0-9]{1,2})$',
+        )
+    else:
+        name = part.lower()
+        numbers = pandas.to_numeric(values, errors='coerce')
+        if name == 'year':
+            # Values like "YYYY-MM"
+            extracted = values.str.extract(r'^([0-9]{4})\b', expand=False)
+            numbers = numbers.where(numbers <= 9999, extracted)
+        elif name == 'month':
+            # Month names
+            names = values.str[:3].str.lower().map(_month_numbers)
+            numbers = numbers.where(~numbers.isna(), names)
+        components = pandas.DataFrame({name: numbers})
+    components = components.apply(pandas.to_numeric, errors='coerce')
+    # Only keep whole numbers
+    return components.where(components % 1 == 0)
+
+
+def combine_temporal_columns(data, parts):
+    """Build datetimes from a date split over multiple columns.
+
+    This needs at least a year and a month. The day defaults to the first of
+    the month, and the time is only used if there is a day.
+
+    :param data: The data as a DataFrame
+    :param parts: A dict mapping the index of each column that holds part of
+        a date to the part it holds: ``'Year'``, ``'Year_Month'``,
+        ``'Month'``, ``'Day'``, ``'Hour'``, ``'Minute'``, or ``'Second'``
+    :return: A tuple ``(column_indexes, datetimes)`` where `column_indexes`
+        are the columns that were combined and `datetimes` a ``DatetimeIndex``
+        in UTC of the rows that form a valid date, or None if the columns
+        don't form a date
+    """
+    # Pick a column for each component
+    sources = {}
+    for column_idx, part in parts.items():
+        if part == 'Year_Month':
+            components = ['year', 'month']
+        elif isinstance(part, str) and part.lower() in _date_components:
+            components = [part.lower()]
+        else:
+            continue
+        if not any(c in sources for c in components):
+            for component in components:
+                sources[component] = column_idx, part
+    if 'year' not in sources or 'month' not in sources:
+        return None
+    if 'day' not in sources:
+        sources = {k: v for k, v in sources.items() if k in ('year', 'month')}
+
+    # Parse the columns, in bulk
+    column_indexes = []
+    frame = pandas.DataFrame(index=pandas.RangeIndex(len(data)))
+    for component in _date_components:
+        if component not in sources:
+            continue
+        column_idx, part = sources[component]
+        if column_idx not in column_indexes:
+            column_indexes.append(column_idx)
+            parsed = _parse_date_part(data.iloc[:, column_idx].values, part)
+            for name in parsed.columns:
+                frame[name] = parsed[name].values
+    if 'day' not in frame.columns:
+        frame['day'] = 1
+
+    datetimes = pandas.DatetimeIndex(pandas.to_datetime(
+        frame[[c for c in _date_components if c in frame.columns]],
+        errors='coerce',
+        utc=True,
+    ))
+    datetimes = datetimes[~datetimes.isna()]
+    if not len(datetimes):
+        return None
+    return column_indexes, datetimes
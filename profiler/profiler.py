@@ -1,16 +1,25 @@
 import aio_pika
 import asyncio
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 import contextlib
 from datetime import datetime
 import defusedxml
 import elasticsearch
+import elasticsearch.serializer
+import hashlib
 import io
 import itertools
+import json
 import lazo_index_service
 import logging
+import multiprocessing
 import opentelemetry.trace
 import os
+import pickle
 import prometheus_client
+import prometheus_client.multiprocess
+import resource
 import sentry_sdk
 import socket
 import threading
@@ -18,29 +27,145 @@ import time
 import traceback
 
 from datamart_core.common import PrefixedElasticsearch, setup_logging, \
-    add_dataset_to_index, delete_dataset_from_index, \
-    delete_dataset_from_lazo, log_future, json2msg, msg2json
+    add_dataset_to_index, add_datasets_to_index, delete_dataset_from_index, \
+    delete_dataset_from_lazo, log_future, block_run, json2msg, msg2json, \
+    hash_json, encode_dataset_id
 from datamart_core.materialize import get_dataset, dataset_cache_key
 from datamart_fslock.cache import cache_get_or_set
 from datamart_geo import GeoData
 from datamart_materialize import DatasetTooBig
 from datamart_materialize.detect import detect_format_convert_to_csv
-from datamart_profiler import process_dataset
+from datamart_profiler import process_dataset, spatial
 
 
 logger = logging.getLogger(__name__)
 tracer = opentelemetry.trace.get_tracer(__name__)
 
+_serializer = elasticsearch.serializer.JSONSerializer()
 
-MAX_CONCURRENT_PROFILE = 1
-MAX_CONCURRENT_DOWNLOAD = 2
+
+SIZE_CLASSES = ('small', 'large')
+"""Classes of datasets by size, each has its own queue and worker processes
+
+Small datasets don't wait behind big ones, and big ones always make progress
+on their own workers.
+"""
+
+SMALL_DATASET_SIZE = int(
+    os.environ.get('PROFILE_SMALL_DATASET_SIZE', '100000000'),
+    10,
+)
+"""Size up to which datasets are in the 'small' class, in bytes
+
+Datasets of unknown size are in the 'large' class.
+"""
+
+PROFILE_WORKERS = {
+    size_class: int(
+        os.environ.get('PROFILE_WORKERS_%s' % size_class.upper(), '1'),
+        10,
+    )
+    for size_class in SIZE_CLASSES
+}
+"""Number of worker processes profiling datasets, for each size class"""
+
+DOWNLOAD_CONCURRENCY = int(
+    os.environ.get('PROFILE_DOWNLOAD_CONCURRENCY', '2'),
+    10,
+)
+"""Number of datasets downloaded at a time, for each size class"""
+
+CONVERT_WORKERS = int(os.environ.get('PROFILE_CONVERT_WORKERS', '1'), 10)
+"""Number of worker processes converting datasets, for each size class"""
+
+INDEX_BATCH_SIZE = 20
+"""Maximum number of datasets added to the index in one bulk request"""
+
+INDEX_BATCH_DELAY = 0.5
+"""Time to wait for more datasets before adding a batch, in seconds"""
+
+ROUTE_PREFETCH = 20
+"""Number of messages to get from the profiling queue to route by size"""
+
+WORKER_MAX_JOBS = int(os.environ.get('PROFILE_WORKER_MAX_JOBS', '50'), 10)
+"""Number of datasets a worker process profiles before being replaced"""
+
+WORKER_MAX_RSS = int(
+    os.environ.get('PROFILE_WORKER_MAX_RSS', '4000000000'),
+    10,
+)
+"""Peak resident memory after which a worker is replaced, in bytes"""
+
+WORKER_MEMORY_LIMIT = os.environ.get('PROFILE_WORKER_MEMORY_LIMIT')
+WORKER_MEMORY_LIMIT = int(WORKER_MEMORY_LIMIT, 10) \
+    if WORKER_MEMORY_LIMIT else None
+"""Address space limit of worker processes, in bytes
+
+Going over it makes the current dataset fail with a ``MemoryError``.
+"""
+
+DIGEST_CHUNK_SIZE = 1 << 20
+"""Number of bytes read at a time when computing the digest of a file"""
 
 
 PROM_DOWNLOADING = prometheus_client.Gauge(
     'profile_downloading_count', "Number of datasets currently downloading",
+    multiprocess_mode='livesum',
 )
 PROM_PROFILING = prometheus_client.Gauge(
     'profile_profiling_count', "Number of datasets currently profiling",
+    multiprocess_mode='livesum',
+)
+PROM_WORKERS_BUSY = prometheus_client.Gauge(
+    'profile_workers_busy', "Number of worker processes currently busy",
+    multiprocess_mode='livesum',
+)
+PROM_WORKERS_REPLACED = prometheus_client.Counter(
+    'profile_workers_replaced',
+    "Number of worker processes replaced, by reason",
+    ['reason'],
+)
+for reason in ('jobs', 'memory', 'crash'):
+    PROM_WORKERS_REPLACED.labels(reason).inc(0)
+PROM_QUEUE_WAIT = prometheus_client.Histogram(
+    'profile_queue_wait_seconds',
+    "Time datasets wait before processing starts, by size class",
+    ['size_class'],
+    buckets=[
+        1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0, 4 * 3600.0,
+        24 * 3600.0, float('inf'),
+    ],
+)
+for size_class in SIZE_CLASSES:
+    PROM_QUEUE_WAIT.labels(size_class)
+PROM_STAGE_CONCURRENCY = prometheus_client.Gauge(
+    'profile_stage_concurrency',
+    "Number of jobs a pipeline stage runs at a time",
+    ['stage', 'size_class'],
+    multiprocess_mode='livesum',
+)
+PROM_STAGE_BUSY = prometheus_client.Gauge(
+    'profile_stage_busy',
+    "Number of jobs a pipeline stage is currently running",
+    ['stage', 'size_class'],
+    multiprocess_mode='livesum',
+)
+PROM_STAGE_QUEUED = prometheus_client.Gauge(
+    'profile_stage_queued',
+    "Number of jobs waiting in the queue of a pipeline stage",
+    ['stage', 'size_class'],
+    multiprocess_mode='livesum',
+)
+PROM_STAGE_BUSY_SECONDS = prometheus_client.Counter(
+    'profile_stage_busy_seconds',
+    "Time spent running jobs in a pipeline stage, divide its rate by the "
+    + "concurrency to get the utilization",
+    ['stage', 'size_class'],
+)
+PROM_STAGE_BLOCKED_SECONDS = prometheus_client.Counter(
+    'profile_stage_blocked_seconds',
+    "Time a pipeline stage waited for room in the next stage",
+    ['stage', 'size_class'],
 )
 
 
@@ -63,14 +188,20 @@ def prom_incremented(metric, amount=1):
 class LazoDeleteFirst(object):
     def __init__(self, lazo_client, es, dataset_id):
         self._deleted = False
+        self._lock = threading.Lock()
         self._lazo = lazo_client
         self._es = es
         self._dataset_id = dataset_id
 
     def _delete(self):
-        if not self._deleted:
-            self._deleted = True
-            delete_dataset_from_lazo(self._es, self._dataset_id, self._lazo)
+        # Columns are indexed from multiple threads, make sure none of them
+        # goes ahead before the deletion is done
+        with self._lock:
+            if not self._deleted:
+                self._deleted = True
+                delete_dataset_from_lazo(
+                    self._es, self._dataset_id, self._lazo,
+                )
 
     def index_data_path(self, *args, **kwargs):
         self._delete()
@@ -87,77 +218,482 @@ class LazoDeleteFirst(object):
         return self._lazo.get_lazo_sketch_from_data(*args, **kwargs)
 
 
+def file_digest(path):
+    """Compute the SHA-256 of a file, reading it in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        chunk = fp.read(DIGEST_CHUNK_SIZE)
+        while chunk:
+            digest.update(chunk)
+            chunk = fp.read(DIGEST_CHUNK_SIZE)
+    return digest.hexdigest()
+
+
+def profile_cache_key(dataset_id, metadata, dataset_path):
+    """Get the key of a profile in the cache.
+
+    It is computed from the content of the CSV file, the metadata from
+    discovery that profiling starts from (e.g. manual annotations), and the
+    version of the profiler. The dataset ID is included too, since textual
+    columns are indexed in Lazo under it while profiling.
+    """
+    h = hash_json(
+        id=dataset_id,
+        metadata=metadata,
+        digest=file_digest(dataset_path),
+        version=os.environ['DATAMART_VERSION'],
+    )
+    return '%s_%s' % (encode_dataset_id(dataset_id), h)
+
+
+def is_indexed(es, dataset_id):
+    try:
+        es.get('datasets', dataset_id, _source=False)
+    except elasticsearch.NotFoundError:
+        return False
+    else:
+        return True
+
+
+def _split_materialize(metadata):
+    """Separate the materialization info from the metadata.
+
+    Converters are removed, we'll discover what's needed.
+    """
+    metadata = dict(metadata)
+    materialize = dict(metadata.pop('materialize'))
+    materialize.pop('convert', None)
+    return metadata, materialize
+
+
+def convert_file(func, path, cache_temp):
+    """Convert a file with a converter function, into a new cache entry.
+    """
+    with open(cache_temp, 'w', newline='') as dst:
+        func(path, dst)
+
+
+def materialize_dataset(stack, dataset_id, metadata, materialize,
+                        run_convert=convert_file):
+    """Get the CSV file of a dataset, downloading and converting as needed.
+
+    The downloaded and converted files are cached, and stay locked until
+    `stack` is closed. `materialize` is updated with the conversions that
+    were applied.
+
+    :param run_convert: Function called like `convert_file` to do each
+        conversion, for example in a worker process
+    :return: The path to the CSV file
+    """
+    dataset_path = stack.enter_context(
+        get_dataset(
+            dict(metadata, materialize=materialize),
+            dataset_id,
+        )
+    )
+
+    def convert_dataset(func, path):
+        def convert(cache_temp):
+            run_convert(func, path, cache_temp)
+        converted_key = dataset_cache_key(
+            dataset_id,
+            dict(metadata, materialize=materialize),
+            'csv',
+            {},
+        )
+        return stack.enter_context(
+            cache_get_or_set(
+                '/cache/datasets',
+                converted_key,
+                convert,
+            )
+        )
+
+    return detect_format_convert_to_csv(
+        dataset_path,
+        convert_dataset,
+        materialize,
+    )
+
+
+def download_dataset(stack, dataset_id, metadata):
+    """Download a dataset into the cache, if it's not there already.
+
+    The downloaded file stays locked until `stack` is closed.
+    """
+    metadata, materialize = _split_materialize(metadata)
+    with prom_incremented(PROM_DOWNLOADING):
+        stack.enter_context(
+            get_dataset(
+                dict(metadata, materialize=materialize),
+                dataset_id,
+            )
+        )
+
+
 def materialize_and_process_dataset(
-    dataset_id, metadata,
-    lazo_client, nominatim, geo_data,
-    profile_semaphore,
+    dataset_id, metadata, materialize, dataset_path,
+    lazo_client, nominatim, geo_data, es,
 ):
-    with contextlib.ExitStack() as stack:
-        # Remove converters, we'll discover what's needed
-        metadata = dict(metadata)
-        materialize = dict(metadata.pop('materialize'))
-        materialize.pop('convert', None)
-
-        with prom_incremented(PROM_DOWNLOADING):
-            dataset_path = stack.enter_context(
-                get_dataset(
-                    dict(metadata, materialize=materialize),
+    """Profile the CSV file of a dataset, from `materialize_dataset`.
+
+    `metadata` is the metadata from discovery, without `materialize`.
+    """
+    # Profile, unless this exact data was profiled before. If the
+    # dataset is not in the index (anymore), its columns might not be in
+    # Lazo, so profile it again
+    profile_key = profile_cache_key(dataset_id, metadata, dataset_path)
+    profiled = False
+
+    def profile(cache_temp):
+        nonlocal profiled
+        profiled = True
+        with prom_incremented(PROM_PROFILING):
+            with tracer.start_as_current_span(
+                'profile',
+                attributes={'dataset': dataset_id},
+            ):
+                logger.info("Profiling dataset %r", dataset_id)
+                start = time.perf_counter()
+                profile = process_dataset(
+                    data=dataset_path,
+                    dataset_id=dataset_id,
+                    metadata=metadata,
+                    lazo_client=lazo_client,
+                    nominatim=nominatim,
+                    geo_data=geo_data,
+                    include_sample=True,
+                    coverage=True,
+                    plots=True,
+                )
+                logger.info(
+                    "Profiling dataset %r took %.2fs",
                     dataset_id,
+                    time.perf_counter() - start,
                 )
-            )
+        # Serialize like it would be for Elasticsearch, e.g. dates
+        with open(cache_temp, 'w') as fp:
+            fp.write(_serializer.dumps(profile))
 
-        def convert_dataset(func, path):
-            def convert(cache_temp):
-                with open(cache_temp, 'w', newline='') as dst:
-                    func(path, dst)
-            converted_key = dataset_cache_key(
-                dataset_id,
-                dict(metadata, materialize=materialize),
-                'csv',
-                {},
-            )
-            return stack.enter_context(
-                cache_get_or_set(
-                    '/cache/datasets',
-                    converted_key,
-                    convert,
+    with cache_get_or_set(
+        '/cache/profiles',
+        profile_key,
+        profile,
+        cache_invalid=not is_indexed(es, dataset_id),
+    ) as profile_path:
+        with open(profile_path) as fp:
+            metadata = json.load(fp)
+    if not profiled:
+        logger.info("Dataset %r hasn't changed, using previous profile",
+                    dataset_id)
+
+    metadata['materialize'] = materialize
+    return metadata
+
+
+def picklable_exception(e):
+    """Get an exception that can be sent from a worker process.
+
+    If it can't be unpickled in the parent, the pool breaks and the job
+    looks like a crash, so it is replaced with one that can.
+    """
+    try:
+        pickle.loads(pickle.dumps(e))
+    except Exception:
+        return RuntimeError(
+            "%s.%s: %s" % (type(e).__module__, type(e).__qualname__, e),
+        )
+    return e
+
+
+_worker = None
+
+
+def _init_worker(geo_data_path):
+    """Set up a worker process, with its own connections.
+    """
+    global _worker
+
+    setup_logging()
+    if WORKER_MEMORY_LIMIT is not None:
+        resource.setrlimit(
+            resource.RLIMIT_AS,
+            (WORKER_MEMORY_LIMIT, WORKER_MEMORY_LIMIT),
+        )
+    if os.environ.get('NOMINATIM_CACHE'):
+        spatial.nominatim_cache = spatial.SqliteNominatimCache(
+            os.environ['NOMINATIM_CACHE'],
+        )
+    _worker = dict(
+        es=PrefixedElasticsearch(),
+        lazo_client=lazo_index_service.LazoIndexClient(
+            host=os.environ['LAZO_SERVER_HOST'],
+            port=int(os.environ['LAZO_SERVER_PORT'])
+        ),
+        nominatim=os.environ.get('NOMINATIM_URL') or None,
+        geo_data=spatial.CachedGeoData(GeoData(geo_data_path)),
+    )
+
+
+def _worker_job(func, *args):
+    """Run a function in a worker process.
+
+    :return: A tuple ``(result, pid, max_rss)`` with the peak resident
+        memory of the process so far, in bytes
+    """
+    with prom_incremented(PROM_WORKERS_BUSY):
+        try:
+            result = func(*args)
+        except Exception as e:
+            raise picklable_exception(e)
+    # ru_maxrss is in kilobytes on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return result, os.getpid(), max_rss
+
+
+def _profile_job(dataset_id, metadata, materialize, dataset_path):
+    """Profile a dataset, using the connections of the worker process.
+    """
+    return materialize_and_process_dataset(
+        dataset_id,
+        metadata,
+        materialize,
+        dataset_path,
+        LazoDeleteFirst(_worker['lazo_client'], _worker['es'], dataset_id),
+        _worker['nominatim'],
+        _worker['geo_data'],
+        _worker['es'],
+    )
+
+
+def get_size_class(metadata):
+    """Get the size class of a dataset, from the size given on discovery.
+    """
+    size = metadata.get('size')
+    if isinstance(size, (int, float)) and size <= SMALL_DATASET_SIZE:
+        return 'small'
+    return 'large'
+
+
+# Forking from the event loop's process could copy locks held by its other
+# threads, so workers are forked from a separate server process. It imports
+# this module once, so workers start quickly
+_mp_context = multiprocessing.get_context('forkserver')
+
+
+class _WorkerSlot(object):
+    def __init__(self, geo_data_path):
+        # A single process per executor, so one can be replaced without
+        # affecting the others
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            1,
+            mp_context=_mp_context,
+            initializer=_init_worker,
+            initargs=(geo_data_path,),
+        )
+        self.jobs = 0
+        self.pid = None
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+        if self.pid is not None and 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+            prometheus_client.multiprocess.mark_process_dead(self.pid)
+
+
+class WorkerPool(object):
+    """Pool of worker processes, for converting and profiling datasets.
+
+    A worker is replaced after `WORKER_MAX_JOBS` jobs, if its peak memory
+    went over `WORKER_MAX_RSS`, or if it crashed. A crash only fails the job
+    it was running.
+    """
+    def __init__(self, size, geo_data_path):
+        self.size = size
+        self.geo_data_path = geo_data_path
+        self._idle = asyncio.Queue()
+        for _ in range(size):
+            self._idle.put_nowait(_WorkerSlot(geo_data_path))
+
+    def _replace(self, slot, reason):
+        logger.info("Replacing worker process %s (%s)", slot.pid, reason)
+        PROM_WORKERS_REPLACED.labels(reason).inc()
+        slot.shutdown()
+        return _WorkerSlot(self.geo_data_path)
+
+    async def run(self, func, *args):
+        """Run a function in a worker process, and get its result.
+        """
+        slot = await self._idle.get()
+        try:
+            result, slot.pid, max_rss = \
+                await asyncio.get_event_loop().run_in_executor(
+                    slot.executor,
+                    _worker_job,
+                    func,
+                    *args,
                 )
+        except BrokenProcessPool:
+            slot = self._replace(slot, 'crash')
+            raise
+        else:
+            slot.jobs += 1
+            if slot.jobs >= WORKER_MAX_JOBS:
+                slot = self._replace(slot, 'jobs')
+            elif max_rss > WORKER_MAX_RSS:
+                slot = self._replace(slot, 'memory')
+            return result
+        finally:
+            self._idle.put_nowait(slot)
+
+
+class Job(object):
+    """A dataset going through the pipeline, from its message.
+    """
+    def __init__(self, message, size_class):
+        obj = msg2json(message)
+        self.message = message
+        self.size_class = size_class
+        self.dataset_id = obj['id']
+        self.metadata = obj['metadata']
+        self.queued_at = (message.headers or {}).get('queued_at')
+        self.error = None
+        # Locks on the cached files, held until profiling is done
+        self.stack = contextlib.ExitStack()
+        # Set by the convert stage
+        self.materialize = None
+        self.dataset_path = None
+        # Set if it got added to the index, with the document
+        self.body = None
+
+
+class Stage(object):
+    """Step of the profiling pipeline, with its own concurrency.
+
+    `concurrency` tasks take jobs from a bounded queue, run `func` on them,
+    and put them in the queue of the next stage. When that queue is full,
+    this stage waits, and its own queue fills up in turn (backpressure). Jobs
+    that failed go through the following stages without being processed.
+    """
+    def __init__(self, name, size_class, func, concurrency, next_stage):
+        self.func = func
+        self.concurrency = concurrency
+        self.next_stage = next_stage
+        self.queue = asyncio.Queue(maxsize=concurrency)
+        self._labels = (name, size_class)
+        PROM_STAGE_CONCURRENCY.labels(*self._labels).set(concurrency)
+
+    @property
+    def capacity(self):
+        """Maximum number of jobs in this stage, queued or running.
+        """
+        return self.queue.maxsize + self.concurrency
+
+    def start(self, loop):
+        for _ in range(self.concurrency):
+            log_future(loop.create_task(self._run()), logger,
+                       should_never_exit=True)
+
+    async def put(self, job):
+        await self.queue.put(job)
+        PROM_STAGE_QUEUED.labels(*self._labels).set(self.queue.qsize())
+
+    async def _run(self):
+        while True:
+            job = await self.queue.get()
+            PROM_STAGE_QUEUED.labels(*self._labels).set(self.queue.qsize())
+            if job.error is None:
+                start = time.perf_counter()
+                with prom_incremented(PROM_STAGE_BUSY.labels(*self._labels)):
+                    try:
+                        await self.func(job)
+                    except Exception as e:
+                        job.error = e
+                PROM_STAGE_BUSY_SECONDS.labels(*self._labels).inc(
+                    time.perf_counter() - start,
+                )
+            start = time.perf_counter()
+            await self.next_stage.put(job)
+            PROM_STAGE_BLOCKED_SECONDS.labels(*self._labels).inc(
+                time.perf_counter() - start,
             )
 
-        dataset_path = detect_format_convert_to_csv(
-            dataset_path,
-            convert_dataset,
-            materialize,
+
+class IndexStage(object):
+    """Last step of the profiling pipeline, adding datasets to the index.
+
+    Jobs are taken in batches of up to `INDEX_BATCH_SIZE`, and added to
+    Elasticsearch with bulk requests. Then `finish` is called for each job.
+    Datasets that failed to be added are left for `finish` to add on their
+    own, so it can report the error.
+    """
+    def __init__(self, es, finish):
+        self.es = es
+        self.finish = finish
+        self.queue = asyncio.Queue(maxsize=INDEX_BATCH_SIZE)
+        self._labels = ('index', 'all')
+        PROM_STAGE_CONCURRENCY.labels(*self._labels).set(1)
+
+    def start(self, loop):
+        log_future(loop.create_task(self._run(loop)), logger,
+                   should_never_exit=True)
+
+    async def put(self, job):
+        await self.queue.put(job)
+        PROM_STAGE_QUEUED.labels(*self._labels).set(self.queue.qsize())
+
+    def _index(self, jobs):
+        for job in jobs:
+            # Delete dataset if already exists in index
+            # Don't delete from Lazo, we inserted during profile
+            delete_dataset_from_index(self.es, job.dataset_id, None)
+        bodies = [
+            dict(job.metadata,
+                 date=datetime.utcnow().isoformat() + 'Z',
+                 version=os.environ['DATAMART_VERSION'])
+            for job in jobs
+        ]
+        failed = add_datasets_to_index(
+            self.es,
+            [(job.dataset_id, body) for job, body in zip(jobs, bodies)],
         )
+        for job, body in zip(jobs, bodies):
+            if job.dataset_id in failed:
+                logger.warning("Error adding dataset %r in bulk: %r",
+                               job.dataset_id, failed[job.dataset_id])
+            else:
+                job.body = body
 
-        # Profile
-        with profile_semaphore:
-            with prom_incremented(PROM_PROFILING):
-                with tracer.start_as_current_span(
-                    'profile',
-                    attributes={'dataset': dataset_id},
-                ):
-                    logger.info("Profiling dataset %r", dataset_id)
-                    start = time.perf_counter()
-                    metadata = process_dataset(
-                        data=dataset_path,
-                        dataset_id=dataset_id,
-                        metadata=metadata,
-                        lazo_client=lazo_client,
-                        nominatim=nominatim,
-                        geo_data=geo_data,
-                        include_sample=True,
-                        coverage=True,
-                        plots=True,
-                    )
-                    logger.info(
-                        "Profiling dataset %r took %.2fs",
-                        dataset_id,
-                        time.perf_counter() - start,
-                    )
+    async def _run(self, loop):
+        while True:
+            batch = [await self.queue.get()]
+            if self.queue.qsize() + 1 < INDEX_BATCH_SIZE:
+                # Give other datasets a chance to join the batch
+                await asyncio.sleep(INDEX_BATCH_DELAY)
+            while len(batch) < INDEX_BATCH_SIZE and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            PROM_STAGE_QUEUED.labels(*self._labels).set(self.queue.qsize())
+
+            jobs = [
+                job for job in batch
+                if job.error is None and job.metadata['nb_rows'] > 0
+            ]
+            if jobs:
+                start = time.perf_counter()
+                with prom_incremented(PROM_STAGE_BUSY.labels(*self._labels)):
+                    try:
+                        await loop.run_in_executor(None, self._index, jobs)
+                    except Exception:
+                        logger.exception("Error adding %d datasets in bulk",
+                                         len(jobs))
+                PROM_STAGE_BUSY_SECONDS.labels(*self._labels).inc(
+                    time.perf_counter() - start,
+                )
+                logger.info("Added %d datasets to the index in bulk",
+                            sum(1 for job in jobs if job.body is not None))
 
-        metadata['materialize'] = materialize
-        return metadata
+            for job in batch:
+                log_future(loop.create_task(self.finish(job)), logger)
 
 
 def exception_details(e):
@@ -177,23 +713,26 @@ def exception_details(e):
 
 class Profiler(object):
     def __init__(self):
-        self.profile_semaphore = threading.Semaphore(MAX_CONCURRENT_PROFILE)
         self.es = PrefixedElasticsearch()
         self.lazo_client = lazo_index_service.LazoIndexClient(
             host=os.environ['LAZO_SERVER_HOST'],
             port=int(os.environ['LAZO_SERVER_PORT'])
         )
-        if os.environ.get('NOMINATIM_URL'):
-            self.nominatim = os.environ['NOMINATIM_URL']
-        else:
-            self.nominatim = None
+        if not os.environ.get('NOMINATIM_URL'):
             logger.warning(
                 "$NOMINATIM_URL is not set, not resolving addresses"
             )
-        self.geo_data = GeoData.from_local_cache()
+        # Worker processes use the same data, make sure it's there
+        geo_data = GeoData.from_local_cache()
+        self.index_stage = IndexStage(self.es, self._finish)
+        self.pipelines = {
+            size_class: self._make_pipeline(size_class, geo_data._data_path)
+            for size_class in SIZE_CLASSES
+        }
         self.channel = None
 
         assert(os.path.isdir('/cache/datasets'))
+        os.makedirs('/cache/profiles', exist_ok=True)
 
         self.loop = asyncio.get_event_loop()
         log_future(self.loop.create_task(self._run()), logger,
@@ -213,6 +752,64 @@ class Profiler(object):
             else:
                 break
 
+    def _make_pipeline(self, size_class, geo_data_path):
+        """Set up the stages for a size class, ending with the index stage.
+        """
+        logger.info(
+            "Starting %d+%d worker processes for %s datasets",
+            CONVERT_WORKERS, PROFILE_WORKERS[size_class], size_class,
+        )
+        convert_pool = WorkerPool(CONVERT_WORKERS, geo_data_path)
+        profile_pool = WorkerPool(PROFILE_WORKERS[size_class], geo_data_path)
+
+        async def download(job):
+            if job.queued_at is not None:
+                PROM_QUEUE_WAIT.labels(size_class).observe(
+                    max(0.0, time.time() - job.queued_at),
+                )
+            await self.loop.run_in_executor(
+                None,
+                download_dataset, job.stack, job.dataset_id, job.metadata,
+            )
+
+        def run_convert(*args):
+            # Called from a thread, while the entry is locked
+            block_run(self.loop, convert_pool.run(convert_file, *args))
+
+        def materialize(job):
+            metadata, job.materialize = _split_materialize(job.metadata)
+            job.dataset_path = materialize_dataset(
+                job.stack, job.dataset_id, metadata, job.materialize,
+                run_convert=run_convert,
+            )
+
+        async def convert(job):
+            await self.loop.run_in_executor(None, materialize, job)
+
+        async def profile(job):
+            metadata, _ = _split_materialize(job.metadata)
+            try:
+                job.metadata = await profile_pool.run(
+                    _profile_job, job.dataset_id, metadata,
+                    job.materialize, job.dataset_path,
+                )
+            finally:
+                await self.loop.run_in_executor(None, job.stack.close)
+
+        profile_stage = Stage(
+            'profile', size_class, profile,
+            PROFILE_WORKERS[size_class], self.index_stage,
+        )
+        convert_stage = Stage(
+            'convert', size_class, convert,
+            CONVERT_WORKERS, profile_stage,
+        )
+        download_stage = Stage(
+            'download', size_class, download,
+            DOWNLOAD_CONCURRENCY, convert_stage,
+        )
+        return [download_stage, convert_stage, profile_stage]
+
     async def _amqp_setup(self):
         # Setup the datasets exchange
         self.datasets_exchange = await self.channel.declare_exchange(
@@ -232,6 +829,14 @@ class Profiler(object):
         )
         await self.profile_queue.bind(self.profile_exchange)
 
+        # Declare the queues for each size class
+        self.class_queues = {}
+        for size_class in SIZE_CLASSES:
+            self.class_queues[size_class] = await self.channel.declare_queue(
+                'profile_%s' % size_class,
+                arguments={'x-max-priority': 3},
+            )
+
         # Declare the failed queue
         self.failed_queue = await self.channel.declare_queue('failed_profile')
 
@@ -243,78 +848,111 @@ class Profiler(object):
             password=os.environ['AMQP_PASSWORD'],
         )
         self.channel = await connection.channel()
-        await self.channel.set_qos(prefetch_count=MAX_CONCURRENT_DOWNLOAD)
+        await self.channel.set_qos(prefetch_count=ROUTE_PREFETCH)
 
         await self._amqp_setup()
 
-        # Consume profiling queue
+        self.index_stage.start(self.loop)
+        for size_class in SIZE_CLASSES:
+            log_future(
+                self.loop.create_task(
+                    self._run_class(connection, size_class),
+                ),
+                logger,
+                should_never_exit=True,
+            )
+
+        # Route messages from the profiling queue to the size class queues
         async for message in self.profile_queue:
             obj = msg2json(message)
-            dataset_id = obj['id']
-            metadata = obj['metadata']
-            materialize = metadata.get('materialize', {})
+            size_class = get_size_class(obj['metadata'])
+            logger.info("Dataset %r is %s, size %s",
+                        obj['id'], size_class,
+                        obj['metadata'].get('size', 'unknown'))
+            await self.channel.default_exchange.publish(
+                aio_pika.Message(
+                    message.body,
+                    priority=message.priority,
+                    headers={'queued_at': time.time()},
+                ),
+                self.class_queues[size_class].name,
+            )
+            await message.ack()
 
-            logger.info("Processing dataset %r from %r",
-                        dataset_id, materialize.get('identifier'))
+    async def _run_class(self, connection, size_class):
+        pipeline = self.pipelines[size_class]
+        for stage in pipeline:
+            stage.start(self.loop)
 
-            future = self.loop.run_in_executor(
-                None,
-                materialize_and_process_dataset,
-                dataset_id,
-                metadata,
-                LazoDeleteFirst(self.lazo_client, self.es, dataset_id),
-                self.nominatim,
-                self.geo_data,
-                self.profile_semaphore,
-            )
+        # Separate channel, so each class gets its own prefetch. Get enough
+        # messages to fill every stage
+        channel = await connection.channel()
+        await channel.set_qos(
+            prefetch_count=sum(stage.capacity for stage in pipeline),
+        )
+        queue = await channel.declare_queue(
+            'profile_%s' % size_class,
+            arguments={'x-max-priority': 3},
+        )
 
-            future.add_done_callback(
-                self.process_dataset_callback(
-                    message, dataset_id,
-                )
-            )
+        # Consume profiling queue
+        async for message in queue:
+            job = Job(message, size_class)
+            logger.info("Processing %s dataset %r from %r",
+                        size_class, job.dataset_id,
+                        job.metadata.get('materialize', {}).get('identifier'))
+            await pipeline[0].put(job)
 
-    def process_dataset_callback(self, message, dataset_id):
-        async def coro(future):
-            metadata = msg2json(message)['metadata']
-            _rie = asyncio.get_event_loop().run_in_executor
-            in_thread = lambda func: _rie(None, func)
+    async def _finish(self, job):
+        message = job.message
+        dataset_id = job.dataset_id
+        metadata = msg2json(message)['metadata']
+        _rie = asyncio.get_event_loop().run_in_executor
+        in_thread = lambda func: _rie(None, func)
+        # Release the cached files, if a stage failed before profiling
+        await in_thread(job.stack.close)
+        try:
             try:
-                try:
-                    metadata = future.result()
-                    if metadata['nb_rows'] == 0:
-                        logger.info(
-                            "Dataset has no rows, not inserting into index: " +
-                            "%r",
+                if job.error is not None:
+                    raise job.error
+                metadata = job.metadata
+                if metadata['nb_rows'] == 0:
+                    logger.info(
+                        "Dataset has no rows, not inserting into index: " +
+                        "%r",
+                        dataset_id,
+                    )
+                    await in_thread(
+                        lambda: delete_dataset_from_index(
+                            self.es,
                             dataset_id,
-                        )
-                        await in_thread(
-                            lambda: delete_dataset_from_index(
-                                self.es,
-                                dataset_id,
-                                # DO delete from Lazo
-                                self.lazo_client,
-                            ),
-                        )
-                        self.es.index(
-                            'pending',
-                            dict(
-                                status='error',
-                                error="Dataset has no rows",
-                                metadata=metadata,
-                                date=datetime.utcnow().isoformat(),
-                                source=metadata['source'],
-                                materialize=metadata['materialize'],
-                            ),
-                            id=dataset_id,
-                        )
-                    else:
+                            # DO delete from Lazo
+                            self.lazo_client,
+                        ),
+                    )
+                    self.es.index(
+                        'pending',
+                        dict(
+                            status='error',
+                            error="Dataset has no rows",
+                            metadata=metadata,
+                            date=datetime.utcnow().isoformat(),
+                            source=metadata['source'],
+                            materialize=metadata['materialize'],
+                        ),
+                        id=dataset_id,
+                    )
+                else:
+                    body = job.body
+                    if body is None:
+                        # Bulk insertion failed, try again on its own
                         # Delete dataset if already exists in index
                         await in_thread(
                             lambda: delete_dataset_from_index(
                                 self.es,
                                 dataset_id,
-                                # Don't delete from Lazo, we inserted during profile
+                                # Don't delete from Lazo, we inserted during
+                                # profile
                                 None,
                             ),
                         )
@@ -323,120 +961,140 @@ class Profiler(object):
                                     date=datetime.utcnow().isoformat() + 'Z',
                                     version=os.environ['DATAMART_VERSION'])
                         await in_thread(
-                            lambda: add_dataset_to_index(self.es, dataset_id, body),
-                        )
-
-                        # Publish to RabbitMQ
-                        msg = dict(
-                            id=dataset_id,
-                        )
-                        for key in (
-                            'name', 'description', 'source', 'date', 'version',
-                            'types', 'nb_rows', 'nb_columns', 'materialize',
-                        ):
-                            if key in body:
-                                msg[key] = body[key]
-                        await self.datasets_exchange.publish(
-                            json2msg(msg),
-                            dataset_id,
+                            lambda: add_dataset_to_index(
+                                self.es, dataset_id, body,
+                            ),
                         )
 
-                        # Remove from alternate index
-                        try:
-                            self.es.delete('pending', dataset_id)
-                        except elasticsearch.NotFoundError:
-                            pass
-                except DatasetTooBig as e:
-                    # Materializer reached size limit
-                    if not e.limit:
-                        logger.info("Dataset over size limit: %r", dataset_id)
-                    elif e.actual:
-                        logger.info(
-                            "Dataset over size limit (%d > %d bytes): %r",
-                            e.actual, e.limit,
-                            dataset_id,
-                        )
-                    else:
-                        logger.info(
-                            "Dataset over size limit (%d bytes): %r",
-                            e.limit, dataset_id,
-                        )
-                    await message.ack()
-                    self.es.index(
-                        'pending',
-                        dict(
-                            status='error',
-                            error="Dataset is too big",
-                            metadata=metadata,
-                            date=datetime.utcnow().isoformat(),
-                            source=metadata['source'],
-                            materialize=metadata['materialize'],
-                        ),
+                    # Publish to RabbitMQ
+                    msg = dict(
                         id=dataset_id,
                     )
+                    for key in (
+                        'name', 'description', 'source', 'date', 'version',
+                        'types', 'nb_rows', 'nb_columns', 'materialize',
+                    ):
+                        if key in body:
+                            msg[key] = body[key]
+                    await self.datasets_exchange.publish(
+                        json2msg(msg),
+                        dataset_id,
+                    )
+
+                    # Remove from alternate index
                     try:
-                        await in_thread(
-                            lambda: delete_dataset_from_index(
-                                self.es,
-                                dataset_id,
-                                self.lazo_client,
-                            ),
-                        )
+                        self.es.delete('pending', dataset_id)
                     except elasticsearch.NotFoundError:
                         pass
-                except Exception as e:
-                    if isinstance(e, elasticsearch.RequestError):
-                        # This is a problem with our computed metadata
-                        sentry_sdk.capture_exception(e)
-                        logger.exception(
-                            "Error inserting dataset %r in Elasticsearch",
-                            dataset_id,
-                        )
-                    elif isinstance(e, elasticsearch.TransportError):
-                        # This is probably an issue with Elasticsearch
-                        # We'll log, nack and retry
-                        raise
-                    else:
-                        logger.warning("Error processing dataset %r",
-                                       dataset_id, exc_info=True)
-                    # Move message to failed queue
-                    await self.channel.default_exchange.publish(
-                        aio_pika.Message(message.body),
-                        self.failed_queue.name,
+            except DatasetTooBig as e:
+                # Materializer reached size limit
+                if not e.limit:
+                    logger.info("Dataset over size limit: %r", dataset_id)
+                elif e.actual:
+                    logger.info(
+                        "Dataset over size limit (%d > %d bytes): %r",
+                        e.actual, e.limit,
+                        dataset_id,
                     )
-                    # Ack anyway, retrying would probably fail again
-                    await message.ack()
-
-                    self.es.index(
-                        'pending',
-                        dict(
-                            status='error',
-                            error="Error profiling dataset",
-                            error_details=exception_details(e),
-                            metadata=metadata,
-                            date=datetime.utcnow().isoformat(),
-                            source=metadata['source'],
-                            materialize=metadata['materialize'],
+                else:
+                    logger.info(
+                        "Dataset over size limit (%d bytes): %r",
+                        e.limit, dataset_id,
+                    )
+                await message.ack()
+                self.es.index(
+                    'pending',
+                    dict(
+                        status='error',
+                        error="Dataset is too big",
+                        metadata=metadata,
+                        date=datetime.utcnow().isoformat(),
+                        source=metadata['source'],
+                        materialize=metadata['materialize'],
+                    ),
+                    id=dataset_id,
+                )
+                try:
+                    await in_thread(
+                        lambda: delete_dataset_from_index(
+                            self.es,
+                            dataset_id,
+                            self.lazo_client,
                         ),
-                        id=dataset_id,
                     )
+                except elasticsearch.NotFoundError:
+                    pass
+            except Exception as e:
+                if isinstance(e, elasticsearch.RequestError):
+                    # This is a problem with our computed metadata
+                    sentry_sdk.capture_exception(e)
+                    logger.exception(
+                        "Error inserting dataset %r in Elasticsearch",
+                        dataset_id,
+                    )
+                elif isinstance(e, elasticsearch.TransportError):
+                    # This is probably an issue with Elasticsearch
+                    # We'll log, nack and retry
+                    raise
+                elif (
+                    isinstance(e, BrokenProcessPool)
+                    and not message.redelivered
+                ):
+                    # The worker process died, maybe killed from outside
+                    # Retry once, in a new worker
+                    logger.warning(
+                        "Worker process died profiling dataset %r, "
+                        "retrying",
+                        dataset_id,
+                    )
+                    raise
                 else:
-                    await message.ack()
-                    logger.info("Dataset %r processed successfully",
-                                dataset_id)
-            except Exception:
-                await message.nack()
-                raise
-
-        def callback(future):
-            log_future(self.loop.create_task(coro(future)), logger)
+                    logger.warning("Error processing dataset %r",
+                                   dataset_id, exc_info=True)
+                # Move message to failed queue
+                await self.channel.default_exchange.publish(
+                    aio_pika.Message(message.body),
+                    self.failed_queue.name,
+                )
+                # Ack anyway, retrying would probably fail again
+                await message.ack()
 
-        return callback
+                self.es.index(
+                    'pending',
+                    dict(
+                        status='error',
+                        error="Error profiling dataset",
+                        error_details=exception_details(e),
+                        metadata=metadata,
+                        date=datetime.utcnow().isoformat(),
+                        source=metadata['source'],
+                        materialize=metadata['materialize'],
+                    ),
+                    id=dataset_id,
+                )
+            else:
+                await message.ack()
+                logger.info("Dataset %r processed successfully",
+                            dataset_id)
+        except Exception:
+            await message.nack()
+            raise
 
 
 def main():
     setup_logging()
-    prometheus_client.start_http_server(8000)
+    _mp_context.set_forkserver_preload([__name__])
+    multiproc_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if multiproc_dir:
+        # Collect metrics from the worker processes too. The deployment has
+        # to provide an empty directory, metrics were created on import
+        registry = prometheus_client.CollectorRegistry()
+        prometheus_client.multiprocess.MultiProcessCollector(registry)
+        prometheus_client.start_http_server(8000, registry=registry)
+    else:
+        logger.warning("PROMETHEUS_MULTIPROC_DIR is not set, metrics from "
+                       + "worker processes won't be collected")
+        prometheus_client.start_http_server(8000)
     logger.info(
         "Startup: profiler %s %s",
         os.environ['DATAMART_VERSION'],
@@ -37,3 +37,5 @@ if __name__ == '__main__':
     clear_cache('/cache/datasets', only_if_possible=only_if_possible)
     clear_cache('/cache/aug', only_if_possible=only_if_possible)
     clear_cache('/cache/user_data', only_if_possible=only_if_possible)
+    if os.path.isdir('/cache/profiles'):
+        clear_cache('/cache/profiles', only_if_possible=only_if_possible)
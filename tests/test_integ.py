@@ -2509,6 +2509,7 @@ class TestUpload(DatamartTest):
                             'specialId': 12,
                             'dept': "internal",
                             'source': 'upload',
+                            'size': lambda n: isinstance(n, int),
                             'materialize': {
                                 'identifier': 'datamart.url',
                                 'direct_url': 'http://test-discoverer:8080/basic.csv',
@@ -2616,6 +2617,7 @@ class TestUpload(DatamartTest):
                                 'specialId': 12,
                                 'dept': "internal",
                                 'source': 'upload',
+                                'size': 696,
                                 'materialize': {
                                     'identifier': 'datamart.upload',
                                     'date': lambda d: isinstance(d, str),
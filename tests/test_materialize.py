@@ -2,10 +2,12 @@ import copy
 import io
 import json
 import os
+import pickle
 import shutil
 import tempfile
 import unittest
 
+from datamart_materialize import DatasetTooBig
 from datamart_materialize.d3m import D3mWriter, _D3mAddIndex
 from datamart_materialize.pivot import pivot_table
 
@@ -353,3 +355,14 @@ class TestConvert(unittest.TestCase):
                 f_out.getvalue(),
                 f_exp.read(),
             )
+
+
+class TestErrors(unittest.TestCase):
+    def test_too_big_pickle(self):
+        """Test that DatasetTooBig keeps its limits through pickling"""
+        error = pickle.loads(pickle.dumps(
+            DatasetTooBig("Too big", limit=1000, actual=1500),
+        ))
+        self.assertIsInstance(error, DatasetTooBig)
+        self.assertEqual(error.args, ("Too big",))
+        self.assertEqual((error.limit, error.actual), (1000, 1500))
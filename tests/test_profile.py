@@ -2,23 +2,34 @@ import contextlib
 import csv
 from datetime import datetime
 from dateutil.tz import UTC
+import http.server
 import io
+import json
+import numpy
 import os
 import pandas
 import random
 import requests
 import tempfile
 import textwrap
+import threading
 import unittest
+import urllib.parse
 
 import datamart_geo
 from datamart_profiler import process_dataset
 from datamart_profiler.core import expand_attribute_name, load_data
+from datamart_profiler import encoding
+from datamart_profiler import incremental
+from datamart_profiler import numerical
 from datamart_profiler import profile_types
+from datamart_profiler import sketches
 from datamart_profiler import spatial
 from datamart_profiler.spatial import LATITUDE, LONGITUDE, LatLongColumn, \
     disambiguate_admin_areas
-from datamart_profiler.temporal import get_temporal_resolution, parse_date
+from datamart_profiler import temporal
+from datamart_profiler.temporal import get_temporal_resolution, parse_date, \
+    parse_date_array
 
 from .utils import DataTestCase, data
 
@@ -123,6 +134,227 @@ class TestSample(unittest.TestCase):
             data, metadata, column_names = load_data(tmp.name, 6000)
             self.assertEqual(data.shape, (425, 2))
 
+    def test_sample_header_only(self):
+        """Test sampling a file with no rows"""
+        with self.random_data(0) as (tmp, filesize):
+            data, metadata, column_names = load_data(tmp.name, 5)
+            self.assertEqual(list(data.columns), ['id', 'number'])
+            self.assertEqual(data.shape, (0, 2))
+            self.assertEqual(metadata['nb_rows'], 0)
+
+
+class TestWorkers(unittest.TestCase):
+    def test_workers(self):
+        """Test profiling columns in multiple processes"""
+        with data('spatiotemporal.csv') as data_fp:
+            expected = process_dataset(data_fp, plots=True, coverage=True)
+        with data('spatiotemporal.csv') as data_fp:
+            metadata = process_dataset(
+                data_fp, plots=True, coverage=True, workers=2,
+            )
+        self.assertEqual(metadata, expected)
+
+
+class FakeLazo(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.indexed = {}
+
+    def index_data(self, values, dataset_id, name):
+        with self.lock:
+            self.indexed[(dataset_id, name)] = values
+
+    def get_lazo_sketch_from_data(self, values, dataset_id, name):
+        return 1, sorted(values), len(values)
+
+
+class TestLazo(unittest.TestCase):
+    DATA = pandas.DataFrame({
+        'name': ['one', 'two', 'one', 'three', 'two', 'one'],
+        'number': ['1', '2', '1', '3', '2', '1'],
+        'color': ['red', 'blue', 'red', 'red', 'green', 'blue'],
+    })
+
+    def test_index(self):
+        """Test indexing the distinct values of textual columns"""
+        for workers in (None, 2):
+            lazo = FakeLazo()
+            process_dataset(
+                self.DATA, 'dataset1',
+                lazo_client=lazo, workers=workers,
+            )
+            self.assertEqual(
+                {k: sorted(v) for k, v in lazo.indexed.items()},
+                {
+                    ('dataset1', 'name'): ['one', 'three', 'two'],
+                    ('dataset1', 'color'): ['blue', 'green', 'red'],
+                },
+            )
+
+    def test_sketch(self):
+        """Test getting sketches of textual columns when searching"""
+        metadata = process_dataset(
+            self.DATA,
+            lazo_client=FakeLazo(), search=True,
+        )
+        self.assertEqual(
+            [col.get('lazo') for col in metadata['columns']],
+            [
+                dict(
+                    n_permutations=1,
+                    hash_values=['one', 'three', 'two'],
+                    cardinality=3,
+                ),
+                None,
+                dict(
+                    n_permutations=1,
+                    hash_values=['blue', 'green', 'red'],
+                    cardinality=3,
+                ),
+            ],
+        )
+
+
+class TestSketches(unittest.TestCase):
+    def test_hyperloglog(self):
+        """Test estimating distinct counts, and merging sketches"""
+        first = sketches.HyperLogLog()
+        self.assertEqual(first.count(), 0)
+        first.update(['a', 'b', 'a', 'c'])
+        self.assertEqual(first.count(), 3)
+
+        first = sketches.HyperLogLog()
+        first.update(['v%d' % i for i in range(60000)])
+        second = sketches.HyperLogLog()
+        second.update(['v%d' % i for i in range(40000, 100000)])
+        self.assertAlmostEqual(first.count(), 60000, delta=1800)
+        first.merge(second)
+        self.assertAlmostEqual(first.count(), 100000, delta=3000)
+
+    def test_topk(self):
+        """Test counting the most frequent items, with bounded memory"""
+        top = sketches.TopK()
+        top.update('abcbcc')
+        top.update(['d', 'a'], [1, 3])
+        self.assertEqual(
+            top.most_common(3),
+            [('a', 4), ('c', 3), ('b', 2)],
+        )
+        self.assertEqual(top.error, 0)
+
+        # Frequent items survive, though many others are seen
+        top = sketches.TopK(capacity=10)
+        other = sketches.TopK(capacity=10)
+        for i in range(100):
+            top.update(['x%d' % i, 'frequent', 'frequent'])
+            other.update(['y%d' % i, 'frequent', 'second'])
+        top.merge(other)
+        self.assertLessEqual(len(top.counts), 20)
+        self.assertEqual(top.most_common(2), [
+            ('frequent', 300), ('second', 100),
+        ])
+        # The error bounds the count of items that were dropped
+        self.assertNotIn('x50', top.counts)
+        self.assertGreaterEqual(top.error, 1)
+
+    def test_kll(self):
+        """Test estimating quantiles, and merging sketches"""
+        rand = numpy.random.RandomState(1)
+        values = rand.permutation(100000).astype(float)
+        first = sketches.KLLSketch()
+        second = sketches.KLLSketch()
+        for i in range(0, 60000, 7000):
+            first.update(values[i:min(i + 7000, 60000)])
+        second.update(numpy.concatenate([values[60000:], [numpy.nan]]))
+        self.assertEqual(second.count, 40000)
+        first.merge(second)
+        self.assertEqual(first.count, 100000)
+        self.assertLess(sum(len(level) for level in first.levels), 1000)
+        items, weights = first.weighted_items()
+        self.assertEqual(weights.sum(), 100000)
+        for q in (0.01, 0.25, 0.5, 0.9, 0.99):
+            self.assertAlmostEqual(first.quantile(q), q * 100000, delta=2000)
+
+
+class TestNumericalRanges(unittest.TestCase):
+    def test_optimal_clusters(self):
+        """Test optimal clustering against trying every split"""
+        def cost(values, weights, start, end):
+            values, weights = values[start:end], weights[start:end]
+            mean = (values * weights).sum() / weights.sum()
+            return (weights * (values - mean) ** 2).sum()
+
+        rand = numpy.random.RandomState(1)
+        for _ in range(100):
+            values = numpy.unique(rand.randint(0, 50, 15)).astype(float)
+            weights = rand.randint(1, 5, len(values)).astype(float)
+            expected = min(
+                sum(
+                    cost(values, weights, start, end)
+                    for start, end in zip((0, i, j), (i, j, len(values)))
+                )
+                for i in range(1, len(values))
+                for j in range(i + 1, len(values))
+            )
+            starts = numerical.optimal_clusters_1d(values, weights, 3)
+            self.assertEqual(starts[0], 0)
+            self.assertAlmostEqual(
+                sum(
+                    cost(values, weights, start, end)
+                    for start, end in zip(starts, starts[1:] + [len(values)])
+                ),
+                expected,
+            )
+
+    def test_ranges(self):
+        """Test getting numerical ranges"""
+        values = [1.0] * 10 + [2.0] * 10 + [10.0] * 20 + [11.0] + [50.0] * 30
+        self.assertEqual(
+            numerical.get_numerical_ranges(values),
+            [
+                {'range': {'gte': 1.0, 'lte': 2.0}},
+                {'range': {'gte': 10.0, 'lte': 10.0}},
+                {'range': {'gte': 50.0, 'lte': 50.0}},
+            ],
+        )
+        self.assertEqual(
+            numerical.get_numerical_ranges([3.0, 3.0]),
+            [{'range': {'gte': 3.0, 'lte': 3.0}}],
+        )
+        self.assertEqual(numerical.get_numerical_ranges([]), [])
+
+    def test_summary(self):
+        """Test summarizing numbers chunk by chunk"""
+        rand = numpy.random.RandomState(1)
+        values = numpy.concatenate([
+            rand.normal(0.0, 1.0, 30000),
+            rand.normal(50.0, 2.0, 20000),
+        ])
+        rand.shuffle(values)
+        summary = numerical.NumericalSummary()
+        for i in range(0, 30000, 5000):
+            summary.update(values[i:i + 5000])
+        other = numerical.NumericalSummary()
+        other.update(values[30000:])
+        summary.merge(other)
+
+        self.assertEqual(summary.count, 50000)
+        self.assertEqual(summary.min, values.min())
+        self.assertEqual(summary.max, values.max())
+        mean, stddev = summary.mean_stddev()
+        self.assertAlmostEqual(mean, values.mean())
+        self.assertAlmostEqual(stddev, values.std())
+        ranges = summary.ranges()
+        self.assertEqual(len(ranges), 3)
+        self.assertLess(ranges[0]['range']['lte'], 5.0)
+        self.assertGreater(ranges[-1]['range']['gte'], 40.0)
+        counts, edges = summary.histogram()
+        self.assertEqual(counts.sum(), 50000)
+        self.assertEqual(edges[0], values.min())
+        self.assertEqual(edges[-1], values.max())
+        expected, _ = numpy.histogram(values, bins=edges)
+        numpy.testing.assert_allclose(counts, expected, atol=1000)
+
 
 class TestNames(unittest.TestCase):
     def test_names(self):
@@ -204,6 +436,213 @@ class TestIndex(unittest.TestCase):
         )
 
 
+class TestColumns(DataTestCase):
+    def test_columns(self):
+        """Test profiling only some of the columns"""
+        with data('spatiotemporal.csv') as data_fp:
+            expected = process_dataset(data_fp, coverage=True)
+        with data('spatiotemporal.csv') as data_fp:
+            metadata = process_dataset(
+                data_fp, coverage=True,
+                columns=['longitude', 'latitude', 3],
+            )
+        self.assertEqual(metadata['nb_columns'], 4)
+        self.assertEqual(
+            metadata['columns'],
+            [{'name': 'date', 'unprofiled': True}] + expected['columns'][1:],
+        )
+        self.assertEqual(
+            metadata['spatial_coverage'],
+            expected['spatial_coverage'],
+        )
+        self.assertNotIn('temporal_coverage', metadata)
+
+        with data('spatiotemporal.csv') as data_fp:
+            metadata = process_dataset(
+                data_fp, coverage=True,
+                columns=['date'],
+            )
+        self.assertEqual(
+            metadata['temporal_coverage'][0]['column_indexes'],
+            [0],
+        )
+
+    def test_invalid(self):
+        """Test selecting columns that don't exist"""
+        with self.assertRaises(ValueError):
+            process_dataset(TestIndex.DATA, columns=['d'])
+        with self.assertRaises(ValueError):
+            process_dataset(TestIndex.DATA, columns=[3])
+
+
+class TestChunked(unittest.TestCase):
+    def test_chunked(self):
+        """Test computing statistics over the whole file, by chunks"""
+        rand = numpy.random.RandomState(1)
+        df = pandas.DataFrame({
+            'number': rand.normal(10.0, 3.0, 20000).round(2),
+            'date': (
+                pandas.Timestamp('2010-01-01')
+                + pandas.to_timedelta(rand.randint(0, 3000, 20000), unit='D')
+            ).strftime('%Y-%m-%d'),
+        })
+        df.loc[123, 'number'] = 1000.0
+        df.loc[4567, 'date'] = '2020-06-30'
+        csv_data = df.to_csv(index=False).encode('utf-8')
+
+        metadata = process_dataset(
+            io.BytesIO(csv_data), load_max_size=50000, plots=True,
+        )
+        self.assertLess(metadata['nb_profiled_rows'], 20000)
+        metadata = process_dataset(
+            io.BytesIO(csv_data), load_max_size=50000, plots=True,
+            chunked=True,
+        )
+        self.assertLess(metadata['nb_profiled_rows'], 20000)
+        self.assertEqual(metadata['nb_rows'], 20000)
+
+        number = metadata['columns'][0]
+        self.assertAlmostEqual(number['mean'], df['number'].mean())
+        self.assertAlmostEqual(number['stddev'], df['number'].std(ddof=0))
+        plot = number['plot']['data']
+        self.assertEqual(sum(bin['count'] for bin in plot), 20000)
+        self.assertEqual(plot[-1]['bin_end'], 1000.0)
+
+        date = metadata['columns'][1]
+        self.assertEqual(date['plot']['type'], 'histogram_temporal')
+        plot = date['plot']['data']
+        self.assertEqual(sum(bin['count'] for bin in plot), 20000)
+        self.assertEqual(plot[-1]['date_end'], '2020-06-30T00:00:00')
+        self.assertEqual(
+            metadata['temporal_coverage'][0]['ranges_date'],
+            [{'range': {
+                'gte': datetime(2020, 6, 30, tzinfo=UTC),
+                'lte': datetime(2010, 1, 1, tzinfo=UTC),
+            }}],
+        )
+
+    def test_dataframe(self):
+        """Test that chunked is ignored for DataFrames"""
+        with self.assertWarns(UserWarning):
+            metadata = process_dataset(TestIndex.DATA, chunked=True)
+        self.assertEqual(metadata['nb_profiled_rows'], 4)
+
+
+class TestIncremental(unittest.TestCase):
+    def test_update(self):
+        """Test profiling appended rows from the state of previous ones"""
+        rand = numpy.random.RandomState(1)
+        df = pandas.DataFrame({
+            'date': (
+                pandas.Timestamp('2015-01-01')
+                + pandas.to_timedelta(numpy.arange(3000), unit='D')
+            ).strftime('%Y-%m-%d'),
+            'value': rand.normal(10.0, 2.0, 3000).round(3),
+            'color': rand.choice(
+                ['red', 'green', 'blue', 'black'], 3000, p=[.4, .3, .2, .1],
+            ),
+            'lat': rand.uniform(40.5, 40.9, 3000).round(5),
+            'long': rand.uniform(-74.2, -73.7, 3000).round(5),
+        })
+        df.loc[5, 'value'] = numpy.nan
+
+        expected = process_dataset(df, plots=True)
+        previous = process_dataset(df.iloc[:2000], plots=True)
+        state = incremental.get_dataset_state(df.iloc[:2000], previous)
+        # Round-trip through JSON
+        state = incremental.DatasetState.from_dict(
+            json.loads(json.dumps(state.to_dict())),
+        )
+        metadata = incremental.update_dataset(
+            df.iloc[2000:].reset_index(drop=True), previous, state,
+        )
+        self.assertEqual(previous['nb_rows'], 2000)
+        self.assertEqual(metadata['nb_rows'], 3000)
+        self.assertEqual(state.nb_rows, 3000)
+
+        date, value, color, lat, _ = metadata['columns']
+        self.assertAlmostEqual(
+            date['num_distinct_values'], 3000, delta=60,
+        )
+        self.assertEqual(
+            sum(bin['count'] for bin in date['plot']['data']), 3000,
+        )
+        for key in ('ranges_date', 'ranges_time'):
+            self.assertEqual(
+                metadata['temporal_coverage'][0][key],
+                expected['temporal_coverage'][0][key],
+            )
+        self.assertAlmostEqual(value['mean'], expected['columns'][1]['mean'])
+        self.assertAlmostEqual(
+            value['stddev'], expected['columns'][1]['stddev'],
+        )
+        self.assertAlmostEqual(value['missing_values_ratio'], 1 / 3000)
+        self.assertEqual(len(value['coverage']), 3)
+        self.assertEqual(color['plot'], expected['columns'][2]['plot'])
+        self.assertAlmostEqual(lat['mean'], expected['columns'][3]['mean'])
+        self.assertEqual(
+            metadata['spatial_coverage'][0]['geohashes4'],
+            expected['spatial_coverage'][0]['geohashes4'],
+        )
+        self.assertEqual(metadata['spatial_coverage'][0]['number'], 3000)
+
+        with self.assertRaises(ValueError):
+            incremental.update_dataset(df.iloc[:, :3], previous, state)
+
+    def test_index(self):
+        """Test summarizing a DataFrame that has an index set"""
+        df = TestIndex.DATA.set_index('a')
+        metadata = process_dataset(df)
+        state = incremental.get_dataset_state(df, metadata)
+        self.assertEqual(state.nb_rows, 4)
+        self.assertEqual(state.columns[0].distinct.count(), 2)
+
+        metadata = process_dataset(df, indexes=False)
+        state = incremental.get_dataset_state(df, metadata, indexes=False)
+        self.assertEqual(state.nb_rows, 4)
+        self.assertEqual(state.columns[0].distinct.count(), 4)
+
+
+class TestTyped(unittest.TestCase):
+    DATA = pandas.DataFrame({
+        'id': numpy.arange(30),
+        'number': numpy.arange(30) % 7,
+        'missing': [1.0, numpy.nan, 3.0] * 10,
+        'flag': [True, False, False] * 10,
+        'lat': numpy.arange(30) * 2.5 - 37.5,
+        'date': pandas.date_range('2020-01-01', periods=30, freq='D'),
+        'compact': [20200101 + i for i in range(30)],
+        'year': [2000 + i % 4 for i in range(30)],
+        'text': ['a', 'b', 'c'] * 10,
+    })
+
+    def test_typed(self):
+        """Test profiling a DataFrame from its dtypes, compared to strings"""
+        expected = process_dataset(self.DATA, coverage=True, plots=True)
+        metadata = process_dataset(
+            self.DATA, coverage=True, plots=True, typed=True,
+        )
+        self.assertEqual(
+            [
+                (col['name'], col['structural_type'], col['semantic_types'])
+                for col in metadata['columns']
+            ],
+            [
+                (col['name'], col['structural_type'], col['semantic_types'])
+                for col in expected['columns']
+            ],
+        )
+        self.assertEqual(metadata, expected)
+
+    def test_encode(self):
+        """Test encoding a column with missing values, keeping its dtype"""
+        array = encoding.TypedColumn.from_array(self.DATA['missing'])
+        self.assertEqual(array.native.dtype, numpy.float64)
+        self.assertEqual(list(array.counts), [10, 10, 10])
+        self.assertEqual(list(array.values), ['1.0', '3.0', ''])
+        self.assertEqual(list(array.codes[:4]), [0, 2, 1, 0])
+
+
 class TestLatlongSelection(DataTestCase):
     def test_normalize_name(self):
         """Test normalizing column names"""
@@ -352,6 +791,38 @@ class TestDates(DataTestCase):
             None,
         )
 
+    def test_parse_array(self):
+        """Test parsing dates in bulk, with format inference"""
+        values = [
+            '2019-07-02T21:13:19Z',
+            '2019-07-02 21:13',
+            '2020-12',
+            '2020',
+            '13/02/2020',
+            '02/13/2020',
+            '2019-07-02T21:13:19-04:00',
+            '11:00',
+            '',
+            'June 2020',
+        ]
+        dates = parse_date_array(values)
+        self.assertEqual(str(dates.dtype), 'datetime64[ns, UTC]')
+        self.assertEqual(
+            [None if dt is pandas.NaT else dt for dt in dates],
+            [
+                datetime(2019, 7, 2, 21, 13, 19, tzinfo=UTC),
+                datetime(2019, 7, 2, 21, 13, tzinfo=UTC),
+                datetime(2020, 12, 1, tzinfo=UTC),
+                None,
+                datetime(2020, 2, 13, tzinfo=UTC),
+                datetime(2020, 2, 13, tzinfo=UTC),
+                parse_date('2019-07-02T21:13:19-04:00'),
+                None,
+                None,
+                datetime(2020, 6, 1, tzinfo=UTC),
+            ],
+        )
+
     def test_year(self):
         """Test the 'year' special-case"""
         dataframe = pandas.DataFrame({
@@ -360,25 +831,20 @@ class TestDates(DataTestCase):
         })
         metadata = process_dataset(dataframe)
 
-        def year_rng(year):
-            year = float(year)
-            return {'range': {'gte': year, 'lte': year}}
-
         self.assertJson(
             metadata,
             {
                 'nb_rows': 3,
                 'nb_profiled_rows': 3,
                 'nb_columns': 2,
-                'nb_temporal_columns': 1,
                 'nb_numerical_columns': 1,
-                'types': ['numerical', 'temporal'],
+                'types': ['numerical'],
                 'attribute_keywords': ['year', 'number'],
                 'columns': [
                     {
                         'name': 'year',
                         'structural_type': 'http://schema.org/Text',
-                        'semantic_types': ['http://schema.org/DateTime'],
+                        'semantic_types': ['http://schema.org/Date'],
                         'unclean_values_ratio': 0.0,
                         'num_distinct_values': 3,
                     },
@@ -402,11 +868,18 @@ class TestDates(DataTestCase):
                         'type': 'datetime',
                         'column_names': ['year'],
                         'column_indexes': [0],
-                        'column_types': ['http://schema.org/DateTime'],
-                        'ranges': [
-                            year_rng(1072915200.0),
-                            year_rng(1104537600.0),
-                            year_rng(1136073600.0),
+                        'column_types': ['http://schema.org/Date'],
+                        'ranges_date': [
+                            {'range': {
+                                'gte': datetime(2006, 1, 1, tzinfo=UTC),
+                                'lte': datetime(2004, 1, 1, tzinfo=UTC),
+                            }},
+                        ],
+                        'ranges_time': [
+                            {'range': {
+                                'gte': lambda n: int(n) == 1136073600,
+                                'lte': lambda n: int(n) == 1072915200,
+                            }},
                         ],
                         'temporal_resolution': 'year',
                     },
@@ -414,6 +887,96 @@ class TestDates(DataTestCase):
             },
         )
 
+    def test_year_out_of_bounds(self):
+        """Test a 'year' column with years pandas can't represent"""
+        dataframe = pandas.DataFrame({
+            'year': ['1500', '1600', '1700'],
+            'value': [12, 15, 13],
+        })
+        metadata = process_dataset(dataframe)
+        self.assertEqual(
+            metadata['columns'][0]['semantic_types'],
+            ['http://schema.org/Date'],
+        )
+        self.assertEqual(
+            metadata['temporal_coverage'][0]['ranges_date'],
+            [{'range': {
+                'gte': datetime(1700, 1, 1, tzinfo=UTC),
+                'lte': datetime(1700, 1, 1, tzinfo=UTC),
+            }}],
+        )
+
+        dataframe = pandas.DataFrame({
+            'year': ['1500', '1600', '1650'],
+            'value': [12, 15, 13],
+        })
+        metadata = process_dataset(dataframe)
+        self.assertNotIn('temporal_coverage', metadata)
+
+
+class TestSplitDates(unittest.TestCase):
+    def test_combine(self):
+        """Test building datetimes from parts in multiple columns"""
+        dataframe = pandas.DataFrame({
+            'y': ['2020', '2020', '2021', '2021', ''],
+            'm': ['1', 'Feb', 'december', '2', '3'],
+            'd': ['31', '29', '1', '30', '1'],
+            'h': ['0', '12', '23', '1', '1'],
+            'ym': ['2020-01', '202002', '2021-13', '2021', 'x'],
+        })
+        indexes, dates = temporal.combine_temporal_columns(
+            dataframe,
+            {0: 'Year', 1: 'Month', 2: 'Day', 3: 'Hour'},
+        )
+        self.assertEqual(indexes, [0, 1, 2, 3])
+        self.assertEqual(
+            list(dates),
+            list(parse_date_array([
+                '2020-01-31 00:00', '2020-02-29 12:00', '2021-12-01 23:00',
+            ])),
+        )
+
+        # Time is ignored without a day
+        indexes, dates = temporal.combine_temporal_columns(
+            dataframe,
+            {4: 'Year_Month', 3: 'Hour'},
+        )
+        self.assertEqual(indexes, [4])
+        self.assertEqual(
+            list(dates),
+            list(parse_date_array(['2020-01-01', '2020-02-01'])),
+        )
+
+        # Not a date
+        self.assertIsNone(temporal.combine_temporal_columns(
+            dataframe,
+            {0: 'Year', 2: 'Day'},
+        ))
+
+    def test_profile(self):
+        """Test temporal coverage of a date split over multiple columns"""
+        dataframe = pandas.DataFrame({
+            'year': [2019, 2019, 2019, 2020] * 3,
+            'month': [1, 2, 3, 4] * 3,
+            'day': [4, 8, 15, 16] * 3,
+            'value': list(range(12)),
+        })
+        metadata = process_dataset(dataframe)
+        coverage, = metadata['temporal_coverage']
+        self.assertEqual(coverage['column_names'], ['year', 'month', 'day'])
+        self.assertEqual(coverage['column_indexes'], [0, 1, 2])
+        self.assertEqual(
+            coverage['ranges_date'],
+            [{'range': {
+                'gte': datetime(2020, 4, 16, tzinfo=UTC),
+                'lte': datetime(2019, 1, 4, tzinfo=UTC),
+            }}],
+        )
+        self.assertEqual(
+            coverage['quarter_percentage_data'],
+            {1: 75.0, 2: 25.0},
+        )
+
 
 class TestTemporalResolutions(unittest.TestCase):
     def test_pandas(self):
@@ -432,6 +995,35 @@ class TestTemporalResolutions(unittest.TestCase):
 
         self.do_checks(get_res)
 
+    def test_large(self):
+        """Test guessing temporal resolution of regular series"""
+        for freq, expected in [
+            ('AS', 'year'),
+            ('QS', 'quarter'),
+            ('MS', 'month'),
+            ('W-MON', 'week'),
+            ('W-WED', 'week'),
+            ('D', 'day'),
+            ('H', 'hour'),
+            ('5T', 'minute'),
+            ('S', 'second'),
+            ('250L', 'second'),
+        ]:
+            idx = pandas.date_range('1950-01-01', periods=100, freq=freq)
+            self.assertEqual(get_temporal_resolution(idx), expected)
+
+            # Shuffled, repeated, with some missing values
+            idx = idx.repeat(3)[numpy.random.RandomState(0).permutation(300)]
+            idx = idx.insert(10, pandas.NaT)
+            self.assertEqual(get_temporal_resolution(idx), expected)
+
+        # A few hours in a daily series
+        idx = pandas.date_range('2020-01-01', periods=100, freq='D')
+        idx = idx.append(idx[:4] + pandas.Timedelta(hours=1))
+        self.assertEqual(get_temporal_resolution(idx), 'day')
+        idx = idx.append(idx[4:10] + pandas.Timedelta(hours=1))
+        self.assertEqual(get_temporal_resolution(idx), 'hour')
+
     def do_checks(self, get_res):
         self.assertEqual(
             get_res([
@@ -568,6 +1160,70 @@ class TestTemporalResolutions(unittest.TestCase):
         )
 
 
+class TestTemporalDistributions(unittest.TestCase):
+    DATES = [
+        '2019-12-30T05:00:00',  # ISO week 1 of 2020
+        '2020-01-01T11:59:59',
+        '2020-04-01T12:00:00',
+        '2020-12-31T23:00:00',
+    ]
+
+    def test_native(self):
+        """Test distributions from native Python values"""
+        self.do_checks([parse_date(d) for d in self.DATES])
+
+    def test_datetime64(self):
+        """Test distributions from a datetime64 array"""
+        self.do_checks(parse_date_array(self.DATES))
+
+    def do_checks(self, values):
+        self.assertEqual(
+            temporal.getWeekData(values),
+            {1: 50.0, 14: 25.0, 53: 25.0},
+        )
+        self.assertEqual(
+            temporal.getQuarterData(values),
+            {1: 25.0, 2: 25.0, 4: 50.0},
+        )
+        self.assertEqual(
+            temporal.getTimeOfDayData(values),
+            {'night': 25.0, 'morning': 25.0, 'afternoon': 25.0,
+             'evening': 25.0},
+        )
+        self.assertEqual(
+            temporal.get_temporal_ranges(values),
+            [{'range': {
+                'gte': datetime(2020, 12, 31, 23, tzinfo=UTC),
+                'lte': datetime(2019, 12, 30, 5, tzinfo=UTC),
+            }}],
+        )
+
+    def test_histogram(self):
+        """Test the temporal histogram, computed on exact values"""
+        values = parse_date_array([
+            '2020-01-01T00:00:00',
+            '2020-01-01T00:00:09',
+            '2020-01-01T00:00:10',
+            '2020-01-01T00:00:01.5',
+        ])
+        counts, edges = temporal.get_temporal_histogram(values, bins=10)
+        self.assertEqual(counts, [1, 1, 0, 0, 0, 0, 0, 0, 0, 2])
+        self.assertEqual(
+            [e.isoformat() for e in edges[:3] + edges[-1:]],
+            [
+                '2020-01-01T00:00:00',
+                '2020-01-01T00:00:01',
+                '2020-01-01T00:00:02',
+                '2020-01-01T00:00:10',
+            ],
+        )
+
+        # A single value is in the middle bin
+        counts, edges = temporal.get_temporal_histogram(values[:1], bins=10)
+        self.assertEqual(counts, [0, 0, 0, 0, 0, 1, 0, 0, 0, 0])
+        self.assertEqual(edges[0].isoformat(), '2019-12-31T23:59:59.500000')
+
+
 class TestTypes(unittest.TestCase):
     def do_test(self, match, positive, negative):
         for elem in textwrap.dedent(positive).splitlines():
@@ -854,6 +1510,175 @@ class TestNominatim(DataTestCase):
         finally:
             spatial.nominatim_query = old_query
 
+    def test_server(self):
+        """Test resolving addresses from a local server, with caching"""
+        requests_received = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = urllib.parse.parse_qs(
+                    urllib.parse.urlparse(self.path).query,
+                )
+                batch = [q['q'] for q in json.loads(query['batch'][0])]
+                requests_received.append(batch)
+                results = []
+                for q in batch:
+                    if q.startswith('nowhere'):
+                        results.append([])
+                    else:
+                        number = int(q.split(' ', 1)[0])
+                        results.append([{'lat': number, 'lon': -number}])
+                body = json.dumps({'batch': results}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = 'http://127.0.0.1:%d/' % server.server_address[1]
+        addresses = ['%d Main St' % i for i in range(50)] + ['nowhere']
+        expected = [(float(i), float(-i)) for i in range(50)]
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                cache = spatial.SqliteNominatimCache(
+                    os.path.join(tmp, 'cache.sqlite3'),
+                )
+                res, non_empty = spatial.nominatim_resolve_all(
+                    url, addresses, cache=cache,
+                )
+                self.assertEqual(res, expected)
+                self.assertEqual(non_empty, 51)
+                self.assertEqual(len(requests_received), 3)
+                self.assertEqual(
+                    sorted(a for batch in requests_received for a in batch),
+                    sorted(addresses),
+                )
+
+                # Results are persisted, including addresses not found
+                requests_received[:] = []
+                cache = spatial.SqliteNominatimCache(
+                    os.path.join(tmp, 'cache.sqlite3'),
+                )
+                res, non_empty = spatial.nominatim_resolve_all(
+                    url, addresses + ['50 Main St'], cache=cache,
+                )
+                self.assertEqual(res, expected + [(50.0, -50.0)])
+                self.assertEqual(requests_received, [['50 Main St']])
+
+                # Size limit
+                cache = spatial.SqliteNominatimCache(
+                    os.path.join(tmp, 'cache.sqlite3'),
+                    max_size=10,
+                )
+                cache.set_many(url, {'51 Main St': (51.0, -51.0)})
+                self.assertEqual(
+                    len(cache.get_many(
+                        url,
+                        addresses + ['50 Main St', '51 Main St'],
+                    )),
+                    10,
+                )
+
+            # In-memory cache, with expiration
+            requests_received[:] = []
+            cache = spatial.NominatimCache(max_size=30, ttl=-1)
+            res, non_empty = spatial.nominatim_resolve_all(
+                url, addresses, max_requests=20, cache=cache,
+            )
+            self.assertEqual(res, expected[:20])
+            self.assertEqual(non_empty, 20)
+            self.assertEqual(len(requests_received), 1)
+            self.assertEqual(cache.get_many(url, addresses), {})
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestCachedGeoData(unittest.TestCase):
+    class FakeArea(object):
+        def __init__(self, geo, id, type, parent):
+            self.geo = geo
+            self.id = id
+            self.type = type
+            self.parent = parent
+            self.levels = [None] * 6
+
+        def get_parent_area(self):
+            self.geo.parent_lookups += 1
+            if self.parent is None:
+                return None
+            return self.geo.areas[self.parent]
+
+        def __repr__(self):
+            return '<Area %s>' % self.id
+
+    class FakeGeoData(object):
+        def __init__(self):
+            self._data_path = '/geo'
+            self.name_lookups = 0
+            self.parent_lookups = 0
+            area = TestCachedGeoData.FakeArea
+            self.areas = {
+                'us': area(self, 'us', datamart_geo.Type.COUNTRY, None),
+                'in': area(self, 'in', datamart_geo.Type.COUNTRY, None),
+                'ny': area(self, 'ny', datamart_geo.Type.ADMIN_1, 'us'),
+                'ct': area(self, 'ct', datamart_geo.Type.ADMIN_1, 'us'),
+                'ct2': area(self, 'ct2', datamart_geo.Type.ADMIN_1, 'in'),
+                'nj': area(self, 'nj', datamart_geo.Type.ADMIN_1, 'us'),
+            }
+            for area in self.areas.values():
+                area.levels[0] = area.parent or area.id
+                area.levels[area.type.value] = area.id
+            self.names = {
+                'NY': ['ny'], 'CT': ['ct2', 'ct'], 'NJ': ['nj'],
+            }
+
+        def resolve_name_all(self, name):
+            self.name_lookups += 1
+            for area_id in self.names.get(name, []):
+                yield self.areas[area_id]
+
+    def test_cache(self):
+        """Test memoizing admin area lookups"""
+        fake = self.FakeGeoData()
+        names = ['NY', 'CT', 'NJ', 'XX']
+        expected = disambiguate_admin_areas(
+            [r for r in (list(fake.resolve_name_all(n)) for n in names) if r],
+        )
+        self.assertEqual(expected[0], 1)
+        self.assertEqual(
+            [area.id for area in expected[1]],
+            ['ny', 'ct', 'nj'],
+        )
+
+        geo_data = spatial.CachedGeoData(fake, max_size=10)
+        self.assertEqual(geo_data._data_path, '/geo')
+        for _ in range(3):
+            fake.name_lookups = fake.parent_lookups = 0
+            admin_areas = geo_data.resolve_names_all(names)
+            admin_areas = [r for r in admin_areas if r]
+            self.assertEqual(
+                disambiguate_admin_areas(admin_areas, geo_data),
+                expected,
+            )
+        self.assertEqual(fake.name_lookups, 0)
+        self.assertEqual(fake.parent_lookups, 0)
+        self.assertEqual(geo_data.resolve_name('CT').id, 'ct2')
+        self.assertIsNone(geo_data.resolve_name('XX'))
+
+        # Size limit
+        geo_data = spatial.CachedGeoData(fake, max_size=2)
+        geo_data.resolve_names_all(names)
+        fake.name_lookups = 0
+        geo_data.resolve_names_all(['NJ', 'XX', 'NY'])
+        self.assertEqual(fake.name_lookups, 1)
+
 
 class TestGeo(DataTestCase):
     @classmethod
@@ -1346,6 +2171,23 @@ class TestGeoHash(unittest.TestCase):
             ),
         )
 
+    def test_hash_array(self):
+        points = [
+            (40.6962574, -73.9849621),
+            (48.8588376, 2.2768489),
+            (45.0, 90.0),
+            (-90.0, 180.0),
+        ]
+        for base, precision in [(4, 16), (32, 12), (32, 5)]:
+            codes = spatial.hash_locations(points, base, precision)
+            self.assertEqual(
+                spatial.codes_to_hashes(codes, base, precision),
+                [
+                    spatial.hash_location(point, base, precision)
+                    for point in points
+                ],
+            )
+
     def test_sketch_points(self):
         test_data = [
             ((40.0, 10.0), '3011'),
@@ -1438,6 +2280,26 @@ class TestGeoHash(unittest.TestCase):
             ],
         )
 
+    def test_sketch_aabs(self):
+        boxes = [
+            (-100.0, -30.0, -15.0, 50.0),
+            (-80.0, 20.0, -50.0, 15.0),
+            (-100.0, -30.0, -15.0, 50.0),
+            (170.0, -170.0, 10.0, 20.0),
+        ]
+        expected = spatial.Geohasher(base=4, precision=5, number=40)
+        for box in boxes:
+            expected.add_aab(box)
+        builder = spatial.Geohasher(base=4, precision=5, number=40)
+        builder.add_aabs(boxes)
+        self.assertEqual(builder.get_hashes(), expected.get_hashes())
+        self.assertEqual(builder.precision, 3)
+        self.assertEqual(builder.total, 4)
+        self.assertEqual(
+            builder.get_hashes()[:3],
+            [('013', 2), ('031', 3), ('033', 3)],
+        )
+
 
 class TestMedianDist(unittest.TestCase):
     def test_median_dist(self):
@@ -1460,3 +2322,25 @@ class TestMedianDist(unittest.TestCase):
             0.9,
             delta=0.05
         )
+
+
+class TestSpatialRanges(unittest.TestCase):
+    def test_sampled(self):
+        """Test building spatial ranges from a sample of many points"""
+        rand = numpy.random.RandomState(2)
+        points = numpy.concatenate([
+            rand.uniform((40.0, -74.0), (41.0, -73.0), (30000, 2)),
+            rand.uniform((34.0, -119.0), (35.0, -118.0), (10000, 2)),
+        ])
+        ranges = spatial.get_spatial_ranges(points)
+        coords = [rg['range']['coordinates'] for rg in ranges]
+        self.assertTrue(all(
+            rg['range']['type'] == 'envelope' for rg in ranges
+        ))
+        # The smaller group is a single cluster, sorted first
+        self.assertEqual(len(coords), 3)
+        [min_long, max_lat], [max_long, min_lat] = coords[0]
+        self.assertAlmostEqual(min_long, -118.95, delta=0.01)
+        self.assertAlmostEqual(max_long, -118.05, delta=0.01)
+        self.assertAlmostEqual(min_lat, 34.05, delta=0.01)
+        self.assertAlmostEqual(max_lat, 34.95, delta=0.01)